@@ -1,31 +1,331 @@
 
 # Import FastAPI and supporting libraries
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
+from typing import Literal
 # Import core logic modules
-from query import query_helpdesk
-from responder import generate_response
+from query import query_helpdesk, query_helpdesk_batch, set_dense_search_disabled, dense_search_disabled
+from encoder import MODEL_NAME, embed_query, embed_texts, warm_up, encoder_stats, active_backend
+from responder import agenerate_response, astream_response, FALLBACK_RESPONSE
+from semantic_cache import SemanticCache
+from retriever import MANIFEST_PATH, load_manifest, indexed_embedding_space
+from router import reset_router
+from canonical_answers import CanonicalAnswers
+from session_store import SessionStore, plan_retrieval, merge_results, SESSION_RETRIEVALS
+from admission import AdmissionController, AdmissionMiddleware, ADMISSION_ENABLED
+from context_packer import pack_context, CONTEXT_TOKEN_BUDGET
+from evaluation import load_scenarios, run_evaluation
+from metrics import (span, render, start_request_timings, server_timing_header, CallbackMetric,
+                     REQUEST_SECONDS, TIME_TO_FIRST_TOKEN_SECONDS, CONTEXT_TOKENS)
 import uvicorn
 # Main entry point: Run the API server
 import webbrowser
 import threading  
 import re
+import os
+import json
+import time
+import asyncio
+import contextvars
+import random
+from collections import deque
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+# Concurrency limits and timeouts (override via environment variables)
+RETRIEVAL_WORKERS        = int(os.getenv("RETRIEVAL_WORKERS", "8"))            # threads for blocking Chroma/embedding work
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv("MAX_CONCURRENT_LLM_CALLS", "200"))   # in-flight completions per worker
+RETRIEVAL_TIMEOUT_SECONDS = float(os.getenv("RETRIEVAL_TIMEOUT_SECONDS", "10"))
+GENERATION_TIMEOUT_SECONDS = float(os.getenv("GENERATION_TIMEOUT_SECONDS", "60"))
+# /chat/batch limits: questions per request, concurrent LLM calls per batch, retries on timeouts
+BATCH_MAX_QUESTIONS        = int(os.getenv("BATCH_MAX_QUESTIONS", "500"))
+BATCH_LLM_CONCURRENCY      = int(os.getenv("BATCH_LLM_CONCURRENCY", "16"))
+BATCH_MAX_RETRIES          = int(os.getenv("BATCH_MAX_RETRIES", "2"))
+BATCH_RETRY_BASE_SECONDS   = float(os.getenv("BATCH_RETRY_BASE_SECONDS", "1"))
+BATCH_RETRIEVAL_TIMEOUT_SECONDS = float(os.getenv("BATCH_RETRIEVAL_TIMEOUT_SECONDS", "120"))
+# Semantic answer cache settings (SEMANTIC_CACHE_MAX_ENTRIES=0 disables it)
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1024"))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "3600"))
+SEMANTIC_CACHE_THRESHOLD   = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+# Add a Server-Timing header with per-stage durations to every response (else only on X-Debug-Timing: 1)
+TIMING_HEADER = os.getenv("TIMING_HEADER", "0") == "1"
+
+# Bounded executor so retrieval never runs on (or starves) the event loop
+retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+# Caps concurrent LLM calls so a burst queues here instead of overwhelming the provider
+llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+# Recent (time-to-first-token, total generation) timings of streamed answers, in seconds
+stream_timings = deque(maxlen=1000)
+# Answers for near-duplicate questions are served from here instead of the LLM
+response_cache = SemanticCache(
+    max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+    ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS,
+    threshold=SEMANTIC_CACHE_THRESHOLD
+)
+# Pre-generated answers for tickets that clearly match one troubleshooting entry or guide
+canonical_answers = CanonicalAnswers()
+CallbackMetric(
+    "helpdesk_canonical_answer_lookups_total", "Canonical answer lookups by outcome (hit = LLM bypassed)",
+    lambda: [({"outcome": "hit"}, canonical_answers.hits), ({"outcome": "miss"}, canonical_answers.misses)],
+    kind="counter")
+# Per-route-class concurrency limits and priority queueing (interactive chat before batch/test traffic)
+admission = AdmissionController()
+# Multi-turn conversations (requests that carry a session_id)
+sessions = SessionStore()
+CallbackMetric(
+    "helpdesk_sessions", "Conversation sessions currently held in memory",
+    lambda: [({}, sessions.stats()["sessions"])])
+CallbackMetric(
+    "helpdesk_semantic_cache_events_total", "Semantic answer cache lookups and removals",
+    lambda: [({"event": event}, getattr(response_cache, event))
+             for event in ("hits", "misses", "evictions", "invalidations")],
+    kind="counter")
+# Document hashes and embedding model/backend of the index manifest the semantic cache was last checked against
+indexed_documents = {"mtime": None, "hashes": None, "space": None}
+indexed_documents_lock = threading.Lock()
+CallbackMetric(
+    "helpdesk_semantic_cache_entries", "Answers currently held in the semantic cache",
+    lambda: [({}, response_cache.stats()["entries"])])
 
 
 # Initialize FastAPI app
 app = FastAPI(title="TechCorp Help‑Desk API")
 
 
+# Admission control: guarded routes wait for a slot in priority order, or get 429 + Retry-After.
+# Added before record_timings so it runs inside it: shed requests are still timed and counted.
+app.add_middleware(AdmissionMiddleware, controller=admission, enabled=ADMISSION_ENABLED)
+
+
+# Time every request: latency histogram per route, plus an optional Server-Timing header
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    timings = start_request_timings()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        route = request.scope.get("route")
+        REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                route=route.path if route else "unmatched", status=status)
+    if timings and (TIMING_HEADER or request.headers.get("X-Debug-Timing") == "1"):
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    return response
+
+
+# Load and warm the shared encoder at process start, not on the first request
+@app.on_event("startup")
+async def warm_encoder():
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(retrieval_executor, warm_up)
+    # Only now is the backend known for sure (a missing ONNX export falls back to PyTorch)
+    check_embedding_space(indexed_embedding_space())
+
+
+# Release retrieval threads when the server stops
+@app.on_event("shutdown")
+def shutdown_executor():
+    retrieval_executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Run a blocking retrieval function on the retrieval executor, bounded by a timeout
+async def run_retrieval(func, *args, timeout: float = RETRIEVAL_TIMEOUT_SECONDS, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Run inside a copy of this context so stage timings reach the request's Server-Timing header
+    context = contextvars.copy_context()
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(retrieval_executor, context.run, partial(func, *args, **kwargs)),
+            timeout=timeout
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Knowledge retrieval timed out.")
+
+
+# Serve BM25 only while the collection was embedded by another model or encoder backend than the
+# one embedding queries: cosine scores across the two vector spaces are meaningless
+def check_embedding_space(space: tuple[str, str] | None) -> None:
+    current = (MODEL_NAME, active_backend())
+    if space is None or space == current:
+        set_dense_search_disabled(None)
+        return
+    reason = (f"the index was embedded with {space[0]} on the {space[1]!r} backend, "
+              f"but queries are embedded with {current[0]} on {current[1]!r}")
+    print(f"WARNING: {reason}. Dense search is disabled and every query falls back to BM25 "
+          f"until the corpus is re-indexed with this backend (python retriever.py).")
+    set_dense_search_disabled(reason)
+
+
+# Drop cached answers built from documents that were re-indexed or removed since the last
+# check, and rebuild the category router from the new chunks; costs one stat() of the
+# index manifest per request while the index is unchanged
+def sync_cache_with_index() -> None:
+    try:
+        mtime = MANIFEST_PATH.stat().st_mtime_ns
+    except OSError:
+        mtime = None
+    with indexed_documents_lock:
+        if mtime == indexed_documents["mtime"]:
+            return
+        manifest = load_manifest()
+        hashes = {doc_id: doc.get("hash") for doc_id, doc in manifest.get("documents", {}).items()}
+        # As recorded, even when load_manifest() discards it as stale for this backend
+        space = indexed_embedding_space()
+        previous, previous_space = indexed_documents["hashes"], indexed_documents["space"]
+        indexed_documents.update(mtime=mtime, hashes=hashes, space=space)
+        check_embedding_space(space)
+    if previous is not None:
+        reset_router()
+        # Re-embedded with another model or encoder backend: no cached retrieval still holds
+        if space != previous_space:
+            response_cache.invalidate()
+            return
+        changed = [doc_id for doc_id, doc_hash in previous.items() if hashes.get(doc_id) != doc_hash]
+        if changed:
+            response_cache.invalidate(changed)
+
+
+# Embed the question once, then search with that vector (runs on the retrieval executor).
+# Follow-up turns of a session reuse or extend the previous turn's chunks instead.
+# Returns (embedding, results, retrieval action, topic embedding searched with)
+def embed_and_query(question: str, top_k: int, session=None, **kwargs):
+    sync_cache_with_index()
+    embedding = embed_query(question)
+    action, topic = plan_retrieval(session, embedding, question)
+    if session is not None:
+        SESSION_RETRIEVALS.inc(action=action)
+    if action == "reuse":
+        return embedding, session.results, action, topic
+    if action == "extend":
+        # A smaller search for what the follow-up adds; the rest of the context carries over
+        hits = query_helpdesk(f"{session.last_question} {question}", top_k=max(1, (top_k + 1) // 2),
+                              query_embedding=topic.tolist(), **kwargs)
+        return embedding, merge_results(hits, session.results, top_k), action, topic
+    return embedding, query_helpdesk(question, top_k=top_k, query_embedding=embedding, **kwargs), action, topic
+
+
+# Embed every question in one encoder pass, then run the searches as multi-query calls
+def embed_and_query_batch(questions: list[str], top_k: int, **kwargs):
+    sync_cache_with_index()
+    with span("embedding"):
+        embeddings = embed_texts(questions).tolist()
+    return embeddings, query_helpdesk_batch(questions, top_k=top_k, query_embeddings=embeddings, **kwargs)
+
+
+# Generate an answer with the async LLM client, bounded by the concurrency limit and a timeout
+async def generate_async(question: str, context_chunks: list[str], history: list[dict] | None = None) -> str:
+    try:
+        async with llm_semaphore:
+            return await asyncio.wait_for(
+                agenerate_response(question, context_chunks, history=history),
+                timeout=GENERATION_TIMEOUT_SECONDS
+            )
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Response generation timed out.")
+
+
+# The LLM gateway already retries rate limits and transient API errors; batches also retry timeouts
+RETRYABLE_ERRORS = (asyncio.TimeoutError,)
+
+
+# Generate with retries and exponential backoff (with jitter) on generation timeouts
+async def generate_with_retry(question: str, context_chunks: list[str]) -> str:
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        try:
+            async with llm_semaphore:
+                return await asyncio.wait_for(
+                    agenerate_response(question, context_chunks, raise_errors=True),
+                    timeout=GENERATION_TIMEOUT_SECONDS
+                )
+        except RETRYABLE_ERRORS:
+            if attempt == BATCH_MAX_RETRIES:
+                raise
+            await asyncio.sleep(BATCH_RETRY_BASE_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+# Convert plain-text answers to simple HTML line/paragraph breaks
+def format_answer(answer_text: str, format_type: str = "text") -> str:
+    if format_type != "html":
+        return answer_text
+    # Replace double newlines with paragraph breaks
+    answer_out = re.sub(r'\n\n+', '<br><br>', answer_text)
+    # Replace single newlines with line breaks
+    return re.sub(r'(?<!<br>)\n', '<br>', answer_out)
+
+
+class HtmlStreamFormatter:
+    """
+    Incremental version of format_answer(..., "html") for streamed text.
+
+    A trailing run of newlines is held back until the next delta arrives,
+    because it may still grow into a paragraph break.
+    """
+
+    def __init__(self):
+        self._pending = ""
+
+    def feed(self, delta: str) -> str:
+        text = self._pending + delta
+        body = text.rstrip("\n")
+        self._pending = text[len(body):]
+        return format_answer(body, "html")
+
+    def flush(self) -> str:
+        out, self._pending = format_answer(self._pending, "html"), ""
+        return out
+
+
+# Format one server-sent event
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 # Request model for /chat endpoint
 class ChatRequest(BaseModel):
     question: str  # User's helpdesk question
-    top_k: int = 10  # Number of top results to retrieve (optional)
+    top_k: int = 5  # Number of top results to retrieve (optional)
+    mode: Literal["vector", "bm25", "hybrid"] = "hybrid"  # Retrieval mode (hybrid = BM25 + vector, RRF-fused)
+    session_id: str | None = None  # Continue a conversation: follow-ups see earlier turns and reuse retrieval
 
 
 # Response model for /chat endpoint
 class ChatResponse(BaseModel):
     answer: str  # LLM-generated answer
     sources: list[str]  # Source document IDs
+    context_tokens: int | None = None  # Prompt context tokens used (None when served from cache)
+    canonical: bool = False  # Served from the pre-generated canonical answers (no LLM call)
+    session_id: str | None = None
+    retrieval: str | None = None  # Session turns: "fresh", "extend" (searched and merged) or "reuse" (no search)
+
+
+# Request model for /chat/batch endpoint
+class BatchChatRequest(BaseModel):
+    questions: list[str]  # Queued tickets, answered in order
+    top_k: int = 5
+    mode: Literal["vector", "bm25", "hybrid"] = "hybrid"
+
+
+# One answer (or error) per question of a /chat/batch request
+class BatchChatItem(BaseModel):
+    index: int  # Position of the question in the request
+    answer: str | None = None
+    sources: list[str] = []
+    context_tokens: int | None = None
+    cached: bool = False
+    canonical: bool = False
+    error: str | None = None  # Set when this question failed; the rest of the batch is unaffected
+
+
+# Response model for /chat/batch endpoint
+class BatchChatResponse(BaseModel):
+    results: list[BatchChatItem]
+    errors: int
+    elapsed_ms: float
 
 
 # /chat endpoint: Handles help-desk queries
@@ -37,66 +337,265 @@ async def chat(req: ChatRequest, request: Request):
     if not req.question.strip():
         raise HTTPException(status_code=400, detail="Question cannot be empty.")
 
-    # Retrieve relevant knowledge chunks
-    results = query_helpdesk(req.question, top_k=req.top_k)
-    context_chunks = [doc for doc, _meta in results]
-    # Generate response using LLM
-    answer_text = generate_response(req.question, context_chunks)
+    # Embed the question and retrieve relevant knowledge chunks (off the event loop);
+    # follow-up turns of a session reuse or extend the previous turn's chunks
+    session = sessions.get(req.session_id) if req.session_id else None
+    embedding, results, action, topic = await run_retrieval(
+        embed_and_query, req.question, req.top_k, session, mode=req.mode)
+    metadatas = [meta for _doc, meta in results]
+
+    # Serve clear single-document matches from the canonical answers and near-duplicate
+    # questions from the semantic cache, else call the LLM. Follow-ups depend on the
+    # conversation so far and always go to the LLM.
+    context_tokens = None
+    canonical = canonical_answers.lookup(results) if session is None else None
+    answer_text = canonical[1] if canonical else None
+    if answer_text is None and session is None:
+        answer_text = response_cache.lookup(embedding, metadatas)
+    if answer_text is None:
+        # Deduplicate/merge chunks and fit them into the context token budget
+        with span("context_packing"):
+            context_chunks, context_tokens = pack_context(results, CONTEXT_TOKEN_BUDGET)
+        CONTEXT_TOKENS.observe(context_tokens)
+        answer_text = await generate_async(req.question, context_chunks,
+                                           session.history_messages() if session else None)
+        if answer_text != FALLBACK_RESPONSE and session is None:
+            response_cache.store(req.question, embedding, metadatas, answer_text)
+    if req.session_id and answer_text != FALLBACK_RESPONSE:
+        sessions.record_turn(req.session_id, req.question, answer_text, embedding, results, topic)
 
     # Get format query param (default to 'text')
     format_type = request.query_params.get('format', 'text')
-    if format_type == 'html':
-      
-        # Replace double newlines with paragraph breaks
-        answer_out = re.sub(r'\n\n+', '<br><br>', answer_text)
-        # Replace single newlines with line breaks
-        answer_out = re.sub(r'(?<!<br>)\n', '<br>', answer_out)
-    else:
-        answer_out = answer_text
+    with span("html_formatting"):
+        answer_out = format_answer(answer_text, format_type)
 
     # Collect source document IDs for transparency
     source_ids = [meta["parent_id"] for _doc, meta in results]
-    return ChatResponse(answer=answer_out, sources=source_ids)
+    return ChatResponse(answer=answer_out, sources=source_ids, context_tokens=context_tokens,
+                        canonical=canonical is not None, session_id=req.session_id,
+                        retrieval=action if req.session_id else None)
+
+
+
+# /chat/batch endpoint: answers many queued tickets in one request
+# Questions are embedded together and searched with multi-query vector searches; LLM calls
+# run with bounded concurrency and retry with backoff on timeouts. Results keep request order.
+@app.post("/chat/batch", response_model=BatchChatResponse)
+async def chat_batch(req: BatchChatRequest, request: Request):
+    if not req.questions:
+        raise HTTPException(status_code=400, detail="questions cannot be empty.")
+    if len(req.questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_QUESTIONS} questions per batch.")
+    started = time.perf_counter()
+    items = [BatchChatItem(index=i) for i in range(len(req.questions))]
+    valid = [i for i, q in enumerate(req.questions) if q.strip()]
+    for i in set(range(len(req.questions))) - set(valid):
+        items[i].error = "Question cannot be empty."
+
+    embeddings, results = [], []
+    if valid:
+        try:
+            embeddings, results = await run_retrieval(
+                embed_and_query_batch, [req.questions[i] for i in valid], req.top_k,
+                mode=req.mode, raise_errors=True, timeout=BATCH_RETRIEVAL_TIMEOUT_SECONDS)
+        except HTTPException:
+            raise
+        except Exception as e:
+            # Never answer from empty context: every question of the failed search gets the error
+            detail = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+            for i in valid:
+                items[i].error = f"Knowledge retrieval failed: {detail}"
+    format_type = request.query_params.get('format', 'text')
+    batch_semaphore = asyncio.Semaphore(BATCH_LLM_CONCURRENCY)
+
+    async def answer(item: BatchChatItem, question: str, embedding: list[float], hits: list):
+        metadatas = [meta for _doc, meta in hits]
+        item.sources = [meta["parent_id"] for meta in metadatas]
+        try:
+            canonical = canonical_answers.lookup(hits)
+            item.canonical = canonical is not None
+            answer_text = canonical[1] if canonical else response_cache.lookup(embedding, metadatas)
+            item.cached = answer_text is not None and not item.canonical
+            if answer_text is None:
+                with span("context_packing"):
+                    context_chunks, item.context_tokens = pack_context(hits, CONTEXT_TOKEN_BUDGET)
+                CONTEXT_TOKENS.observe(item.context_tokens)
+                async with batch_semaphore:
+                    answer_text = await generate_with_retry(question, context_chunks)
+                response_cache.store(question, embedding, metadatas, answer_text)
+            item.answer = format_answer(answer_text, format_type)
+        except Exception as e:
+            item.error = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+
+    await asyncio.gather(*(
+        answer(items[i], req.questions[i], embedding, hits)
+        for i, embedding, hits in zip(valid, embeddings, results)
+    ))
+    return BatchChatResponse(
+        results=items,
+        errors=sum(item.error is not None for item in items),
+        elapsed_ms=round(1000 * (time.perf_counter() - started), 1),
+    )
+
+
+# /chat/stream endpoint: same pipeline as /chat, but answer tokens are sent as server-sent events
+# Events: "sources" (first), "token" (answer deltas), "done" (timings) or "error"
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest, request: Request):
+    if not req.question.strip():
+        raise HTTPException(status_code=400, detail="Question cannot be empty.")
+
+    started = time.perf_counter()
+    session = sessions.get(req.session_id) if req.session_id else None
+    embedding, results, action, topic = await run_retrieval(
+        embed_and_query, req.question, req.top_k, session, mode=req.mode)
+    metadatas = [meta for _doc, meta in results]
+    html = request.query_params.get('format', 'text') == 'html'
+
+    async def event_stream():
+        yield sse_event("sources", {"sources": [meta["parent_id"] for meta in metadatas]})
+        formatter = HtmlStreamFormatter() if html else None
+        canonical = canonical_answers.lookup(results) if session is None else None
+        cached = canonical[1] if canonical else None
+        if cached is None and session is None:
+            cached = response_cache.lookup(embedding, metadatas)
+        if cached is not None:
+            if req.session_id:
+                sessions.record_turn(req.session_id, req.question, cached, embedding, results, topic)
+            yield sse_event("token", {"text": format_answer(cached, "html" if html else "text")})
+            yield sse_event("done", {"cached": canonical is None, "canonical": canonical is not None,
+                                     "context_tokens": None,
+                                     "retrieval_ms": round(1000 * (time.perf_counter() - started), 1)})
+            return
+
+        with span("context_packing"):
+            context_chunks, context_tokens = pack_context(results, CONTEXT_TOKEN_BUDGET)
+        CONTEXT_TOKENS.observe(context_tokens)
+        gen_started = time.perf_counter()
+        deadline = gen_started + GENERATION_TIMEOUT_SECONDS
+        first_token_at = None
+        parts = []
+        async with llm_semaphore:
+            deltas = astream_response(req.question, context_chunks,
+                                      history=session.history_messages() if session else None)
+            while True:
+                try:
+                    delta = await asyncio.wait_for(deltas.__anext__(), timeout=max(deadline - time.perf_counter(), 0))
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    await deltas.aclose()
+                    yield sse_event("error", {"detail": "Response generation timed out."})
+                    return
+                except Exception:
+                    # Stream broke after part of the answer was sent: never cache or record the fragment
+                    yield sse_event("error", {"detail": "Response generation failed."})
+                    return
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    TIME_TO_FIRST_TOKEN_SECONDS.observe(first_token_at - gen_started)
+                parts.append(delta)
+                text = formatter.feed(delta) if formatter else delta
+                if text:
+                    yield sse_event("token", {"text": text})
+        if formatter:
+            tail = formatter.flush()
+            if tail:
+                yield sse_event("token", {"text": tail})
+
+        finished = time.perf_counter()
+        answer_text = "".join(parts)
+        if answer_text and answer_text != FALLBACK_RESPONSE:
+            if session is None:
+                response_cache.store(req.question, embedding, metadatas, answer_text)
+            if req.session_id:
+                sessions.record_turn(req.session_id, req.question, answer_text, embedding, results, topic)
+        ttft = (first_token_at or finished) - gen_started
+        stream_timings.append((ttft, finished - gen_started))
+        yield sse_event("done", {
+            "cached": False,
+            "canonical": False,
+            "context_tokens": context_tokens,
+            "retrieval_ms": round(1000 * (gen_started - started), 1),
+            "time_to_first_token_ms": round(1000 * ttft, 1),
+            "generation_ms": round(1000 * (finished - gen_started), 1),
+        })
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# /chat/stream/stats endpoint: time-to-first-token and generation time over recent streams
+@app.get("/chat/stream/stats")
+def chat_stream_stats():
+    def pct(values, q):
+        return round(1000 * values[min(len(values) - 1, int(q * len(values)))], 1) if values else None
+    ttfts = sorted(t for t, _total in stream_timings)
+    totals = sorted(total for _t, total in stream_timings)
+    return {
+        "streams": len(stream_timings),
+        "time_to_first_token_ms": {"p50": pct(ttfts, 0.5), "p95": pct(ttfts, 0.95)},
+        "generation_ms": {"p50": pct(totals, 0.5), "p95": pct(totals, 0.95)},
+    }
+
+
+# /cache/stats endpoint: semantic cache hit/miss counters
+@app.get("/cache/stats")
+def cache_stats():
+    return response_cache.stats()
+
+
+# /canonical/stats endpoint: canonical answer entries and LLM bypass rate
+@app.get("/canonical/stats")
+def canonical_stats():
+    return canonical_answers.stats()
+
+
+# /admission/stats endpoint: slots in use, queued and shed requests per route class
+@app.get("/admission/stats")
+def admission_stats():
+    return admission.stats()
+
+
+# /sessions/stats endpoint: live sessions and how follow-up turns were retrieved
+@app.get("/sessions/stats")
+def session_stats():
+    return sessions.stats()
+
+
+# /sessions/{session_id} endpoint: end a conversation
+@app.delete("/sessions/{session_id}")
+def end_session(session_id: str):
+    if not sessions.end(session_id):
+        raise HTTPException(status_code=404, detail="Unknown or expired session.")
+    return {"ended": session_id}
+
+
+# /encoder/stats endpoint: query-vector cache and micro-batching metrics, and why dense search is off (if it is)
+@app.get("/encoder/stats")
+def encoder_statistics():
+    return {**encoder_stats(), "dense_search_disabled": dense_search_disabled()}
+
 
+# /metrics endpoint: Prometheus text exposition of latency histograms, token counts, cache and error counters
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
 
 
-# /run_tests endpoint: Runs all test scenarios from test_requests.json
-# Returns results for each scenario (question, expected, answer)
+# /run_tests endpoint: Runs all test scenarios from test_requests.json concurrently
+# Returns per-scenario answers and scores plus accuracy and per-stage latency percentiles
+# Query params: parallelism (default 4), llm ("openai" or offline "stub")
 @app.get("/run_tests")
-def run_test_scenarios():
-    import json
-    from pathlib import Path
-    import os
-    base_dir = Path(__file__).parent
-    test_file = base_dir / "test_requests.json"
+async def run_test_scenarios(parallelism: int = 4, llm: Literal["openai", "stub"] = "openai"):
+    test_file = Path(__file__).parent / "test_requests.json"
     if not test_file.exists():
         raise HTTPException(status_code=404, detail="test_requests.json not found")
-        # return {"error": "test_requests.json not found"}
     try:
-        data = json.loads(test_file.read_text(encoding="utf-8"))
-        test_requests = data.get("test_requests", [])
-        results = []
-        for req in test_requests:
-            question = req["request"]
-            expected = req.get("expected_classification")
-            elements = req.get("expected_elements")
-            escalate = req.get("escalate")
-            api_req = ChatRequest(question=question, top_k=5)
-            # Use same logic as /chat endpoint
-            try:
-                chunks = [doc for doc, _meta in query_helpdesk(api_req.question, top_k=api_req.top_k)]
-                answer = generate_response(api_req.question, chunks)
-            # Only include the question and relevant expected/answer fields
-            except Exception as e:
-                    answer = f"Error generating answer: {e}"
-            results.append({
-                "question": question, 
-                "answer": answer
-            })
-        return {"test_results": results}
+        scenarios = load_scenarios(test_file)
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid JSON format in test_requests.json")
-            # return {"error": "Invalid JSON format in test_requests.json"}
+    return await run_evaluation(scenarios, parallelism=parallelism, llm=llm, executor=retrieval_executor)
 
 
 
@@ -0,0 +1,249 @@
+# Admission control for the API: per-route-class concurrency limits, a bounded priority
+# queue and load shedding
+#
+# Every request to a guarded route needs a slot. The slot must be free both in its route
+# class (interactive chat, batch, test runs) and in the worker-wide limit. Requests that
+# find no slot wait in one bounded queue, ordered by class priority and then arrival, so
+# interactive chat is always admitted before batch or test traffic. A request that cannot
+# be admitted within its class's queue deadline, or finds the queue full, is shed with
+# 429 and Retry-After. Admitted requests then run at a bounded concurrency and keep a
+# stable latency instead of all timing out together.
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from typing import NamedTuple
+
+from starlette.responses import JSONResponse
+
+from metrics import Counter, Gauge, Histogram
+
+# Set ADMISSION_ENABLED=0 to admit every request immediately
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+# Requests running at once in this worker, across all guarded routes
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "64"))
+# Requests allowed to wait for a slot; beyond this the lowest-priority request is shed
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "256"))
+# Longest an interactive request waits for a slot before it is shed
+ADMISSION_CHAT_QUEUE_SECONDS = float(os.getenv("ADMISSION_CHAT_QUEUE_SECONDS", "2"))
+# Longest a batch or test request waits for a slot
+ADMISSION_BACKGROUND_QUEUE_SECONDS = float(os.getenv("ADMISSION_BACKGROUND_QUEUE_SECONDS", "30"))
+# Upper bound of the Retry-After hint on shed responses
+MAX_RETRY_AFTER_SECONDS = 60
+
+
+class RouteClass(NamedTuple):
+    priority: int           # lower is admitted first
+    max_concurrent: int
+    queue_seconds: float
+
+
+ROUTE_CLASSES = {
+    "interactive": RouteClass(0, int(os.getenv("ADMISSION_CHAT_CONCURRENCY", "64")), ADMISSION_CHAT_QUEUE_SECONDS),
+    "batch": RouteClass(1, int(os.getenv("ADMISSION_BATCH_CONCURRENCY", "4")), ADMISSION_BACKGROUND_QUEUE_SECONDS),
+    "test": RouteClass(2, int(os.getenv("ADMISSION_TEST_CONCURRENCY", "1")), ADMISSION_BACKGROUND_QUEUE_SECONDS),
+}
+# Guarded paths; anything else (stats, /metrics, /docs) is never queued or shed
+ROUTE_PATHS = {
+    "/chat": "interactive",
+    "/chat/stream": "interactive",
+    "/chat/batch": "batch",
+    "/run_tests": "test",
+}
+
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "helpdesk_admission_queue_depth", "Requests waiting for an admission slot", ["route_class"])
+ADMISSION_IN_FLIGHT = Gauge(
+    "helpdesk_admission_in_flight", "Admitted requests currently running", ["route_class"])
+ADMISSION_SHED = Counter(
+    "helpdesk_admission_shed_total", "Requests rejected with 429 by admission control", ["route_class", "reason"])
+ADMISSION_QUEUE_WAIT_SECONDS = Histogram(
+    "helpdesk_admission_queue_wait_seconds", "Time admitted requests waited for a slot", ["route_class"])
+
+
+class Rejected(Exception):
+    """Raised when a request is shed; `retry_after` is the suggested wait in seconds."""
+
+    def __init__(self, route_class: str, reason: str, retry_after: int):
+        super().__init__(f"{route_class} request shed ({reason})")
+        self.route_class = route_class
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Slot accounting and priority queue for one worker's event loop.
+
+    acquire() returns once the request holds a slot, or raises Rejected; every successful
+    acquire() must be paired with release().
+    """
+
+    def __init__(self, classes: dict = ROUTE_CLASSES, max_concurrent: int = ADMISSION_MAX_CONCURRENT,
+                 queue_size: int = ADMISSION_QUEUE_SIZE):
+        self.classes = classes
+        self.max_concurrent = max_concurrent
+        self.queue_size = queue_size
+        self.in_flight = {name: 0 for name in classes}
+        self._queue = []                        # heap of [priority, seq, route_class, future]
+        self._seq = itertools.count()
+        self._service_seconds = {name: 1.0 for name in classes}   # moving average per class
+        self.admitted = 0
+        self.shed = 0
+
+    def _has_slot(self, route_class: str) -> bool:
+        return (sum(self.in_flight.values()) < self.max_concurrent
+                and self.in_flight[route_class] < self.classes[route_class].max_concurrent)
+
+    def _take_slot(self, route_class: str) -> None:
+        self.in_flight[route_class] += 1
+        self.admitted += 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight[route_class], route_class=route_class)
+
+    def _waiting(self, route_class: str) -> int:
+        return sum(1 for entry in self._queue if entry[2] == route_class and not entry[3].done())
+
+    def _update_depth(self, route_class: str) -> None:
+        ADMISSION_QUEUE_DEPTH.set(self._waiting(route_class), route_class=route_class)
+
+    # Suggested wait before retrying: the time for the queue ahead of a class to drain, roughly
+    def retry_after(self, route_class: str) -> int:
+        spec = self.classes[route_class]
+        ahead = sum(1 for entry in self._queue if entry[0] <= spec.priority and not entry[3].done())
+        seconds = self._service_seconds[route_class] * (ahead + 1) / max(1, spec.max_concurrent)
+        return int(min(MAX_RETRY_AFTER_SECONDS, max(1, math.ceil(seconds))))
+
+    def _reject(self, route_class: str, reason: str) -> Rejected:
+        self.shed += 1
+        ADMISSION_SHED.inc(route_class=route_class, reason=reason)
+        return Rejected(route_class, reason, self.retry_after(route_class))
+
+    # Make room in a full queue by shedding its lowest-priority, most recent waiter
+    def _evict_for(self, priority: int) -> bool:
+        waiting = [entry for entry in self._queue if not entry[3].done()]
+        if not waiting:
+            return False
+        victim = max(waiting, key=lambda entry: (entry[0], entry[1]))
+        if victim[0] <= priority:
+            return False
+        victim[3].set_exception(self._reject(victim[2], "preempted"))
+        self._queue.remove(victim)
+        heapq.heapify(self._queue)
+        self._update_depth(victim[2])
+        return True
+
+    async def acquire(self, route_class: str) -> float:
+        """
+        Wait for a slot in `route_class`.
+        Returns:
+            float: Seconds spent queued.
+        Raises:
+            Rejected: The queue was full or the class's queue deadline passed.
+        """
+        spec = self.classes[route_class]
+        # Nobody of equal or higher priority is waiting: skip the queue
+        if self._has_slot(route_class) and not any(
+                entry[0] <= spec.priority and not entry[3].done() for entry in self._queue):
+            self._take_slot(route_class)
+            ADMISSION_QUEUE_WAIT_SECONDS.observe(0.0, route_class=route_class)
+            return 0.0
+        live = sum(1 for entry in self._queue if not entry[3].done())
+        if live >= self.queue_size and not self._evict_for(spec.priority):
+            raise self._reject(route_class, "queue_full")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [spec.priority, next(self._seq), route_class, future]
+        heapq.heappush(self._queue, entry)
+        self._update_depth(route_class)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout=spec.queue_seconds)
+        except asyncio.TimeoutError:
+            raise self._reject(route_class, "queue_timeout")
+        except asyncio.CancelledError:
+            # Client went away; give the slot back if it was granted at the same moment
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release(route_class)
+            raise
+        finally:
+            if entry in self._queue:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+            self._update_depth(route_class)
+        waited = time.monotonic() - started
+        ADMISSION_QUEUE_WAIT_SECONDS.observe(waited, route_class=route_class)
+        return waited
+
+    def release(self, route_class: str, service_seconds: float | None = None) -> None:
+        """Free a slot and admit the highest-priority waiters that now fit."""
+        self.in_flight[route_class] -= 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight[route_class], route_class=route_class)
+        if service_seconds is not None:
+            average = self._service_seconds[route_class]
+            self._service_seconds[route_class] = 0.8 * average + 0.2 * service_seconds
+        self._dispatch()
+
+    # Grant free slots in priority order; a class at its own limit does not block lower classes
+    def _dispatch(self) -> None:
+        for entry in sorted(self._queue):
+            if sum(self.in_flight.values()) >= self.max_concurrent:
+                break
+            priority, _seq, route_class, future = entry
+            if future.done() or not self._has_slot(route_class):
+                continue
+            self._take_slot(route_class)
+            future.set_result(True)
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "queue_size": self.queue_size,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "classes": {
+                name: {
+                    "priority": spec.priority,
+                    "max_concurrent": spec.max_concurrent,
+                    "queue_seconds": spec.queue_seconds,
+                    "in_flight": self.in_flight[name],
+                    "queued": self._waiting(name),
+                }
+                for name, spec in self.classes.items()
+            },
+        }
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying an AdmissionController to the guarded paths.
+
+    The slot is held until the response has been sent in full (streamed answers included)
+    and is released even when the client disconnects mid-response.
+    """
+
+    def __init__(self, app, controller: AdmissionController, paths: dict = ROUTE_PATHS,
+                 enabled: bool = ADMISSION_ENABLED):
+        self.app = app
+        self.controller = controller
+        self.paths = paths
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        route_class = self.paths.get(scope.get("path")) if scope["type"] == "http" else None
+        if not self.enabled or route_class is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.controller.acquire(route_class)
+        except Rejected as e:
+            response = JSONResponse(status_code=429, headers={"Retry-After": str(e.retry_after)},
+                                    content={"detail": "Server busy, please retry later.", "reason": e.reason})
+            await response(scope, receive, send)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(route_class, time.perf_counter() - started)
@@ -0,0 +1,85 @@
+# Benchmark: legacy per-sentence chunker vs. the single-pass, batched chunker in retriever.py
+#
+#   python benchmarks/bench_chunker.py --scale 200 --output chunker.json
+#
+# The bundled knowledge/ documents are scaled up synthetically (each body is
+# repeated with numbered variants) so the timings reflect a realistic corpus.
+import argparse
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import retriever  # noqa: E402
+from tokenizer import n_tokens  # noqa: E402
+
+
+# The original chunk_body: one full encode per sentence, then re-join the strings
+def legacy_chunk_body(body: str, max_tokens: int = retriever.CHUNK_TOKENS) -> list[str]:
+    sentences = re.split(r'(?<=[.!?])\s+', body)
+    chunks = []
+    current_sentences = []
+    current_sentences_tokens = 0
+    for s in sentences:
+        t = n_tokens(s)
+        if current_sentences_tokens + t > max_tokens and current_sentences:
+            chunks.append(" ".join(current_sentences))
+            current_sentences, current_sentences_tokens = [], 0
+        current_sentences.append(s)
+        current_sentences_tokens += t
+    if current_sentences:
+        chunks.append(" ".join(current_sentences))
+    return chunks or [""]
+
+
+# Expand the bundled corpus `scale` times with small textual variations
+def synthetic_bodies(knowledge_dir: Path, scale: int) -> list[str]:
+    bodies = [doc["body"] for doc in retriever.load_corpus(knowledge_dir)]
+    return [f"{body}\n\nRevision {i}: see ticket HD-{i:05d}." for i in range(scale) for body in bodies]
+
+
+def timed(label: str, fn, bodies: list[str]) -> dict:
+    started = time.perf_counter()
+    chunk_count = fn(bodies)
+    seconds = time.perf_counter() - started
+    return {
+        "implementation": label,
+        "documents": len(bodies),
+        "chunks": chunk_count,
+        "seconds": round(seconds, 4),
+        "chunks_per_second": round(chunk_count / seconds, 1) if seconds else None,
+        "docs_per_second": round(len(bodies) / seconds, 1) if seconds else None,
+    }
+
+
+def run(knowledge_dir: Path, scale: int, overlap: int) -> dict:
+    bodies = synthetic_bodies(knowledge_dir, scale)
+    n_tokens("warm-up")  # load the BPE tables outside the timed sections
+    results = [
+        timed("legacy (per-sentence encode)", lambda b: sum(len(legacy_chunk_body(x)) for x in b), bodies),
+        timed("single-pass (per document)", lambda b: sum(len(retriever.chunk_body(x, overlap=overlap)) for x in b), bodies),
+        timed("single-pass (batched encode)", lambda b: sum(len(c) for c in retriever.chunk_bodies(b, overlap=overlap)), bodies),
+    ]
+    baseline = results[0]["seconds"]
+    for r in results:
+        r["speedup_vs_legacy"] = round(baseline / r["seconds"], 2) if r["seconds"] else None
+    return {"scale": scale, "overlap": overlap, "max_tokens": retriever.CHUNK_TOKENS, "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare chunker throughput on a synthetically scaled corpus.")
+    parser.add_argument("--knowledge-dir", default=str(retriever.KNOWLEDGE_DIR))
+    parser.add_argument("--scale", type=int, default=200, help="copies of each bundled document")
+    parser.add_argument("--overlap", type=int, default=0, help="token overlap for the new chunker")
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    report = run(Path(args.knowledge_dir), args.scale, args.overlap)
+    for r in report["results"]:
+        print(f"{r['implementation']:<32} {r['chunks']:>7} chunks  {r['seconds']:>8.3f}s  "
+              f"{r['chunks_per_second']:>10} chunks/s  x{r['speedup_vs_legacy']}")
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
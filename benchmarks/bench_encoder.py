@@ -0,0 +1,117 @@
+# Benchmark: embedding backends (PyTorch fp32, ONNX fp32, ONNX int8) on CPU
+#
+#   python onnx_encoder.py export
+#   python benchmarks/bench_encoder.py --backends torch onnx-fp32 onnx --threads 1 2 4 --output encoder.json
+#
+# Each backend/thread-count pair runs in its own process, through encoder.get_model() exactly
+# as the API and the indexer load it, so peak RSS is that of a worker using that backend alone.
+# Reports model load time, single-query latency (the /chat path), batch-64 throughput (the
+# indexing path) and RSS. Texts are paragraphs of the bundled knowledge base; questions
+# come from test_requests.json.
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+# Current resident set size of this process, in MiB (Linux)
+def rss_mb() -> float | None:
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def load_texts(limit: int) -> tuple[list[str], list[str]]:
+    import retriever
+    from evaluation import load_scenarios
+    paragraphs = [p.strip() for doc in retriever.get_docs() for p in doc["body"].split("\n\n") if len(p.split()) >= 8]
+    passages = [" ".join(p.split()[:200]) for p in paragraphs]
+    passages = (passages * (limit // max(1, len(passages)) + 1))[:limit]
+    return passages, [s["request"] for s in load_scenarios()]
+
+
+# Runs in the child process: one backend, one thread count
+def measure(queries: int, passages: int, batch_size: int) -> dict:
+    from encoder import embed_texts, get_model, active_backend
+    texts, questions = load_texts(passages)
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    get_model()
+    load_seconds = time.perf_counter() - started
+    embed_texts(questions[:4])   # warm-up
+
+    latencies = []
+    for i in range(queries):
+        started = time.perf_counter()
+        embed_texts([questions[i % len(questions)]], batch_size=1)
+        latencies.append(1000 * (time.perf_counter() - started))
+    latencies.sort()
+
+    started = time.perf_counter()
+    embed_texts(texts, batch_size=batch_size)
+    batch_seconds = time.perf_counter() - started
+    return {
+        "backend": active_backend(),
+        "load_seconds": round(load_seconds, 2),
+        "query_latency_ms": {"p50": round(latencies[len(latencies) // 2], 2),
+                             "p99": round(latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))], 2)},
+        "passages_per_second": round(len(texts) / batch_seconds, 1),
+        "rss_before_load_mb": rss_before,
+        "rss_mb": rss_mb(),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_child(backend: str, threads: int, args) -> dict:
+    env = {**os.environ, "ENCODER_BACKEND": backend, "ENCODER_THREADS": str(threads)}
+    result = subprocess.run(
+        [sys.executable, __file__, "--child", "--queries", str(args.queries), "--passages", str(args.passages),
+         "--batch-size", str(args.batch_size)],
+        env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {"backend": backend, "threads": threads, "error": result.stderr.strip().splitlines()[-1:]}
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    if report["backend"] != backend:
+        report["error"] = f"requested {backend} but {report['backend']} was loaded (run onnx_encoder.py export)"
+    return {**report, "threads": threads}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the embedding backends on CPU.")
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx-fp32", "onnx"],
+                        choices=["torch", "onnx-fp32", "onnx"])
+    parser.add_argument("--threads", nargs="+", type=int, default=[os.cpu_count() or 1],
+                        help="intra-op thread counts to try")
+    parser.add_argument("--queries", type=int, default=200, help="single-question embeddings timed")
+    parser.add_argument("--passages", type=int, default=2000, help="passages embedded for throughput")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.queries, args.passages, args.batch_size)))
+        sys.exit(0)
+
+    results = [run_child(backend, threads, args) for backend in args.backends for threads in args.threads]
+    for r in results:
+        if "error" in r:
+            print(f"{r['backend']:<10} threads {r['threads']:<3} ERROR {r['error']}")
+            continue
+        print(f"{r['backend']:<10} threads {r['threads']:<3} query p50 {r['query_latency_ms']['p50']:>7.2f} ms  "
+              f"p99 {r['query_latency_ms']['p99']:>7.2f} ms  {r['passages_per_second']:>8.1f} passages/s  "
+              f"RSS {r['rss_mb']} MiB (peak {r['max_rss_mb']})")
+    if args.output:
+        Path(args.output).write_text(json.dumps({"cpu_count": os.cpu_count(), "results": results}, indent=2),
+                                     encoding="utf-8")
@@ -0,0 +1,262 @@
+# Offline performance baseline: indexing, retrieval and end-to-end /chat on a synthetic corpus
+#
+#   python benchmarks/bench_pipeline.py --scales 1 10 50 --top-k 1 5 10 --output baseline.json
+#
+# The bundled knowledge/ documents are expanded `scale` times into a throw-away
+# vector store (HELPDESK_DB_DIR points at a temporary directory), so the real
+# chroma_store is never touched. Questions come from test_requests.json and
+# sample_conversations.json, and /chat answers are produced by the offline
+# StubLLM from evaluation.py, so no API key or network access is needed.
+# Results are written as JSON so runs can be compared over time.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+SAMPLE_CONVERSATIONS_PATH = ROOT / "sample_conversations.json"
+
+
+# Benchmark questions: test_requests.json plus sample_conversations.json in the same scenario shape
+def load_questions() -> list[dict]:
+    from evaluation import load_scenarios
+    scenarios = load_scenarios()
+    conversations = json.loads(SAMPLE_CONVERSATIONS_PATH.read_text(encoding="utf-8"))
+    for conv in conversations.get("test_conversations", []):
+        scenarios.append({
+            "id": conv["id"],
+            "request": conv["user_message"],
+            "expected_classification": conv.get("expected_category"),
+            "expected_elements": conv.get("expected_response_elements", []),
+            "escalate": conv.get("escalation_required"),
+        })
+    return scenarios
+
+
+# Expand the bundled corpus `scale` times; copy 0 keeps the original ids
+def synthetic_corpus(docs: list[dict], scale: int) -> list[dict]:
+    corpus = []
+    for i in range(scale):
+        for doc in docs:
+            if i == 0:
+                corpus.append(doc)
+                continue
+            corpus.append({
+                **doc,
+                "id": f"{doc['id']}__s{i}",
+                "body": f"{doc['body']}\n\nRevision {i}: see ticket HD-{i:05d}.",
+            })
+    return corpus
+
+
+# Original document id of a (possibly synthetic) parent id
+def base_id(parent_id: str) -> str:
+    return parent_id.split("__s", 1)[0]
+
+
+# Documents relevant to a ticket category: those whose id names it (e.g. password_reset_troubleshoot_v1)
+def relevant_ids(category: str | None, doc_ids: list[str]) -> set:
+    if not category:
+        return set()
+    return {doc_id for doc_id in doc_ids if doc_id.startswith(f"{category}_")}
+
+
+def timed_ms(fn) -> tuple:
+    started = time.perf_counter()
+    result = fn()
+    return result, 1000 * (time.perf_counter() - started)
+
+
+def bench_indexing(retriever, corpus: list[dict]) -> dict:
+    chunks = sum(len(records) for records in retriever.chunk_documents(corpus))
+    started = time.perf_counter()
+    _model, _collection, report = retriever.build_vector(full=True, docs=corpus)
+    seconds = time.perf_counter() - started
+    if report is None:
+        raise RuntimeError("build_vector failed; see the error printed above")
+    return {
+        "documents": len(corpus),
+        "chunks": chunks,
+        "seconds": round(seconds, 3),
+        "chunks_per_second": round(chunks / seconds, 1) if seconds else None,
+        "report": report,
+    }
+
+
+def bench_retrieval(scenarios: list[dict], doc_ids: list[str], top_k: int, mode: str, threads: int) -> dict:
+    import encoder
+    from evaluation import percentiles
+    from query import query_helpdesk
+
+    questions = [s["request"] for s in scenarios]
+    # Cold pass: query vectors are not cached yet, so latency includes embedding
+    encoder._embed_query_cached.cache_clear()
+    latencies, hits, judged = [], 0, 0
+    for scenario in scenarios:
+        results, ms = timed_ms(lambda: query_helpdesk(scenario["request"], top_k=top_k, mode=mode))
+        latencies.append(ms)
+        relevant = relevant_ids(scenario.get("expected_classification"), doc_ids)
+        if relevant:
+            judged += 1
+            hits += any(base_id(meta.get("parent_id", "")) in relevant for _doc, meta in results)
+
+    # Throughput: the same questions replayed from several threads (query vectors now cached)
+    rounds = max(1, 200 // len(questions))
+    workload = questions * rounds
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda q: query_helpdesk(q, top_k=top_k, mode=mode), workload))
+    seconds = time.perf_counter() - started
+
+    return {
+        "top_k": top_k,
+        "mode": mode,
+        "queries": len(questions),
+        "latency_ms": {k: round(v, 2) for k, v in percentiles(latencies).items()},
+        "mean_latency_ms": round(sum(latencies) / len(latencies), 2),
+        # Fraction of judged questions with at least one document of the expected category in the top k
+        "recall_at_k": round(hits / judged, 3) if judged else None,
+        "judged_queries": judged,
+        "threads": threads,
+        "qps": round(len(workload) / seconds, 1) if seconds else None,
+    }
+
+
+async def bench_chat(scenarios: list[dict], requests: int, concurrency: int, top_k: int, mode: str,
+                     url: str | None, stub_latency_ms: float) -> dict:
+    import httpx
+    from evaluation import StubLLM, percentiles
+
+    if url:
+        client = httpx.AsyncClient(base_url=url, timeout=120)
+    else:
+        # In-process server; answers come from the stub so only our own code is measured
+        import Api_server
+        Api_server.agenerate_response = StubLLM(latency_ms=stub_latency_ms).agenerate
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=Api_server.app),
+                                   base_url="http://bench", timeout=120)
+
+    questions = [s["request"] for s in scenarios]
+    latencies, statuses = [], {}
+    next_request = iter(range(requests))
+
+    async def worker():
+        for i in next_request:
+            payload = {"question": questions[i % len(questions)], "top_k": top_k, "mode": mode}
+            started = time.perf_counter()
+            try:
+                response = await client.post("/chat", json=payload)
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(1000 * (time.perf_counter() - started))
+            statuses[status] = statuses.get(status, 0) + 1
+
+    async with client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        seconds = time.perf_counter() - started
+
+    return {
+        "target": url or "in-process (stub LLM)",
+        "requests": requests,
+        "concurrency": concurrency,
+        "stub_latency_ms": None if url else stub_latency_ms,
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(requests / seconds, 1) if seconds else None,
+        "latency_ms": {k: round(v, 2) for k, v in percentiles(latencies).items()},
+        "status_counts": statuses,
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(args) -> dict:
+    import retriever
+    from encoder import MODEL_NAME, warm_up, active_backend
+    from evaluation import run_evaluation
+
+    warm_up()
+    scenarios = load_questions()
+    docs = retriever.load_corpus(args.knowledge_dir)
+    doc_ids = [doc["id"] for doc in docs]
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "embedding_model": MODEL_NAME,
+            "encoder_backend": active_backend(),
+            "args": vars(args),
+        },
+        "indexing": [],
+        "retrieval": [],
+    }
+
+    # The largest scale is indexed last and stays in place for the /chat and evaluation runs
+    for scale in sorted(args.scales):
+        corpus = synthetic_corpus(docs, scale)
+        indexing = {"scale": scale, **bench_indexing(retriever, corpus)}
+        report["indexing"].append(indexing)
+        print(f"scale {scale:>4}: indexed {indexing['chunks']} chunks in {indexing['seconds']}s "
+              f"({indexing['chunks_per_second']} chunks/s)")
+        for top_k in args.top_k:
+            retrieval = {"scale": scale, "chunks": indexing["chunks"],
+                         **bench_retrieval(scenarios, doc_ids, top_k, args.mode, args.threads)}
+            report["retrieval"].append(retrieval)
+            print(f"  top_k {top_k:>3}: p50 {retrieval['latency_ms']['p50']} ms, p99 {retrieval['latency_ms']['p99']} ms, "
+                  f"{retrieval['qps']} qps, recall@k {retrieval['recall_at_k']}")
+
+    report["evaluation"] = asyncio.run(run_evaluation(
+        scenarios, parallelism=args.concurrency, llm="stub", top_k=args.chat_top_k, mode=args.mode,
+        stub_latency_ms=args.stub_latency_ms))["summary"]
+    report["chat"] = asyncio.run(bench_chat(
+        scenarios, args.requests, args.concurrency, args.chat_top_k, args.mode, args.url, args.stub_latency_ms))
+    chat = report["chat"]
+    print(f"/chat: {chat['requests_per_second']} req/s at concurrency {chat['concurrency']}, "
+          f"p50 {chat['latency_ms']['p50']} ms, p99 {chat['latency_ms']['p99']} ms, statuses {chat['status_counts']}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline indexing, retrieval and /chat benchmarks on a synthetic corpus.")
+    parser.add_argument("--knowledge-dir", default=None, help="source corpus (default: ./knowledge)")
+    parser.add_argument("--db-dir", default=None, help="vector store to build into (default: a temporary directory)")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 50], help="copies of each bundled document")
+    parser.add_argument("--top-k", type=int, nargs="+", default=[1, 5, 10], help="top_k values for retrieval runs")
+    parser.add_argument("--mode", choices=["vector", "bm25", "hybrid"], default="hybrid")
+    parser.add_argument("--threads", type=int, default=8, help="threads for the retrieval QPS run")
+    parser.add_argument("--requests", type=int, default=500, help="/chat requests in the load test")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent /chat clients")
+    parser.add_argument("--chat-top-k", type=int, default=5)
+    parser.add_argument("--stub-latency-ms", type=float, default=0.0, help="simulated LLM latency")
+    parser.add_argument("--url", help="load-test a running server (its real LLM) instead of the in-process app")
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    # Must be set before the retriever/query/Api_server modules are imported
+    os.environ["HELPDESK_DB_DIR"] = args.db_dir or tempfile.mkdtemp(prefix="helpdesk_bench_")
+    # Every repeated question would otherwise be answered from the semantic cache
+    os.environ.setdefault("SEMANTIC_CACHE_MAX_ENTRIES", "0")
+    report = run(args)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+        print(f"Results written to {args.output}")
@@ -0,0 +1,123 @@
+# Benchmark: memory-mapped vector index (float16 / int8, brute force / IVF) vs. exact float32 search
+#
+#   python benchmarks/bench_vector_index.py --vectors 200000 --queries 200 --output vector_index.json
+#
+# Uses clustered random unit vectors with the embedding model's dimension (real embeddings
+# cluster by topic, which is what IVF exploits), so it needs neither a built vector store
+# nor the model. recall@k is measured against exact float32 search.
+import argparse
+import json
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import retriever  # noqa: E402
+import vector_index  # noqa: E402
+from encoder import MODEL_NAME  # noqa: E402
+
+
+class ArrayCollection:
+    """Chroma-like paged get() over in-memory arrays, used as the export source."""
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = vectors
+
+    def get(self, include=(), limit=None, offset=0):
+        rows = range(offset, min(len(self.vectors), offset + limit))
+        return {"ids": [f"chunk-{i}" for i in rows], "documents": [f"text {i}" for i in rows],
+                "metadatas": [{"route": "general"} for _ in rows], "embeddings": self.vectors[offset:offset + limit]}
+
+
+def unit_vectors(n: int, dim: int, seed: int) -> np.ndarray:
+    vectors = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+# Unit vectors scattered around `clusters` topic centres
+def clustered_vectors(n: int, dim: int, clusters: int, spread: float, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centres = unit_vectors(clusters, dim, seed)
+    vectors = centres[rng.integers(0, clusters, size=n)] + spread * unit_vectors(n, dim, seed + 1)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def bench_variant(label: str, vectors: np.ndarray, queries: np.ndarray, exact: list[set], top_k: int,
+                  dtype: str, ivf: bool, nprobe: int) -> dict:
+    path = Path(tempfile.mkdtemp(prefix="vector_index_bench_")) / "vector_index"
+    # The export checks which model/backend embedded the collection; claim the current ones
+    manifest_path = path.parent / "index_manifest.json"
+    retriever.save_manifest({"model": MODEL_NAME, "documents": {}}, manifest_path)
+    started = time.perf_counter()
+    manifest = vector_index.export_index(ArrayCollection(vectors), path, dtype=dtype,
+                                         ivf_min_vectors=1 if ivf else len(vectors) + 1, manifest_path=manifest_path)
+    export_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    index = vector_index.MmapVectorIndex(path, nprobe=nprobe)
+    open_ms = 1000 * (time.perf_counter() - started)
+
+    latencies, recall = [], 0.0
+    for query, truth in zip(queries, exact):
+        started = time.perf_counter()
+        hits = index.search_many(query[None, :], top_k)[0]
+        latencies.append(1000 * (time.perf_counter() - started))
+        recall += len({chunk_id for chunk_id, _doc, _meta in hits} & truth) / top_k
+    latencies.sort()
+    size = sum(f.stat().st_size for f in path.iterdir() if f.suffix == ".npy" and f.name not in ("doc_offsets.npy", "order.npy"))
+    return {
+        "variant": label,
+        "ivf_lists": manifest["ivf_lists"],
+        "nprobe": nprobe if ivf else None,
+        "vector_bytes": size,
+        "export_seconds": round(export_seconds, 3),
+        "open_ms": round(open_ms, 2),
+        "latency_ms": {"p50": round(latencies[len(latencies) // 2], 3),
+                       "p99": round(latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))], 3)},
+        f"recall_at_{top_k}": round(recall / len(queries), 4),
+    }
+
+
+def run(n_vectors: int, n_queries: int, dim: int, top_k: int, nprobe: int, clusters: int) -> dict:
+    vectors = clustered_vectors(n_vectors, dim, clusters, spread=0.8, seed=0)
+    # Queries near stored vectors, like real questions near their answers
+    queries = vectors[:n_queries] + 0.3 * unit_vectors(n_queries, dim, seed=2)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    started = time.perf_counter()
+    exact = [set(f"chunk-{i}" for i in np.argsort(vectors @ q)[::-1][:top_k]) for q in queries]
+    exact_ms = 1000 * (time.perf_counter() - started) / n_queries
+
+    results = [
+        {"variant": "exact float32 (in memory)", "vector_bytes": vectors.nbytes,
+         "latency_ms": {"mean": round(exact_ms, 3)}, f"recall_at_{top_k}": 1.0},
+        bench_variant("mmap float16", vectors, queries, exact, top_k, "float16", False, nprobe),
+        bench_variant("mmap int8", vectors, queries, exact, top_k, "int8", False, nprobe),
+        bench_variant("mmap int8 + IVF", vectors, queries, exact, top_k, "int8", True, nprobe),
+    ]
+    return {"vectors": n_vectors, "queries": n_queries, "dim": dim, "clusters": clusters, "top_k": top_k,
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the memory-mapped vector index on synthetic vectors.")
+    parser.add_argument("--vectors", type=int, default=200000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=384, help="embedding dimension (all-MiniLM-L6-v2: 384)")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--clusters", type=int, default=500, help="topic clusters in the synthetic vectors")
+    parser.add_argument("--nprobe", type=int, default=vector_index.IVF_NPROBE)
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    report = run(args.vectors, args.queries, args.dim, args.top_k, args.nprobe, args.clusters)
+    for r in report["results"]:
+        print(f"{r['variant']:<28} {r['vector_bytes'] / 2**20:>8.1f} MiB  latency {r['latency_ms']}  "
+              f"recall@{args.top_k} {r[f'recall_at_{args.top_k}']}")
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
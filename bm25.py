@@ -0,0 +1,123 @@
+# In-process BM25 inverted index over the same chunks stored in ChromaDB
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from pathlib import Path
+
+# Common English words that carry no retrieval signal
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "for", "from", "has",
+    "have", "how", "i", "if", "in", "is", "it", "its", "me", "my", "not", "of", "on", "or",
+    "so", "that", "the", "this", "to", "was", "what", "when", "with", "you", "your",
+}
+
+
+# Lowercase word tokens; compound keys like "password_reset" also yield their parts
+def tokenize(text: str) -> list[str]:
+    tokens = []
+    for word in re.findall(r"\w+", text.lower()):
+        if word in STOPWORDS:
+            continue
+        tokens.append(word)
+        if "_" in word:
+            tokens += [part for part in word.split("_") if part and part not in STOPWORDS]
+    return tokens
+
+
+class BM25Index:
+    """Okapi BM25 over chunk texts, with simple equality/membership filters on chunk metadata."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids = []
+        self.texts = []
+        self.metas = []
+        self.lengths = []
+        self.postings = {}   # term -> [[doc index, term frequency], ...]
+        self.avg_length = 0.0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids: list[str], texts: list[str], metas: list[dict], **params) -> "BM25Index":
+        index = cls(**params)
+        index.add(ids, texts, metas)
+        return index
+
+    # Append chunks; call once per page to build a large index without holding the whole collection
+    def add(self, ids: list[str], texts: list[str], metas: list[dict]) -> None:
+        total_length = self.avg_length * len(self.lengths)
+        for chunk_id, text, meta in zip(ids, texts, metas):
+            # Title and tags are indexed too so app names in metadata are matchable
+            tokens = tokenize(" ".join([str(meta.get("title", "")), str(meta.get("tags", "")), text]))
+            i = len(self.ids)
+            self.ids.append(chunk_id)
+            self.texts.append(text)
+            self.metas.append(meta)
+            self.lengths.append(len(tokens))
+            total_length += len(tokens)
+            for term, tf in Counter(tokens).items():
+                self.postings.setdefault(term, []).append([i, tf])
+        self.avg_length = total_length / len(self.lengths) if self.lengths else 0.0
+
+    def _idf(self, term: str) -> float:
+        df = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.ids) - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, top_k: int = 5, where: dict | None = None) -> list[tuple[int, float]]:
+        """
+        Score chunks against the query.
+        Args:
+            query (str): Free-text query.
+            top_k (int): Number of results to return.
+            where (dict|None): Metadata filter, e.g. {"category": "troubleshooting"}; a list
+                value matches any of its items, e.g. {"route": ["password_reset", "general"]}.
+        Returns:
+            list[tuple[int, float]]: (chunk index, BM25 score) pairs, best first.
+        """
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self._idf(term)
+            for i, tf in self.postings.get(term, ()):
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / (self.avg_length or 1))
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+        if where:
+            scores = {i: s for i, s in scores.items()
+                      if all(self.metas[i].get(k) in v if isinstance(v, list) else self.metas[i].get(k) == v
+                             for k, v in where.items())}
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+    def save(self, path) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        payload = {
+            "k1": self.k1, "b": self.b, "ids": self.ids, "texts": self.texts, "metas": self.metas,
+            "lengths": self.lengths, "postings": self.postings,
+        }
+        tmp = path.with_suffix(".tmp")
+        # Stream to disk instead of building the whole JSON string in memory
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(payload, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path) -> "BM25Index":
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+        index = cls(k1=data["k1"], b=data["b"])
+        index.ids, index.texts, index.metas = data["ids"], data["texts"], data["metas"]
+        index.lengths, index.postings = data["lengths"], data["postings"]
+        index.avg_length = sum(index.lengths) / len(index.lengths) if index.lengths else 0.0
+        return index
+
+
+# Fuse several ranked ID lists: score(d) = Σ 1 / (k + rank_i(d))
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[tuple[str, float]]:
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] += 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,202 @@
+# Pre-generated answers for tickets that map onto a single troubleshooting entry or installation guide
+#
+# `python canonical_answers.py` generates the formatted "Category / Response / Escalation Required"
+# answer for every such document and stores it keyed by parent_id, regenerating only documents
+# whose content changed. At query time /chat serves the stored answer without an LLM call when
+# the top retrieved chunk is a confident, unambiguous match for one of these documents.
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Stored answers, next to the vector store
+CANONICAL_ANSWERS_PATH = Path(os.getenv("HELPDESK_DB_DIR", "chroma_store")) / "canonical_answers.json"
+# Document types (metadata "category") that get a canonical answer
+CANONICAL_DOC_TYPES = ("troubleshooting", "installation_guide")
+# Minimum cosine similarity of the top chunk to the question
+CANONICAL_MIN_SIMILARITY = float(os.getenv("CANONICAL_MIN_SIMILARITY", "0.65"))
+# Minimum lead of the top chunk over the best chunk of any other document
+CANONICAL_MIN_MARGIN = float(os.getenv("CANONICAL_MIN_MARGIN", "0.1"))
+
+
+# The question a canonical answer is generated for
+def canonical_question(doc: dict) -> str:
+    title = doc["meta"].get("title", doc["id"])
+    if doc["meta"].get("category") == "installation_guide":
+        return f"How do I complete this: {title}?"
+    return f"I need help with this issue: {title}. What should I do?"
+
+
+def load_answers(path: Path = CANONICAL_ANSWERS_PATH) -> dict:
+    try:
+        return json.loads(Path(path).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Error loading canonical answers from {path}: {e}")
+        return {}
+
+
+def save_answers(answers: dict, path: Path = CANONICAL_ANSWERS_PATH) -> None:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(answers, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def build_answers(docs: list[dict] | None = None, full: bool = False, workers: int = 4, llm: str = "openai",
+                  path: Path = CANONICAL_ANSWERS_PATH) -> dict:
+    """
+    Generate (or refresh) canonical answers.
+    Args:
+        docs (list[dict]|None): Corpus documents (default: retriever.get_docs()).
+        full (bool): Regenerate every answer, not only changed documents.
+        workers (int): Concurrent LLM calls.
+        llm (str): "openai", or "stub" for the offline StubLLM.
+        path (Path): Answer store to update.
+    Returns:
+        dict: generated/skipped/removed/failed counts.
+    """
+    import retriever
+    docs = retriever.get_docs() if docs is None else docs
+    if llm == "stub":
+        from evaluation import StubLLM
+        generate = StubLLM().answer
+    elif llm == "openai":
+        from responder import generate_response as generate, FALLBACK_RESPONSE
+    else:
+        raise ValueError(f"Unknown llm backend {llm!r}; expected 'openai' or 'stub'")
+
+    old = load_answers(path)
+    candidates = [d for d in docs if d["meta"].get("category") in CANONICAL_DOC_TYPES]
+    answers, todo = {}, []
+    for doc in candidates:
+        doc_hash = retriever.document_hash(doc)
+        entry = old.get(doc["id"])
+        if entry and entry.get("hash") == doc_hash and not full:
+            answers[doc["id"]] = entry
+        else:
+            todo.append((doc, doc_hash))
+
+    def generate_entry(item):
+        doc, doc_hash = item
+        answer = generate(canonical_question(doc), [doc["body"]])
+        if llm == "openai" and answer == FALLBACK_RESPONSE:
+            return doc["id"], None
+        return doc["id"], {
+            "hash": doc_hash,
+            # The chunks the answer was written from; a re-indexed chunk no longer matches
+            "chunk_hashes": [r["hash"] for r in retriever.chunk_document(doc)],
+            "question": canonical_question(doc),
+            "answer": answer,
+            "generated": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        }
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for doc_id, entry in pool.map(generate_entry, todo):
+            if entry is None:
+                failed += 1
+                # Keep serving the previous answer only if its chunks are still current (checked at lookup)
+                if doc_id in old:
+                    answers[doc_id] = old[doc_id]
+                continue
+            answers[doc_id] = entry
+    save_answers(answers, path)
+    removed = len(set(old) - {d["id"] for d in candidates})
+    report = {"generated": len(todo) - failed, "skipped": len(candidates) - len(todo),
+              "removed": removed, "failed": failed}
+    print(f"Canonical answers: {report}")
+    return report
+
+
+class CanonicalAnswers:
+    """Lookup side of the canonical answer store; reloads when the file changes."""
+
+    def __init__(self, path: Path = CANONICAL_ANSWERS_PATH, min_similarity: float = CANONICAL_MIN_SIMILARITY,
+                 min_margin: float = CANONICAL_MIN_MARGIN):
+        self.path = Path(path)
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+        self._answers = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _current(self) -> dict:
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            return {}
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._answers, self._mtime = load_answers(self.path), mtime
+        return self._answers
+
+    def lookup(self, results: list[tuple[str, dict]]) -> tuple[str, str] | None:
+        """
+        Return (parent_id, answer) when the most similar retrieved chunk clears the similarity threshold,
+        leads every other document by the margin, and belongs to a document with a current answer.
+        Other documents found by keyword search alone (no dense similarity) make the match ambiguous.
+        Args:
+            results (list[tuple[str, dict]]): (chunk, metadata) pairs from query_helpdesk, best first.
+        """
+        match = self._match(results)
+        with self._lock:
+            if match is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return match
+
+    def _match(self, results: list[tuple[str, dict]]) -> tuple[str, str] | None:
+        answers = self._current()
+        if not answers or not results:
+            return None
+        # Rank by dense similarity: in hybrid mode results[0] is the RRF winner, not the closest chunk
+        dense = sorted((m for _doc, m in results if m.get("similarity") is not None),
+                       key=lambda m: m["similarity"], reverse=True)
+        if not dense:
+            return None
+        top = dense[0]
+        entry = answers.get(top.get("parent_id"))
+        similarity = top["similarity"]
+        if entry is None or similarity < self.min_similarity:
+            return None
+        if top.get("content_hash") not in entry.get("chunk_hashes", ()):
+            return None
+        others = [m for _doc, m in results if m.get("parent_id") != top.get("parent_id")]
+        if any(m.get("similarity") is None for m in others):
+            # A keyword-only hit on another document has no similarity to measure the margin against
+            return None
+        runner_up = max((m["similarity"] for m in others), default=0.0)
+        if similarity - runner_up < self.min_margin:
+            return None
+        return top["parent_id"], entry["answer"]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._current()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypass_rate": self.hits / lookups if lookups else 0.0,
+            "min_similarity": self.min_similarity,
+            "min_margin": self.min_margin,
+        }
+
+
+# Command-line entry point: python canonical_answers.py --workers 8
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-generate canonical answers for troubleshooting entries and guides.")
+    parser.add_argument("--full", action="store_true", help="regenerate every answer")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent LLM calls")
+    parser.add_argument("--llm", choices=["openai", "stub"], default="openai")
+    args = parser.parse_args()
+    build_answers(full=args.full, workers=args.workers, llm=args.llm)
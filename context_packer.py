@@ -0,0 +1,83 @@
+# Token-budgeted assembly of retrieved chunks into the LLM context
+import os
+import re
+
+from tokenizer import get_encoder, n_tokens
+
+# Maximum number of context tokens sent to the LLM
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Word-shingle Jaccard similarity above which two chunks count as duplicates
+NEAR_DUPLICATE_THRESHOLD = 0.9
+# Don't bother appending a truncated passage smaller than this
+MIN_PARTIAL_TOKENS = 40
+PASSAGE_SEPARATOR = "\n\n"
+GAP_MARKER = "\n[...]\n"
+
+
+# Set of 3-word shingles used for near-duplicate detection
+def _shingles(text: str, size: int = 3) -> set:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+# Group ranked chunks by parent document, dropping exact and near duplicates
+def _group_by_parent(results: list[tuple[str, dict]]) -> list[list[tuple[int, str]]]:
+    groups = {}         # parent_id -> [(chunk_index, text)], in first-seen (relevance) order
+    seen_chunks = set()
+    kept_shingles = []
+    for rank, (text, meta) in enumerate(results):
+        parent = meta.get("parent_id", f"_unknown_{rank}")
+        chunk_index = meta.get("chunk_index", rank)
+        if (parent, chunk_index) in seen_chunks or not text.strip():
+            continue
+        shingles = _shingles(text)
+        if any(_jaccard(shingles, other) >= NEAR_DUPLICATE_THRESHOLD for other in kept_shingles):
+            continue
+        seen_chunks.add((parent, chunk_index))
+        kept_shingles.append(shingles)
+        groups.setdefault(parent, []).append((chunk_index, text))
+    return list(groups.values())
+
+
+# Merge a parent's chunks in document order; adjacent chunks join seamlessly
+def _merge_group(chunks: list[tuple[int, str]]) -> str:
+    chunks = sorted(chunks)
+    merged = chunks[0][1]
+    for (prev_index, _prev), (index, text) in zip(chunks, chunks[1:]):
+        merged += (" " if index == prev_index + 1 else GAP_MARKER) + text
+    return merged
+
+
+def pack_context(results: list[tuple[str, dict]], max_tokens: int = CONTEXT_TOKEN_BUDGET) -> tuple[list[str], int]:
+    """
+    Fit retrieved chunks into a token budget.
+    Args:
+        results (list[tuple[str, dict]]): (chunk, metadata) pairs, most relevant first.
+        max_tokens (int): Token budget for the joined context.
+    Returns:
+        tuple[list[str], int]: Passages to send (one per parent document, in relevance
+        order) and the number of tokens they use.
+    """
+    passages, used = [], 0
+    separator_tokens = n_tokens(PASSAGE_SEPARATOR)
+    for group in _group_by_parent(results):
+        passage = _merge_group(group)
+        cost = n_tokens(passage) + (separator_tokens if passages else 0)
+        if used + cost <= max_tokens:
+            passages.append(passage)
+            used += cost
+            continue
+        # Out of room: truncate the next-best passage to what is left, then stop
+        remaining = max_tokens - used - (separator_tokens if passages else 0)
+        if remaining >= MIN_PARTIAL_TOKENS:
+            encoder = get_encoder()
+            passages.append(encoder.decode(encoder.encode(passage)[:remaining]))
+            used += remaining + (separator_tokens if len(passages) > 1 else 0)
+        break
+    return passages, used
@@ -0,0 +1,217 @@
+# Shared sentence-embedding service used by both indexing (retriever) and querying (query)
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
+
+from metrics import span, CallbackMetric
+
+# Embedding model; stored vectors and query vectors must come from the same one
+MODEL_NAME = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+# "torch" (SentenceTransformer), "onnx" (int8 ONNX Runtime) or "onnx-fp32"; export first with onnx_encoder.py
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "torch")
+# Intra-op threads per worker's encoder; with several uvicorn workers use cores / workers.
+# ONNX defaults to min(4, cores); PyTorch keeps its own default unless this is set.
+ENCODER_THREADS = int(os.getenv("ENCODER_THREADS", "0")) or min(4, os.cpu_count() or 1)
+# Number of distinct query strings whose vectors are kept in memory
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "4096"))
+# Micro-batching of concurrent query embeddings (QUERY_BATCH_MAX_SIZE=1 disables it)
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "32"))
+QUERY_BATCH_MAX_WAIT_MS = float(os.getenv("QUERY_BATCH_MAX_WAIT_MS", "5"))
+
+_model = None
+_model_lock = threading.Lock()
+
+
+# Load the embedding model once per process (thread-safe); anything with SentenceTransformer's encode()
+def get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                if ENCODER_BACKEND in ("onnx", "onnx-fp32"):
+                    try:
+                        from onnx_encoder import OnnxEncoder
+                        _model = OnnxEncoder(quantized=ENCODER_BACKEND == "onnx")
+                    except Exception as e:
+                        print(f"Error loading the ONNX encoder ({e}); falling back to PyTorch. "
+                              f"Run `python onnx_encoder.py export` first.")
+                if _model is None:
+                    from sentence_transformers import SentenceTransformer
+                    if os.getenv("ENCODER_THREADS"):
+                        import torch
+                        torch.set_num_threads(ENCODER_THREADS)
+                    _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
+
+# Backend actually serving embeddings ("torch", "onnx" or "onnx-fp32"). Before the model is
+# loaded, the one get_model() will pick: ONNX needs onnxruntime and an exported model, else PyTorch.
+# Recorded in the index manifests, since vectors from different backends are not interchangeable.
+def active_backend() -> str:
+    if _model is None:
+        if ENCODER_BACKEND not in ("onnx", "onnx-fp32"):
+            return ENCODER_BACKEND
+        from importlib.util import find_spec
+        from onnx_encoder import ONNX_MODEL_DIR, CONFIG_FILE
+        ready = find_spec("onnxruntime") is not None and (ONNX_MODEL_DIR / CONFIG_FILE).exists()
+        return ENCODER_BACKEND if ready else "torch"
+    quantized = getattr(_model, "quantized", None)
+    if quantized is None:
+        return "torch"
+    return "onnx" if quantized else "onnx-fp32"
+
+
+# Embed a list of texts into unit-length vectors
+def embed_texts(texts: list[str], batch_size: int = 64, show_progress_bar: bool = False) -> "numpy.ndarray":
+    return get_model().encode(
+        texts,
+        batch_size=batch_size,
+        show_progress_bar=show_progress_bar,
+        normalize_embeddings=True
+    )
+
+
+class MicroBatcher:
+    """
+    Collects texts submitted from many threads and embeds them in one encode call.
+
+    A batch is flushed when it reaches `max_batch_size` or when the oldest
+    queued text has waited `max_wait_ms`, whichever comes first. Each caller
+    blocks only on its own future.
+    """
+
+    def __init__(self, encode_fn, max_batch_size: int = 32, max_wait_ms: float = 5):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.max_batch_seen = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+        self.batch_size_counts = {}   # batch size -> number of batches
+
+    def _ensure_worker(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="query-embed-batcher", daemon=True)
+                    self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future, time.monotonic()))
+        return future
+
+    def embed(self, text: str, timeout: float | None = None):
+        return self.submit(text).result(timeout=timeout)
+
+    # Block for the first item, then gather more until the batch is full or the window closes
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            # Identical concurrent questions share a single row in the forward pass
+            unique = list(dict.fromkeys(text for text, _f, _t in batch))
+            try:
+                vectors = dict(zip(unique, self.encode_fn(unique)))
+                for text, future, _t in batch:
+                    future.set_result(vectors[text])
+            except Exception as e:
+                for _text, future, _t in batch:
+                    future.set_exception(e)
+            self._record(batch, started)
+
+    def _record(self, batch: list, started: float):
+        waits = [started - enqueued for _text, _f, enqueued in batch]
+        with self._stats_lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            self.total_wait += sum(waits)
+            self.max_wait_seen = max(self.max_wait_seen, max(waits))
+            self.batch_size_counts[len(batch)] = self.batch_size_counts.get(len(batch), 0) + 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+                "max_batch_size": self.max_batch_seen,
+                "avg_queue_wait_ms": 1000 * self.total_wait / self.items if self.items else 0.0,
+                "max_queue_wait_ms": 1000 * self.max_wait_seen,
+                "batch_size_counts": dict(sorted(self.batch_size_counts.items())),
+                "queued": self._queue.qsize(),
+            }
+
+
+# Process-wide batcher for query embeddings
+query_batcher = MicroBatcher(
+    lambda texts: embed_texts(texts, batch_size=len(texts)),
+    max_batch_size=QUERY_BATCH_MAX_SIZE,
+    max_wait_ms=QUERY_BATCH_MAX_WAIT_MS
+)
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _embed_query_cached(text: str) -> tuple:
+    if QUERY_BATCH_MAX_SIZE > 1:
+        vector = query_batcher.embed(text)
+    else:
+        vector = embed_texts([text])[0]
+    return tuple(float(x) for x in vector)
+
+
+# Embed a single user question, reusing the vector for repeated questions
+def embed_query(text: str) -> list[float]:
+    with span("embedding"):
+        return list(_embed_query_cached(text))
+
+
+# Load the model and run one forward pass so the first real request is not a cold start
+def warm_up() -> None:
+    embed_texts(["warm-up query"])
+
+
+# Hit/miss statistics of the query-vector cache
+def query_cache_info() -> dict:
+    info = _embed_query_cached.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max_size": info.maxsize}
+
+
+# Query-vector cache and micro-batcher metrics
+def encoder_stats() -> dict:
+    return {"model": MODEL_NAME, "backend": active_backend(), "query_cache": query_cache_info(),
+            "batcher": query_batcher.stats()}
+
+
+# Expose query-vector cache and batcher counters on /metrics
+CallbackMetric("helpdesk_query_embedding_cache_total", "Query-embedding LRU cache lookups",
+               lambda: [({"result": "hit"}, query_cache_info()["hits"]), ({"result": "miss"}, query_cache_info()["misses"])],
+               kind="counter")
+CallbackMetric("helpdesk_embedding_batches_total", "Micro-batches embedded",
+               lambda: [({}, query_batcher.batches)], kind="counter")
+CallbackMetric("helpdesk_embedding_batch_items_total", "Queries embedded through the micro-batcher",
+               lambda: [({}, query_batcher.items)], kind="counter")
@@ -0,0 +1,215 @@
+# Concurrent evaluation of the help-desk pipeline against test_requests.json
+import argparse
+import asyncio
+import json
+import re
+import time
+from pathlib import Path
+
+# Default scenario file
+TEST_REQUESTS_PATH = Path(__file__).parent / "test_requests.json"
+# Fraction of expected elements an answer must mention to pass
+ELEMENT_PASS_THRESHOLD = 0.5
+
+
+# Load the scenarios list from test_requests.json
+def load_scenarios(path: Path = TEST_REQUESTS_PATH) -> list[dict]:
+    data = json.loads(Path(path).read_text(encoding="utf-8"))
+    return data.get("test_requests", [])
+
+
+# Nearest-rank percentiles of a list of values (None for an empty list)
+def percentiles(values: list[float], qs=(50, 90, 99)) -> dict:
+    ordered = sorted(values)
+    if not ordered:
+        return {f"p{q}": None for q in qs}
+    return {f"p{q}": ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))] for q in qs}
+
+
+class StubLLM:
+    """
+    Deterministic offline stand-in for the LLM.
+
+    Picks the category whose name/description overlaps most with the question,
+    echoes the first context passage as the response and escalates for
+    categories where every case must be escalated. Optional `latency_ms`
+    simulates provider latency so concurrency effects stay measurable.
+    """
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        from responder import get_categories
+        self.categories = get_categories()
+
+    def _classify(self, question: str):
+        words = set(re.findall(r"\w+", question.lower()))
+        def overlap(category):
+            vocab = set(re.findall(r"\w+", f"{category.name.replace('_', ' ')} {category.description}".lower()))
+            return len(words & vocab)
+        return max(self.categories, key=overlap) if self.categories else None
+
+    def answer(self, question: str, context_documents: list[str], history: list[dict] | None = None) -> str:
+        category = self._classify(question)
+        escalate = bool(category) and any(t.lower().startswith("all ") for t in category.escalation_triggers)
+        body = context_documents[0] if context_documents else "Sorry, I could not find this in the knowledge base."
+        return (
+            f"Category: {category.name if category else 'unknown'}\n\n"
+            f"Response:\n{body}\n\n"
+            f"Escalation Required: {'Yes' if escalate else 'No'}"
+        )
+
+    # Same call signature as responder.agenerate_response, so the API can use it as a drop-in
+    async def agenerate(self, question: str, context_documents: list[str], history: list[dict] | None = None,
+                        raise_errors: bool = False) -> str:
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        return self.answer(question, context_documents, history)
+
+
+# Pull the "Category:" and "Escalation Required:" fields out of a formatted answer
+def parse_answer(answer: str) -> dict:
+    category = re.search(r"Category:\s*([\w\s-]+?)\s*$", answer, re.M)
+    escalation = re.search(r"Escalation Required:\s*(Yes|No)", answer, re.I)
+    return {
+        "category": category.group(1).strip().lower().replace(" ", "_") if category else None,
+        "escalate": escalation.group(1).lower() == "yes" if escalation else None,
+    }
+
+
+# An expected element counts as mentioned when all its significant words appear in the answer
+def element_mentioned(element: str, answer: str) -> bool:
+    text = answer.lower()
+    words = [w for w in re.findall(r"[\w./@-]+", element.lower()) if len(w) > 2]
+    return all(w in text for w in words) if words else element.lower() in text
+
+
+def score_answer(answer: str, scenario: dict) -> dict:
+    """
+    Score one answer against a scenario's expectations.
+    Returns:
+        dict with classification_correct, escalation_correct, element_recall,
+        missing_elements and an overall passed flag.
+    """
+    parsed = parse_answer(answer)
+    expected_elements = scenario.get("expected_elements", [])
+    missing = [e for e in expected_elements if not element_mentioned(e, answer)]
+    recall = 1 - len(missing) / len(expected_elements) if expected_elements else 1.0
+    classification_correct = parsed["category"] == scenario.get("expected_classification")
+    escalation_correct = parsed["escalate"] == scenario.get("escalate")
+    return {
+        "predicted_classification": parsed["category"],
+        "predicted_escalate": parsed["escalate"],
+        "classification_correct": classification_correct,
+        "escalation_correct": escalation_correct,
+        "element_recall": round(recall, 3),
+        "missing_elements": missing,
+        "passed": classification_correct and escalation_correct and recall >= ELEMENT_PASS_THRESHOLD,
+    }
+
+
+# Aggregate accuracy and per-stage latency percentiles
+def summarize(results: list[dict], wall_seconds: float, parallelism: int) -> dict:
+    ok = [r for r in results if "error" not in r]
+    def rate(key):
+        return round(sum(r[key] for r in ok) / len(ok), 3) if ok else None
+    return {
+        "scenarios": len(results),
+        "errors": len(results) - len(ok),
+        "parallelism": parallelism,
+        "wall_seconds": round(wall_seconds, 3),
+        "pass_rate": rate("passed"),
+        "classification_accuracy": rate("classification_correct"),
+        "escalation_accuracy": rate("escalation_correct"),
+        "mean_element_recall": rate("element_recall"),
+        "latency_ms": {
+            stage: percentiles([r["timings_ms"][stage] for r in ok])
+            for stage in ("retrieval", "generation", "total")
+        },
+    }
+
+
+async def run_evaluation(
+    scenarios: list[dict],
+    parallelism: int = 4,
+    llm: str = "openai",
+    top_k: int = 5,
+    mode: str = "hybrid",
+    executor=None,
+    stub_latency_ms: float = 0.0,
+) -> dict:
+    """
+    Run every scenario through retrieval + generation with at most `parallelism` in flight.
+    Args:
+        scenarios (list[dict]): Entries from test_requests.json.
+        parallelism (int): Maximum concurrently evaluated scenarios.
+        llm (str): "openai" for the real model or "stub" for the offline StubLLM.
+        top_k (int): Chunks retrieved per question.
+        mode (str): query_helpdesk retrieval mode.
+        executor: Executor for blocking retrieval (default: the loop's default executor).
+        stub_latency_ms (float): Simulated latency of the stub LLM.
+    Returns:
+        dict: {"test_results": [...], "summary": {...}}
+    """
+    from query import query_helpdesk
+    from context_packer import pack_context
+    if llm == "stub":
+        generate = StubLLM(latency_ms=stub_latency_ms).agenerate
+    elif llm == "openai":
+        from responder import agenerate_response as generate
+    else:
+        raise ValueError(f"Unknown llm backend {llm!r}; expected 'openai' or 'stub'")
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max(1, parallelism))
+
+    async def evaluate(scenario: dict) -> dict:
+        question = scenario["request"]
+        result = {"id": scenario.get("id"), "question": question}
+        async with semaphore:
+            try:
+                started = time.perf_counter()
+                hits = await loop.run_in_executor(
+                    executor, lambda: query_helpdesk(question, top_k=top_k, mode=mode))
+                retrieved = time.perf_counter()
+                chunks, _tokens = pack_context(hits)
+                answer = await generate(question, chunks)
+                finished = time.perf_counter()
+            except Exception as e:
+                result["error"] = str(e)
+                return result
+        result.update(
+            answer=answer,
+            expected_classification=scenario.get("expected_classification"),
+            sources=[meta.get("parent_id") for _doc, meta in hits],
+            timings_ms={
+                "retrieval": round(1000 * (retrieved - started), 1),
+                "generation": round(1000 * (finished - retrieved), 1),
+                "total": round(1000 * (finished - started), 1),
+            },
+            **score_answer(answer, scenario),
+        )
+        return result
+
+    wall_started = time.perf_counter()
+    results = await asyncio.gather(*(evaluate(s) for s in scenarios))
+    return {"test_results": results, "summary": summarize(results, time.perf_counter() - wall_started, parallelism)}
+
+
+# Command-line entry point: python evaluation.py --llm stub --parallelism 8
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the help-desk pipeline against test scenarios.")
+    parser.add_argument("--scenarios", default=str(TEST_REQUESTS_PATH), help="path to test_requests.json")
+    parser.add_argument("--parallelism", type=int, default=4, help="scenarios evaluated concurrently")
+    parser.add_argument("--llm", choices=["openai", "stub"], default="openai", help="LLM backend")
+    parser.add_argument("--stub-latency-ms", type=float, default=0.0, help="simulated stub LLM latency")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--mode", choices=["vector", "bm25", "hybrid"], default="hybrid")
+    parser.add_argument("--output", help="write the full report to this JSON file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_evaluation(
+        load_scenarios(args.scenarios), parallelism=args.parallelism, llm=args.llm,
+        top_k=args.top_k, mode=args.mode, stub_latency_ms=args.stub_latency_ms))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(json.dumps(report["summary"], indent=2))
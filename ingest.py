@@ -0,0 +1,233 @@
+# Streaming, resumable ingestion pipeline for large knowledge corpora
+#
+#   sources ──► parse + hash + chunk (process pool) ──► diff vs. manifest ──► embed + upsert (fixed batches)
+#
+# Documents flow through the stages as generators, so memory is bounded by the
+# batch size and the pool's in-flight window rather than by the corpus size.
+# The index manifest doubles as the checkpoint: it is flushed every few batches,
+# so an interrupted run resumes by skipping every document already stored.
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import retriever
+
+# Chunks embedded and upserted per batch
+BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+# Batches between manifest checkpoints
+CHECKPOINT_EVERY = int(os.getenv("INGEST_CHECKPOINT_EVERY", "10"))
+# Documents handed to one worker task
+WORKER_CHUNKSIZE = 32
+
+# Document hashes already in the index, installed in each worker by _init_worker
+_known_hashes = {}
+
+
+def _init_worker(known_hashes: dict):
+    global _known_hashes
+    _known_hashes = known_hashes
+
+
+# Yield work items for every source in the knowledge directory, without loading them all
+def iter_sources(knowledge_dir: Path):
+    knowledge_dir = Path(knowledge_dir)
+    # Markdown articles (recursively, one item per file; parsed in the workers)
+    for path in sorted(knowledge_dir.rglob("*.md")):
+        yield ("md", str(path))
+    # JSONL article exports: one {"id", "body", ...metadata} object per line
+    for path in sorted(knowledge_dir.rglob("*.jsonl")):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield ("jsonl", line, str(path))
+    # Structured JSON catalogs (small; parsed here, chunked in the workers)
+    loaders = (
+        ("installation_guides.json", retriever.load_installation_guides),
+        ("categories.json", retriever.load_categories),
+        ("troubleshooting_database.json", retriever.load_troubleshooting),
+    )
+    for filename, loader in loaders:
+        path = knowledge_dir / filename
+        if path.exists():
+            for doc in loader(str(path)):
+                yield ("doc", doc)
+
+
+# Build a document from a JSONL export line
+def jsonl_document(line: str, source: str) -> dict:
+    record = json.loads(line)
+    body = record.pop("body")
+    doc_id = record.pop("id")
+    meta = record.pop("meta", None) or record
+    return {"id": doc_id, "meta": meta, "body": body, "source": source}
+
+
+# Worker stage: parse one item, hash it, and chunk it unless it is unchanged
+def _prepare(item) -> tuple | None:
+    kind = item[0]
+    try:
+        if kind == "md":
+            doc = retriever.md_document(item[1])
+        elif kind == "jsonl":
+            doc = jsonl_document(item[1], item[2])
+        else:
+            doc = item[1]
+        doc_hash = retriever.document_hash(doc)
+        if _known_hashes.get(doc["id"]) == doc_hash:
+            return doc["id"], doc_hash, None
+        return doc["id"], doc_hash, retriever.chunk_document(doc)
+    except Exception as e:
+        print(f"Error preparing {kind} item: {e}")
+        return None
+
+
+# Like pool.map over chunks of items, but only keeps `window` tasks in flight
+def _bounded_map(pool, fn, items, window: int, chunksize: int):
+    def batched():
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    pending = deque()
+    for chunk in batched():
+        pending.append(pool.submit(_prepare_many, fn, chunk))
+        if len(pending) >= window:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+def _prepare_many(fn, chunk: list) -> list:
+    return [fn(item) for item in chunk]
+
+
+def ingest(
+    knowledge_dir: Path | str | None = None,
+    workers: int | None = None,
+    batch_size: int = BATCH_SIZE,
+    checkpoint_every: int = CHECKPOINT_EVERY,
+    full: bool = False,
+) -> dict:
+    """
+    Stream the knowledge corpus into ChromaDB with bounded memory.
+    Args:
+        knowledge_dir: Directory to ingest (default: retriever.KNOWLEDGE_DIR).
+        workers (int|None): Parse/chunk processes (default: CPU count).
+        batch_size (int): Chunks embedded and upserted together.
+        checkpoint_every (int): Batches between manifest checkpoints.
+        full (bool): Ignore the manifest and re-embed everything.
+    Returns:
+        dict: added/updated/skipped/removed chunk counts, documents seen and elapsed seconds.
+    """
+    started = time.perf_counter()
+    knowledge_dir = Path(knowledge_dir or retriever.KNOWLEDGE_DIR)
+    manifest = retriever.load_manifest()
+    old_docs = manifest.get("documents", {})
+    stale_ids = list(manifest.get("stale_chunk_ids", []))
+    collection = retriever.open_collection()
+
+    report = {"added": 0, "updated": 0, "skipped": 0, "removed": 0, "documents": 0, "batches": 0}
+    done_docs = {}          # manifest entries of documents fully stored
+    batch, batch_docs, batch_deletes = [], {}, []
+
+    def checkpoint():
+        retriever.save_manifest({**manifest, "documents": {**old_docs, **done_docs}})
+
+    def flush():
+        if batch:
+            texts = [r["text"] for r in batch]
+            collection.upsert(
+                ids=[r["id"] for r in batch],
+                documents=texts,
+                embeddings=retriever.embed_texts(texts, batch_size=len(texts)),
+                metadatas=[r["meta"] for r in batch]
+            )
+        if batch_deletes:
+            collection.delete(ids=batch_deletes)
+        done_docs.update(batch_docs)
+        report["batches"] += 1
+        if report["batches"] % max(1, checkpoint_every) == 0:
+            checkpoint()
+        batch.clear(); batch_docs.clear(); batch_deletes.clear()
+
+    # Vectors from a different embedding model or chunk size are unusable
+    if stale_ids:
+        for i in range(0, len(stale_ids), batch_size):
+            collection.delete(ids=stale_ids[i:i + batch_size])
+
+    # With --full nothing counts as known, so every document is re-chunked and re-embedded
+    known_hashes = {} if full else {doc_id: entry["hash"] for doc_id, entry in old_docs.items()}
+    workers = workers or os.cpu_count() or 1
+    seen = set()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(known_hashes,)) as pool:
+        results = _bounded_map(pool, _prepare, iter_sources(knowledge_dir), window=workers * 2,
+                               chunksize=WORKER_CHUNKSIZE)
+        for prepared in results:
+            if prepared is None:
+                continue
+            doc_id, doc_hash, records = prepared
+            if doc_id in seen:
+                print(f"Skipping duplicate document id {doc_id}")
+                continue
+            seen.add(doc_id)
+            report["documents"] += 1
+            previous = old_docs.get(doc_id, {})
+            if records is None:
+                # Unchanged since the last run (or the last checkpoint)
+                done_docs[doc_id] = previous
+                report["skipped"] += len(previous.get("chunks", {}))
+                continue
+            old_chunks = previous.get("chunks", {})
+            new_chunks = {}
+            for record in records:
+                new_chunks[record["id"]] = record["hash"]
+                old_hash = old_chunks.get(record["id"])
+                if old_hash == record["hash"] and not full:
+                    report["skipped"] += 1
+                    continue
+                batch.append(record)
+                report["updated" if old_hash else "added"] += 1
+            vanished = [cid for cid in old_chunks if cid not in new_chunks]
+            batch_deletes.extend(vanished)
+            report["removed"] += len(vanished)
+            batch_docs[doc_id] = {"hash": doc_hash, "chunks": new_chunks}
+            # Flush only at document boundaries so a checkpoint never holds half a document
+            if len(batch) >= batch_size:
+                flush()
+    flush()
+
+    # Documents that disappeared from the corpus
+    orphans = [cid for doc_id, entry in old_docs.items() if doc_id not in seen for cid in entry.get("chunks", {})]
+    for i in range(0, len(orphans), batch_size):
+        collection.delete(ids=orphans[i:i + batch_size])
+    report["removed"] += len(orphans)
+
+    # Manifest first: the mmap export checks which backend embedded the collection
+    retriever.save_manifest({**manifest, "documents": done_docs})
+    if report["added"] or report["updated"] or report["removed"] or not retriever.BM25_PATH.exists():
+        retriever.build_search_indexes(collection)
+    retriever.reset_router()
+    report["seconds"] = round(time.perf_counter() - started, 2)
+    return report
+
+
+# Command-line entry point: python ingest.py --workers 8 --batch-size 512
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream a knowledge corpus into the help-desk vector store.")
+    parser.add_argument("--knowledge-dir", default=None, help="directory to ingest (default: ./knowledge)")
+    parser.add_argument("--workers", type=int, default=None, help="parse/chunk processes")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="chunks per embed/upsert batch")
+    parser.add_argument("--checkpoint-every", type=int, default=CHECKPOINT_EVERY, help="batches between checkpoints")
+    parser.add_argument("--full", action="store_true", help="re-embed everything, ignoring the manifest")
+    args = parser.parse_args()
+    print(ingest(args.knowledge_dir, workers=args.workers, batch_size=args.batch_size,
+                 checkpoint_every=args.checkpoint_every, full=args.full))
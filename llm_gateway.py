@@ -0,0 +1,307 @@
+# Shared gateway for every LLM call: pooled connections, client-side rate limiting,
+# retries with exponential backoff and jitter, and coalescing of identical in-flight requests
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import openai
+from metrics import Counter, Gauge, Histogram, LLM_TOKENS
+
+# OpenAI-compatible endpoint; point at a local stand-in (e.g. http://localhost:8080/v1) to avoid the provider
+LLM_BASE_URL = os.getenv("LLM_BASE_URL") or None
+# Per-call timeout for the LLM, in seconds
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+# Client-side limits; set them just under the account tier's requests/tokens per minute (0 disables)
+LLM_RPM_LIMIT = float(os.getenv("LLM_RPM_LIMIT", "500"))
+LLM_TPM_LIMIT = float(os.getenv("LLM_TPM_LIMIT", "200000"))
+# Retries on rate limits, timeouts and transient server/network errors
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "0.5"))
+LLM_RETRY_MAX_SECONDS = float(os.getenv("LLM_RETRY_MAX_SECONDS", "20"))
+# Pooled HTTP connections shared by all requests of this process
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+# Completion tokens reserved per request before the real usage is known
+COMPLETION_TOKEN_ESTIMATE = 400
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError,
+                    openai.InternalServerError)
+
+LLM_REQUESTS = Counter(
+    "helpdesk_llm_requests_total", "LLM gateway calls by outcome", ["outcome"])
+RATE_LIMIT_WAIT_SECONDS = Histogram(
+    "helpdesk_llm_rate_limit_wait_seconds", "Time requests waited for the client-side rate limiter")
+LLM_IN_FLIGHT = Gauge(
+    "helpdesk_llm_in_flight", "Upstream LLM requests currently in flight")
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `rate_per_minute`.
+
+    reserve() debits immediately (the balance may go negative) and returns how long the
+    caller must wait, so sync and async callers share one bucket and are served in order.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # A single request larger than the bucket still goes through once it is full
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, amount: float) -> None:
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+# Count prompt/completion tokens reported by the API
+def record_usage(usage) -> None:
+    if usage is None:
+        return
+    LLM_TOKENS.inc(usage.prompt_tokens or 0, kind="prompt")
+    LLM_TOKENS.inc(usage.completion_tokens or 0, kind="completion")
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details else None
+    if cached:
+        LLM_TOKENS.inc(cached, kind="cached_prompt")
+
+
+# Cheap prompt-size estimate (~4 characters per token) used for TPM accounting
+def estimate_tokens(messages: list[dict]) -> int:
+    return sum(len(str(m.get("content", ""))) for m in messages) // 4 + COMPLETION_TOKEN_ESTIMATE
+
+
+# Stable key for coalescing identical requests
+def request_key(model: str, messages: list[dict], **params) -> str:
+    payload = json.dumps({"model": model, "messages": messages, **params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# Delay before retry `attempt` (0-based): server Retry-After if given, else capped exponential with full jitter
+def backoff_seconds(attempt: int, error: Exception | None = None,
+                    base: float = LLM_RETRY_BASE_SECONDS, cap: float = LLM_RETRY_MAX_SECONDS) -> float:
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        if retry_after is not None:
+            return min(cap, float(retry_after))
+    except ValueError:
+        pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class LLMGateway:
+    """
+    Chat-completion calls for the whole process (sync, async and streaming).
+
+    Clients are created lazily over pooled httpx connections, with the SDK's own retries
+    disabled so backoff, rate limiting and request coalescing all happen here.
+    """
+
+    def __init__(self, base_url: str | None = LLM_BASE_URL, api_key: str | None = None,
+                 rpm: float = LLM_RPM_LIMIT, tpm: float = LLM_TPM_LIMIT, max_retries: int = LLM_MAX_RETRIES,
+                 timeout: float = LLM_TIMEOUT_SECONDS, max_connections: int = LLM_MAX_CONNECTIONS):
+        self.base_url = base_url
+        # A local stand-in endpoint usually accepts any key
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY") or ("local" if base_url else None)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._client = None
+        self._async_client = None
+        self._client_lock = threading.Lock()
+        self._inflight = {}         # request key -> asyncio.Future (async callers)
+        self._inflight_sync = {}    # request key -> concurrent.futures.Future (sync callers)
+        self._inflight_lock = threading.Lock()
+
+    def _limits(self):
+        import httpx
+        return httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+
+    @property
+    def client(self) -> openai.OpenAI:
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import httpx
+                    self._client = openai.OpenAI(
+                        api_key=self.api_key, base_url=self.base_url, timeout=self.timeout, max_retries=0,
+                        http_client=httpx.Client(limits=self._limits(), timeout=self.timeout))
+        return self._client
+
+    @property
+    def async_client(self) -> openai.AsyncOpenAI:
+        if self._async_client is None:
+            with self._client_lock:
+                if self._async_client is None:
+                    import httpx
+                    self._async_client = openai.AsyncOpenAI(
+                        api_key=self.api_key, base_url=self.base_url, timeout=self.timeout, max_retries=0,
+                        http_client=httpx.AsyncClient(limits=self._limits(), timeout=self.timeout))
+        return self._async_client
+
+    # Debit both buckets; returns (seconds to wait, tokens reserved)
+    def _reserve(self, messages: list[dict]) -> tuple[float, int]:
+        estimate = estimate_tokens(messages)
+        wait = max(self.requests.reserve(1), self.tokens.reserve(estimate))
+        RATE_LIMIT_WAIT_SECONDS.observe(wait)
+        return wait, estimate
+
+    # Record usage once per upstream call and return over-reserved tokens
+    def _settle(self, reserved: int, response) -> None:
+        usage = getattr(response, "usage", None)
+        record_usage(usage)
+        if usage is not None and usage.total_tokens is not None:
+            self.tokens.refund(reserved - usage.total_tokens)
+
+    def complete(self, messages: list[dict], model: str, **params):
+        """Blocking chat completion with rate limiting, retries and coalescing."""
+        key = request_key(model, messages, **params)
+        with self._inflight_lock:
+            shared = self._inflight_sync.get(key)
+            if shared is None:
+                future = self._inflight_sync[key] = Future()
+        if shared is not None:
+            LLM_REQUESTS.inc(outcome="coalesced")
+            return shared.result()
+        try:
+            response = self._call_with_retries(messages, model, **params)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight_sync.pop(key, None)
+
+    def _call_with_retries(self, messages: list[dict], model: str, **params):
+        for attempt in range(self.max_retries + 1):
+            wait, reserved = self._reserve(messages)
+            if wait:
+                time.sleep(wait)
+            LLM_IN_FLIGHT.inc()
+            try:
+                response = self.client.chat.completions.create(model=model, messages=messages, **params)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    LLM_REQUESTS.inc(outcome="error")
+                    raise
+                LLM_REQUESTS.inc(outcome="retry")
+                time.sleep(backoff_seconds(attempt, e))
+                continue
+            except Exception:
+                LLM_REQUESTS.inc(outcome="error")
+                raise
+            finally:
+                LLM_IN_FLIGHT.dec()
+            self._settle(reserved, response)
+            LLM_REQUESTS.inc(outcome="ok")
+            return response
+
+    async def acomplete(self, messages: list[dict], model: str, **params):
+        """Async chat completion; identical concurrent requests share one upstream call."""
+        key = request_key(model, messages, **params)
+        shared = self._inflight.get(key)
+        if shared is not None:
+            LLM_REQUESTS.inc(outcome="coalesced")
+            # shield: a cancelled waiter must not cancel the call the others are waiting on
+            return await asyncio.shield(shared)
+        task = asyncio.ensure_future(self._acall_with_retries(messages, model, **params))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _t: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _acall_with_retries(self, messages: list[dict], model: str, **params):
+        for attempt in range(self.max_retries + 1):
+            wait, reserved = self._reserve(messages)
+            if wait:
+                await asyncio.sleep(wait)
+            LLM_IN_FLIGHT.inc()
+            try:
+                response = await self.async_client.chat.completions.create(model=model, messages=messages, **params)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    LLM_REQUESTS.inc(outcome="error")
+                    raise
+                LLM_REQUESTS.inc(outcome="retry")
+                await asyncio.sleep(backoff_seconds(attempt, e))
+                continue
+            except Exception:
+                LLM_REQUESTS.inc(outcome="error")
+                raise
+            finally:
+                LLM_IN_FLIGHT.dec()
+            self._settle(reserved, response)
+            LLM_REQUESTS.inc(outcome="ok")
+            return response
+
+    async def astream(self, messages: list[dict], model: str, **params):
+        """
+        Open a streaming completion. Retries apply until the stream is established;
+        streams are not coalesced since each caller consumes its own deltas.
+        The reserved tokens are settled when the returned stream ends, fails or is cancelled.
+        """
+        for attempt in range(self.max_retries + 1):
+            wait, reserved = self._reserve(messages)
+            try:
+                if wait:
+                    await asyncio.sleep(wait)
+                stream = await self.async_client.chat.completions.create(
+                    model=model, messages=messages, stream=True, **params)
+            except RETRYABLE_ERRORS as e:
+                self.tokens.refund(reserved)
+                if attempt == self.max_retries:
+                    LLM_REQUESTS.inc(outcome="error")
+                    raise
+                LLM_REQUESTS.inc(outcome="retry")
+                await asyncio.sleep(backoff_seconds(attempt, e))
+                continue
+            except asyncio.CancelledError:
+                self.tokens.refund(reserved)
+                raise
+            except Exception:
+                self.tokens.refund(reserved)
+                LLM_REQUESTS.inc(outcome="error")
+                raise
+            LLM_REQUESTS.inc(outcome="ok")
+            return self._settled_stream(stream, reserved)
+
+    # Pass a stream's chunks through, then return over-reserved tokens: by the reported usage,
+    # else (failed or cancelled streams) by the prompt estimate plus the text actually streamed
+    async def _settled_stream(self, stream, reserved: int):
+        usage, streamed_chars = None, 0
+        try:
+            async for chunk in stream:
+                usage = getattr(chunk, "usage", None) or usage
+                for choice in getattr(chunk, "choices", None) or ():
+                    streamed_chars += len(getattr(choice.delta, "content", None) or "")
+                yield chunk
+        finally:
+            if usage is not None and usage.total_tokens is not None:
+                used = usage.total_tokens
+            else:
+                used = reserved - COMPLETION_TOKEN_ESTIMATE + streamed_chars // 4
+            self.tokens.refund(reserved - used)
+
+gateway = LLMGateway()
@@ -0,0 +1,182 @@
+# Minimal in-process metrics (counters, gauges, histograms) with Prometheus text exposition
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets (seconds) shared by the timing histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> dict:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self._labels(k), v) for k, v in sorted(self._values.items())]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{_format_labels(labels)} {_format_value(value)}" for name, labels, value in self.samples()]
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, state in sorted(self._values.items()):
+                labels = self._labels(key)
+                for bound, count in zip(self.buckets, state["counts"]):
+                    out.append((f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, count))
+                out.append((f"{self.name}_bucket", {**labels, "le": "+Inf"}, state["count"]))
+                out.append((f"{self.name}_sum", labels, state["sum"]))
+                out.append((f"{self.name}_count", labels, state["count"]))
+        return out
+
+
+class CallbackMetric(_Metric):
+    """Metric whose samples are read from `fn() -> list[(labels dict, value)]` at scrape time."""
+
+    def __init__(self, name: str, help_text: str, fn, kind: str = "gauge"):
+        super().__init__(name, help_text)
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self):
+        try:
+            return [(self.name, labels, value) for labels, value in self.fn()]
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {e}")
+            return []
+
+
+# Render every registered metric in the Prometheus text format (version 0.0.4)
+def render() -> str:
+    with _registry_lock:
+        metrics = list(_registry)
+    return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+# ---- Help-desk pipeline metrics ----
+STAGE_SECONDS = Histogram(
+    "helpdesk_stage_duration_seconds", "Time spent in each pipeline stage", ["stage"])
+REQUEST_SECONDS = Histogram(
+    "helpdesk_request_duration_seconds", "End-to-end HTTP request latency", ["route", "status"])
+TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    "helpdesk_time_to_first_token_seconds", "Time from LLM request to first streamed token")
+CONTEXT_TOKENS = Histogram(
+    "helpdesk_context_tokens", "Retrieved-context tokens sent to the LLM per request", buckets=TOKEN_BUCKETS)
+LLM_TOKENS = Counter(
+    "helpdesk_llm_tokens_total", "LLM tokens consumed", ["kind"])
+ERRORS = Counter(
+    "helpdesk_errors_total", "Errors caught in the pipeline", ["stage"])
+
+# Per-request stage timings (seconds), populated by span() and read for the Server-Timing header
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+# Start collecting stage timings for the current request/context
+def start_request_timings() -> dict:
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+# Time a pipeline stage: observed in STAGE_SECONDS and recorded for the current request
+@contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+# Format stage timings as a Server-Timing header value (durations in ms)
+def server_timing_header(timings: dict) -> str:
+    return ", ".join(f"{stage};dur={1000 * seconds:.1f}" for stage, seconds in timings.items())
@@ -0,0 +1,220 @@
+# ONNX Runtime backend for the embedding model (ENCODER_BACKEND=onnx or onnx-fp32)
+#
+#   python onnx_encoder.py export              # fp32 export + int8 dynamic quantization
+#   python onnx_encoder.py parity --k 5        # cosine drift and recall@k against PyTorch fp32
+#
+# The export reproduces the SentenceTransformer pipeline (transformer -> mean pooling ->
+# L2 normalization): the transformer runs in ONNX Runtime and the pooling in numpy.
+# Serving needs only onnxruntime and tokenizers, not torch. That is most of the per-worker
+# memory saving; int8 weights and a fixed intra-op thread count supply the speed-up.
+import argparse
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from encoder import MODEL_NAME, ENCODER_THREADS
+
+# Where exported models live; one sub-directory per embedding model
+ONNX_MODEL_DIR = Path(os.getenv("ENCODER_ONNX_DIR", Path(__file__).parent / "onnx_models")) / MODEL_NAME.replace("/", "__")
+FP32_FILE = "model.onnx"
+INT8_FILE = "model_int8.onnx"
+CONFIG_FILE = "encoder.json"
+ONNX_OPSET = 14
+
+
+# Mean of the token vectors, ignoring padding, then L2 normalization (SentenceTransformer pooling)
+def mean_pool(hidden: np.ndarray, attention_mask: np.ndarray, normalize: bool = True) -> np.ndarray:
+    mask = attention_mask[..., None].astype(np.float32)
+    pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    if normalize:
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        pooled = pooled / np.where(norms == 0, 1, norms)
+    return pooled.astype(np.float32)
+
+
+def export_model(model_name: str = MODEL_NAME, path: Path = ONNX_MODEL_DIR) -> dict:
+    """
+    Export the SentenceTransformer's transformer to ONNX and quantize it to int8.
+    Needs torch, sentence-transformers, onnx and onnxruntime (build machine only).
+    Args:
+        model_name (str): SentenceTransformer model to export.
+        path (Path): Output directory; replaced atomically.
+    Returns:
+        dict: The written encoder.json config.
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer, pooling = model[0], model[1]
+    if not getattr(pooling, "pooling_mode_mean_tokens", False):
+        raise ValueError(f"{model_name} does not use mean pooling; the ONNX backend only reproduces mean pooling")
+    tokenizer = transformer.tokenizer
+    sample = tokenizer(["export sample"], padding=True, return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, *inputs):
+            return self.auto_model(**dict(zip(input_names, inputs))).last_hidden_state
+
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    axes = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(
+            LastHiddenState(transformer.auto_model.eval()),
+            tuple(sample[name] for name in input_names),
+            str(tmp / FP32_FILE),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={**{name: axes for name in input_names}, "last_hidden_state": axes},
+            opset_version=ONNX_OPSET,
+        )
+    # int8 weights, activations quantized on the fly: no calibration data needed
+    quantize_dynamic(str(tmp / FP32_FILE), str(tmp / INT8_FILE), weight_type=QuantType.QInt8)
+    tokenizer.save_pretrained(str(tmp))
+    config = {
+        "model": model_name,
+        "inputs": input_names,
+        "max_seq_length": model.max_seq_length,
+        "dimension": model.get_sentence_embedding_dimension(),
+        "pad_token": tokenizer.pad_token,
+        "pad_token_id": tokenizer.pad_token_id,
+    }
+    (tmp / CONFIG_FILE).write_text(json.dumps(config, indent=2), encoding="utf-8")
+    old = path.with_name(path.name + ".old")
+    shutil.rmtree(old, ignore_errors=True)
+    if path.exists():
+        path.rename(old)
+    tmp.rename(path)
+    shutil.rmtree(old, ignore_errors=True)
+    sizes = {f: round((path / f).stat().st_size / 2**20, 1) for f in (FP32_FILE, INT8_FILE)}
+    print(f"Exported {model_name} to {path} (MiB: {sizes})")
+    return config
+
+
+class OnnxEncoder:
+    """
+    Drop-in for SentenceTransformer.encode() backed by an exported ONNX model.
+
+    Texts are sorted by length before batching so each batch pads to a similar length,
+    then returned in input order.
+    """
+
+    def __init__(self, path: Path = ONNX_MODEL_DIR, quantized: bool = True, threads: int = ENCODER_THREADS):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        path = Path(path)
+        self.config = json.loads((path / CONFIG_FILE).read_text(encoding="utf-8"))
+        if self.config["model"] != MODEL_NAME:
+            raise ValueError(f"{path} holds {self.config['model']}, not EMBEDDING_MODEL={MODEL_NAME}")
+        self.tokenizer = Tokenizer.from_file(str(path / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_token_id"], pad_token=self.config["pad_token"])
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.quantized = quantized
+        self.file = path / (INT8_FILE if quantized else FP32_FILE)
+        self.session = ort.InferenceSession(str(self.file), options, providers=["CPUExecutionProvider"])
+        self.threads = threads
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.config["dimension"]
+
+    def _encode_batch(self, texts: list[str], normalize: bool) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        features = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {name: features[name] for name in self.config["inputs"]})[0]
+        return mean_pool(hidden, features["attention_mask"], normalize)
+
+    def encode(self, texts: list[str], batch_size: int = 64, show_progress_bar: bool = False,
+               normalize_embeddings: bool = True) -> np.ndarray:
+        if isinstance(texts, str):
+            return self.encode([texts], batch_size, show_progress_bar, normalize_embeddings)[0]
+        vectors = np.zeros((len(texts), self.config["dimension"]), dtype=np.float32)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            vectors[rows] = self._encode_batch([texts[i] for i in rows], normalize_embeddings)
+            if show_progress_bar:
+                print(f"\rEmbedded {min(start + batch_size, len(order))}/{len(order)}", end="", flush=True)
+        if show_progress_bar and texts:
+            print()
+        return vectors
+
+
+# Exact top-k row indices of `corpus` for each query (all vectors unit length)
+def _top_k(queries: np.ndarray, corpus: np.ndarray, k: int) -> list[set]:
+    scores = queries @ corpus.T
+    return [set(np.argsort(row)[::-1][:k]) for row in scores]
+
+
+def parity_report(k: int = 5, path: Path = ONNX_MODEL_DIR, threads: int = ENCODER_THREADS) -> dict:
+    """
+    Compare the ONNX backends with PyTorch fp32 on the knowledge-base chunks and test_requests.json.
+    Returns:
+        dict: Per backend, cosine similarity to the fp32 vectors (mean/min/p1) and recall@k of the
+        fp32 neighbours, both for ONNX queries against an fp32-built index ("mixed") and with
+        chunks and queries both re-embedded ("reindexed").
+    """
+    import retriever
+    from evaluation import load_scenarios
+    from sentence_transformers import SentenceTransformer
+
+    chunks = [record["text"] for records in retriever.chunk_documents(retriever.get_docs()) for record in records]
+    questions = [s["request"] for s in load_scenarios()]
+    reference = SentenceTransformer(MODEL_NAME, device="cpu")
+    ref_chunks = reference.encode(chunks, batch_size=64, normalize_embeddings=True)
+    ref_queries = reference.encode(questions, batch_size=64, normalize_embeddings=True)
+    truth = _top_k(ref_queries, ref_chunks, k)
+
+    report = {"model": MODEL_NAME, "chunks": len(chunks), "queries": len(questions), "k": k, "backends": {}}
+    for backend, quantized in (("onnx-fp32", False), ("onnx", True)):
+        encoder = OnnxEncoder(path, quantized=quantized, threads=threads)
+        onnx_chunks = encoder.encode(chunks)
+        onnx_queries = encoder.encode(questions)
+        cosines = np.concatenate([(onnx_chunks * ref_chunks).sum(axis=1), (onnx_queries * ref_queries).sum(axis=1)])
+
+        def recall(found):
+            return round(float(np.mean([len(f & t) / k for f, t in zip(found, truth)])), 4)
+        report["backends"][backend] = {
+            "cosine_to_fp32": {"mean": round(float(cosines.mean()), 5), "min": round(float(cosines.min()), 5),
+                               "p1": round(float(np.percentile(cosines, 1)), 5)},
+            f"recall_at_{k}_mixed": recall(_top_k(onnx_queries, ref_chunks, k)),
+            f"recall_at_{k}_reindexed": recall(_top_k(onnx_queries, onnx_chunks, k)),
+        }
+    return report
+
+
+# Command-line entry point: python onnx_encoder.py export | parity
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the embedding model to ONNX and check it against PyTorch.")
+    parser.add_argument("command", choices=["export", "parity"])
+    parser.add_argument("--k", type=int, default=5, help="neighbours compared by the parity check")
+    parser.add_argument("--output", help="write the parity report to this JSON file")
+    args = parser.parse_args()
+    if args.command == "export":
+        export_model()
+    else:
+        report = parity_report(args.k)
+        print(json.dumps(report, indent=2))
+        if args.output:
+            Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
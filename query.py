@@ -1,43 +1,298 @@
 
-# Import ChromaDB for vector database operations
-import chromadb
-from chromadb.config import Settings
+# ChromaDB is imported and connected lazily, on the first query
+import os
+import threading
+from pathlib import Path
+from bm25 import BM25Index, reciprocal_rank_fusion
+import router
+from metrics import span, ERRORS
+# Queries are embedded with the same model/pipeline used to index the chunks
+from encoder import embed_query
 
 # Default number of results to return
 TOP_K_DEFAULT = 5
-# Directory where ChromaDB vector store is stored
-DB_DIR = "chroma_store"
-# Initialize ChromaDB client and collection
-client = chromadb.PersistentClient(path=DB_DIR, settings=Settings())
-collection = client.get_or_create_collection("helpdesk_knowledge")
+# Directory where ChromaDB vector store is stored (override with HELPDESK_DB_DIR)
+DB_DIR = os.getenv("HELPDESK_DB_DIR", "chroma_store")
+# Name of the Chroma collection holding the knowledge chunks
+COLLECTION_NAME = "helpdesk_knowledge"
+
+_collection = None
+_collection_lock = threading.Lock()
+
+
+# Open the ChromaDB client and collection on first use (thread-safe)
+def get_collection():
+    global _collection
+    if _collection is None:
+        with _collection_lock:
+            if _collection is None:
+                import chromadb
+                from chromadb.config import Settings
+                client = chromadb.PersistentClient(path=DB_DIR, settings=Settings(anonymized_telemetry=False))
+                _collection = client.get_or_create_collection(COLLECTION_NAME)
+    return _collection
+
+# Dense search backend: the memory-mapped export (VECTOR_BACKEND=mmap) when present, else Chroma
+def get_vector_store():
+    import vector_index
+    if vector_index.VECTOR_BACKEND == "mmap":
+        index = vector_index.get_index()
+        if index is not None:
+            return index
+    return get_collection()
+
+
+# Search modes supported by query_helpdesk
+SEARCH_MODES = ("vector", "bm25", "hybrid")
+# Why dense search is refused (e.g. the collection was embedded by another encoder backend than the
+# one serving queries, so cosine scores would be meaningless); None while it is allowed
+_dense_disabled_reason = None
+
+
+# Refuse dense search (and embedding-based routing) until re-enabled; every mode then runs as BM25
+def set_dense_search_disabled(reason: str | None) -> None:
+    global _dense_disabled_reason
+    _dense_disabled_reason = reason
+
+
+def dense_search_disabled() -> str | None:
+    return _dense_disabled_reason
+# Each retriever contributes this many candidates per requested result before fusion
+HYBRID_CANDIDATE_MULTIPLIER = 4
+# Reciprocal-rank-fusion damping constant
+RRF_K = 60
+# BM25 index written by retriever.build_vector
+BM25_PATH = Path(DB_DIR) / "bm25_index.json"
+
+_bm25_index = None
+_bm25_mtime = None
+_bm25_lock = threading.Lock()
+
+
+# Load the BM25 index, reloading it whenever the indexer rewrites the file
+def get_bm25_index() -> BM25Index | None:
+    global _bm25_index, _bm25_mtime
+    try:
+        mtime = BM25_PATH.stat().st_mtime
+    except FileNotFoundError:
+        return None
+    if mtime != _bm25_mtime:
+        with _bm25_lock:
+            if mtime != _bm25_mtime:
+                _bm25_index = BM25Index.load(BM25_PATH)
+                _bm25_mtime = mtime
+    return _bm25_index
+
+
+# Chroma and BM25 metadata filters for a document-type category and/or a set of routes
+def build_filters(category: str | None = None, routes: list[str] | None = None) -> tuple:
+    conditions = []
+    if category:
+        conditions.append({"category": {"$eq": category}})
+    if routes:
+        conditions.append({"route": {"$in": list(routes)}})
+    chroma_where = None if not conditions else conditions[0] if len(conditions) == 1 else {"$and": conditions}
+    bm25_where = {k: v for k, v in (("category", category), ("route", list(routes or []))) if v} or None
+    return chroma_where, bm25_where
+
+
+# Dense search; returns (id, document chunk, metadata) triples best first
+def vector_search(user_input: str, top_k: int, category: str | None = None,
+                  query_embedding: list[float] | None = None,
+                  routes: list[str] | None = None) -> list[tuple[str, str, dict]]:
+    # Never let Chroma embed query_texts itself: its default model/runtime differs from indexing
+    if query_embedding is None:
+        query_embedding = embed_query(user_input)
+    return vector_search_many([query_embedding], top_k, category, routes)[0]
+
+
+# Keyword search over the BM25 index; returns (id, document chunk, metadata) triples best first
+def keyword_search(user_input: str, top_k: int, category: str | None = None,
+                   routes: list[str] | None = None) -> list[tuple[str, str, dict]]:
+    index = get_bm25_index()
+    if index is None:
+        return []
+    _, where = build_filters(category, routes)
+    with span("bm25_search"):
+        hits = index.search(user_input, top_k, where)
+    return [(index.ids[i], index.texts[i], index.metas[i]) for i, _score in hits]
+
+
+# Dense search for many queries in one call (Chroma or the mmap index); one triple list per query,
+# with the cosine "similarity" of each hit added to its metadata
+def vector_search_many(query_embeddings: list, top_k: int, category: str | None = None,
+                       routes: list[str] | None = None) -> list[list[tuple[str, str, dict]]]:
+    where, _ = build_filters(category, routes)
+    store = get_vector_store()
+    with span("vector_search"):
+        if not hasattr(store, "query"):
+            return store.search_many(query_embeddings, top_k, where)
+        results = store.query(
+            query_embeddings=[list(map(float, e)) for e in query_embeddings],
+            n_results=top_k,
+            where=where  # None means no filter
+        )
+    # Vectors are unit length, so Chroma's squared-L2 distance d gives cosine similarity 1 - d/2
+    return [[(chunk_id, doc, {**meta, "similarity": round(1 - dist / 2, 4)})
+             for chunk_id, doc, meta, dist in zip(ids, docs, metas, dists)]
+            for ids, docs, metas, dists in zip(results["ids"], results["documents"], results["metadatas"],
+                                               results["distances"])]
+
+
+# Merge dense and keyword hits with reciprocal-rank fusion
+def _fuse(dense: list, sparse: list, top_k: int) -> list[tuple[str, str, dict]]:
+    by_id = {chunk_id: (doc, meta) for chunk_id, doc, meta in sparse + dense}
+    fused = reciprocal_rank_fusion([[h[0] for h in dense], [h[0] for h in sparse]], k=RRF_K)
+    return [(chunk_id, *by_id[chunk_id]) for chunk_id, _score in fused[:top_k]]
+
+
+# Run one retrieval in the given mode; returns (id, document chunk, metadata) triples best first
+def search(user_input: str, top_k: int, category: str | None, query_embedding, mode: str,
+           routes: list[str] | None = None) -> list[tuple[str, str, dict]]:
+    if mode == "bm25":
+        return keyword_search(user_input, top_k, category, routes)
+    if mode == "hybrid" and get_bm25_index() is not None:
+        candidates = top_k * HYBRID_CANDIDATE_MULTIPLIER
+        dense = vector_search(user_input, candidates, category, query_embedding, routes)
+        sparse = keyword_search(user_input, candidates, category, routes)
+        return _fuse(dense, sparse, top_k)
+    # Plain vector search (also the fallback when no BM25 index has been built yet)
+    return vector_search(user_input, top_k, category, query_embedding, routes)
+
+
+# search() for many questions sharing the same filters, with a single multi-query vector search
+def search_many(questions: list[str], query_embeddings: list, top_k: int, category: str | None, mode: str,
+                routes: list[str] | None = None) -> list[list[tuple[str, str, dict]]]:
+    if mode == "bm25":
+        return [keyword_search(q, top_k, category, routes) for q in questions]
+    if mode == "hybrid" and get_bm25_index() is not None:
+        candidates = top_k * HYBRID_CANDIDATE_MULTIPLIER
+        dense_all = vector_search_many(query_embeddings, candidates, category, routes)
+        return [_fuse(dense, keyword_search(q, candidates, category, routes), top_k)
+                for q, dense in zip(questions, dense_all)]
+    return vector_search_many(query_embeddings, top_k, category, routes)
+
+
+# Predict the question's category; returns the routes to search, or None to search everything
+def route_query(query_embedding: list[float]) -> list[str] | None:
+    with span("routing"):
+        category_router = router.get_router(get_vector_store())
+        if not category_router.tagged:
+            # Index built before route tags: a filtered search would match nothing
+            router.ROUTING_DECISIONS.inc(outcome="untagged_index")
+            return None
+        prediction = category_router.predict(query_embedding)
+    if not prediction.confident:
+        router.ROUTING_DECISIONS.inc(outcome="low_confidence")
+        return None
+    return [prediction.category, router.GENERAL_ROUTE]
+
 
 # Query the helpdesk knowledge base for relevant document chunks
-def query_helpdesk(user_input: str, top_k: int = TOP_K_DEFAULT, category: str | None = None):
+def query_helpdesk(user_input: str, top_k: int = TOP_K_DEFAULT, category: str | None = None,
+                   query_embedding: list[float] | None = None, mode: str = "vector",
+                   route: bool | None = None):
     """
-    Query the ChromaDB vector store for the most relevant document chunks.
+    Query the knowledge base for the most relevant document chunks.
     Args:
         user_input (str): The user's helpdesk question.
         top_k (int): Number of top results to return.
         category (str|None): Optional category filter.
+        query_embedding (list[float]|None): Precomputed embedding of user_input.
+        mode (str): "vector" (dense), "bm25" (keyword) or "hybrid" (both, fused with RRF).
+        route (bool|None): Narrow the search to the predicted ticket category
+            (default: router.ROUTER_ENABLED; ignored when `category` is given).
     Returns:
         list[tuple[str, dict]]: List of (document chunk, metadata) tuples.
     """
-    # Build filter for category if provided
-    where = {"category": {"$eq": category}} if category else None
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode {mode!r}; expected one of {SEARCH_MODES}")
+    route = router.ROUTER_ENABLED if route is None else route
+    if _dense_disabled_reason is not None:
+        mode, route = "bm25", False
     try:
-    # Query the vector store
-        results = collection.query(
-            query_texts=[user_input],
-            n_results=top_k,
-            where=where  # None means no filter
-        )
+        routes = None
+        if route and category is None:
+            if query_embedding is None:
+                query_embedding = embed_query(user_input)
+            routes = route_query(query_embedding)
+        hits = search(user_input, top_k, category, query_embedding, mode, routes)
+        if routes:
+            if len(hits) < top_k:
+                # Too few chunks in the partition (or an index built before routing): search everything
+                router.ROUTING_DECISIONS.inc(outcome="fallback")
+                hits = search(user_input, top_k, category, query_embedding, mode)
+            else:
+                router.ROUTING_DECISIONS.inc(outcome="routed")
 
         # Extract document chunks and metadata
-        docs  = results["documents"][0]   # list[str]
-        metas = results["metadatas"][0]   # list[dict]
-        return list(zip(docs, metas))
+        return [(doc, meta) for _id, doc, meta in hits]
 
     except Exception as e:
         # Log or handle errors gracefully
+        ERRORS.inc(stage="retrieval")
         print(f"Error querying helpdesk knowledge base: {e}")
-        return []
\ No newline at end of file
+        return []
+
+
+# Query the knowledge base for many questions at once (bulk triage)
+def query_helpdesk_batch(questions: list[str], top_k: int = TOP_K_DEFAULT, category: str | None = None,
+                         query_embeddings: list | None = None, mode: str = "vector",
+                         route: bool | None = None, raise_errors: bool = False) -> list[list[tuple[str, dict]]]:
+    """
+    Batched query_helpdesk: questions are embedded in one encoder pass and searched with one
+    multi-query vector search per routed category.
+    Args:
+        questions (list[str]): The users' helpdesk questions.
+        top_k (int): Number of top results per question.
+        category (str|None): Optional category filter applied to every question.
+        query_embeddings (list|None): Precomputed embeddings, one per question.
+        mode (str): "vector", "bm25" or "hybrid".
+        route (bool|None): Narrow each search to its predicted ticket category.
+        raise_errors (bool): Re-raise retrieval errors instead of returning empty results.
+    Returns:
+        list[list[tuple[str, dict]]]: (document chunk, metadata) lists, in question order.
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode {mode!r}; expected one of {SEARCH_MODES}")
+    if not questions:
+        return []
+    route = router.ROUTER_ENABLED if route is None else route
+    if _dense_disabled_reason is not None:
+        mode, route = "bm25", False
+    try:
+        if query_embeddings is None:
+            from encoder import embed_texts
+            with span("embedding"):
+                query_embeddings = embed_texts(questions)
+        # Questions predicted to the same category share one filtered search
+        groups = {}
+        for i, embedding in enumerate(query_embeddings):
+            routes = route_query(embedding) if route and category is None else None
+            groups.setdefault(tuple(routes) if routes else None, []).append(i)
+
+        hits, fallback = [None] * len(questions), []
+        for routes, indices in groups.items():
+            found = search_many([questions[i] for i in indices], [query_embeddings[i] for i in indices],
+                                top_k, category, mode, list(routes) if routes else None)
+            for i, result in zip(indices, found):
+                if routes and len(result) < top_k:
+                    fallback.append(i)
+                    continue
+                if routes:
+                    router.ROUTING_DECISIONS.inc(outcome="routed")
+                hits[i] = result
+        if fallback:
+            router.ROUTING_DECISIONS.inc(len(fallback), outcome="fallback")
+            found = search_many([questions[i] for i in fallback], [query_embeddings[i] for i in fallback],
+                                top_k, category, mode)
+            for i, result in zip(fallback, found):
+                hits[i] = result
+        return [[(doc, meta) for _id, doc, meta in result] for result in hits]
+
+    except Exception as e:
+        ERRORS.inc(stage="retrieval")
+        print(f"Error querying helpdesk knowledge base (batch): {e}")
+        if raise_errors:
+            raise
+        return [[] for _ in questions]
@@ -1,81 +1,216 @@
 import os
-from openai import OpenAI  # OpenAI API client
+import json
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
 from dotenv import load_dotenv  # For loading .env variables
-load_dotenv()  # Load environment variables from .env
-api_key = os.getenv("OPENAI_API_KEY")  # Get OpenAI API key
-client = OpenAI(api_key=api_key)  # Initialize OpenAI client
+load_dotenv()  # Load environment variables from .env (before the gateway reads its settings)
+from metrics import span, ERRORS
+# Every LLM call goes through the shared gateway (pooling, rate limits, retries, coalescing)
+from llm_gateway import gateway, record_usage
+
+FALLBACK_RESPONSE = "Sorry, something went wrong while generating the response. Please try again later."
+
+# Category taxonomy file used to guide classification and escalation
+CATEGORIES_PATH = Path(__file__).parent / "knowledge" / "categories.json"
+# How often (seconds) the categories file mtime is checked for changes
+PROMPT_RELOAD_CHECK_SECONDS = float(os.getenv("PROMPT_RELOAD_CHECK_SECONDS", "30"))
+
+# Immutable view of one categories.json entry
+class Category(NamedTuple):
+    name: str
+    description: str
+    key_elements: tuple
+    escalation_triggers: tuple
+
+# Static instructions; kept ahead of the variable context so provider prompt-prefix caching applies
+RULES = """Rules
+1. You MUST use only the information provided inside <CONTEXT> below. Do NOT use any outside knowledge, general IT advice, or steps not found in the context.
+2. If the answer is not present in the context, apologize and suggest escalation.
+3. If the context contains a website, email address, or procedure, you MUST use it exactly as written. Do NOT invent or substitute URLs, emails, or steps.
+4. If the context contains a specific procedure or step, follow it exactly.
+5. Quote or paraphrase directly from the context whenever possible, but you may rephrase for clarity and user-friendliness.
+6. Do NOT invent, generalize, or add any steps or advice not found verbatim in the context.
+7. Identify the best-fit issue category from the list above.
+8. Your answer must mention or address all key elements for the selected category.
+9. Provide a clear, complete, and friendly answer:
+    • Use numbered or bulleted steps when possible
+    • Use full sentences and natural language, not just keywords
+    • Mention the escalation trigger and contact ONLY if escalation is required.
+10. Escalate ONLY if the user's issue matches a listed escalation trigger for the chosen category.
+11. Format your output exactly like this:
+Category: <category>
+
+Response:
+<answer>
+
+Escalation Required: <Yes/No> (Only say Yes if the user's issue matches an escalation trigger for the selected category.)"""
+
+_prompt_lock = threading.Lock()
+_prompt_state = {"mtime": None, "checked": 0.0, "categories": (), "prefix": ""}
+
+
+# Parse categories.json into an immutable tuple of Category entries
+def load_categories(path: Path = CATEGORIES_PATH) -> tuple:
+    try:
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return ()
+    except Exception as e:
+        print(f"Error loading categories from {path}: {e}")
+        return ()
+    return tuple(
+        Category(
+            name=name,
+            description=details.get("description", ""),
+            key_elements=tuple(details.get("key_elements", [])),
+            escalation_triggers=tuple(details.get("escalation_triggers", []))
+        )
+        for name, details in data.get("categories", {}).items()
+    )
+
+
+# Render the static part of the system prompt (everything except the retrieved context)
+def build_static_prefix(categories: tuple) -> str:
+    parts = ["You are an IT Help‑Desk Assistant."]
+    if categories:
+        categories_list = "\n".join(
+            f"- {c.name}: {c.description}\n  Key elements: {', '.join(c.key_elements)}\n  Escalation triggers: {', '.join(c.escalation_triggers)}"
+            for c in categories
+        )
+        parts.append(
+            "Available categories (use the best match):\n" +
+            categories_list +
+            "\n\nFor the selected category, your answer must address all key elements listed.\nEscalate ONLY if the user's issue matches a listed escalation trigger for the chosen category."
+        )
+    parts.append(RULES)
+    return "\n\n".join(parts)
+
+
+# Explicitly re-read categories.json and rebuild the static prompt prefix
+def reload_prompt(path: Path = CATEGORIES_PATH) -> None:
+    with _prompt_lock:
+        try:
+            mtime = Path(path).stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        categories = load_categories(path)
+        _prompt_state.update(mtime=mtime, checked=time.monotonic(), categories=categories,
+                             prefix=build_static_prefix(categories))
+
+
+# Refresh the cached prompt if categories.json changed (checked at most every PROMPT_RELOAD_CHECK_SECONDS)
+def _refresh_if_stale() -> None:
+    now = time.monotonic()
+    if _prompt_state["checked"] and now - _prompt_state["checked"] < PROMPT_RELOAD_CHECK_SECONDS:
+        return
+    try:
+        mtime = CATEGORIES_PATH.stat().st_mtime
+    except FileNotFoundError:
+        mtime = None
+    if mtime != _prompt_state["mtime"] or not _prompt_state["prefix"]:
+        reload_prompt()
+    else:
+        _prompt_state["checked"] = now
+
+
+# Cached category taxonomy
+def get_categories() -> tuple:
+    _refresh_if_stale()
+    return _prompt_state["categories"]
+
+
+# Cached static system-prompt prefix
+def get_static_prefix() -> str:
+    _refresh_if_stale()
+    return _prompt_state["prefix"]
+
+
+# Build the system + user messages for the LLM from the retrieved context
+# (earlier turns of a conversation, if any, go between the system prompt and the question)
+def build_messages(user_input: str, context_documents: list[str], history: list[dict] | None = None) -> list[dict]:
+    with span("prompt_build"):
+        # Join the context passages (already fitted to the token budget by context_packer)
+        context_text = "\n\n".join(context_documents)
+        # Static prefix first (byte-identical across requests), variable context last
+        system_prompt = f"{get_static_prefix()}\n\n<CONTEXT>\n{context_text}\n</CONTEXT>"
+    return [
+        {"role": "system", "content": system_prompt},
+        *(history or []),
+        {"role": "user",   "content": user_input}
+    ]
+
 
 def generate_response(
     user_input: str,
     context_documents: list[str],
-    model: str = "gpt-4o-mini"  # or any GPT‑4/3.5 model you have access to
+    model: str = "gpt-4o-mini",  # or any GPT‑4/3.5 model you have access to
+    history: list[dict] | None = None  # earlier turns of the conversation (session_store)
 ) -> str:
     try:
-    # Join up to 10 context documents for the LLM prompt
-        context_text = "\n\n".join(context_documents[:20])
-
-        # Load categories and descriptions for better LLM guidance
-        import json
-        from pathlib import Path
-        categories_path = Path("knowledge/categories.json")
-        if categories_path.exists():
-            categories_data = json.loads(categories_path.read_text(encoding="utf-8"))
-            categories = categories_data.get("categories", {})
-            categories_list = "\n".join([
-                f"- {cat}: {details['description']}\n  Key elements: {', '.join(details.get('key_elements', []))}\n  Escalation triggers: {', '.join(details.get('escalation_triggers', []))}" for cat, details in categories.items()
-            ])
-            categories_section = (
-                "Available categories (use the best match):\n" +
-                categories_list +
-                "\n\nFor the selected category, your answer must address all key elements listed.\nEscalate ONLY if the user's issue matches a listed escalation trigger for the chosen category."
-            )
-        else:
-            categories_section = ""
-
-        # Prompt instructs the LLM to answer only from context and follow help-desk rules
-        system_prompt = f"""
-                    You are an IT Help‑Desk Assistant.
-
-                    <CONTEXT>
-                    {context_text}
-                    </CONTEXT>
-
-                    {categories_section}
-
-                    Rules
-                    1. You MUST use only the information provided inside <CONTEXT>. Do NOT use any outside knowledge, general IT advice, or steps not found in the context.
-                    2. If the answer is not present in the context, apologize and suggest escalation.
-                    3. If the context contains a website, email address, or procedure, you MUST use it exactly as written. Do NOT invent or substitute URLs, emails, or steps.
-                    4. If the context contains a specific procedure or step, follow it exactly.
-                    5. Quote or paraphrase directly from the context whenever possible, but you may rephrase for clarity and user-friendliness.
-                    6. Do NOT invent, generalize, or add any steps or advice not found verbatim in the context.
-                    7. Identify the best-fit issue category from the list above.
-                    8. Your answer must mention or address all key elements for the selected category.
-                    9. Provide a clear, complete, and friendly answer:
-                        • Use numbered or bulleted steps when possible
-                        • Use full sentences and natural language, not just keywords
-                        • Mention the escalation trigger and contact ONLY if escalation is required.
-                    10. Escalate ONLY if the user's issue matches a listed escalation trigger for the chosen category.
-                    11. Format your output exactly like this:
-                    Category: <category>
-
-                    Response:
-                    <answer>
-
-                    Escalation Required: <Yes/No> (Only say Yes if the user's issue matches an escalation trigger for the selected category.)
-                    """
+        messages = build_messages(user_input, context_documents, history)
         # Call OpenAI LLM with system and user prompt
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user",   "content": user_input}
-            ],
-            temperature=0.2
-        )
+        with span("llm"):
+            response = gateway.complete(messages, model=model, temperature=0.2)
         # Return the generated answer
         return response.choices[0].message.content
     except Exception as e:
+        ERRORS.inc(stage="generation")
         print(f"Error generating response: {e}")
-        return "Sorry, something went wrong while generating the response. Please try again later."
+        return FALLBACK_RESPONSE
+
 
+# Async variant of generate_response for use on the API event loop
+async def agenerate_response(
+    user_input: str,
+    context_documents: list[str],
+    model: str = "gpt-4o-mini",
+    raise_errors: bool = False,  # re-raise API errors (e.g. for callers that retry) instead of falling back
+    history: list[dict] | None = None
+) -> str:
+    try:
+        messages = build_messages(user_input, context_documents, history)
+        with span("llm"):
+            response = await gateway.acomplete(messages, model=model, temperature=0.2)
+        return response.choices[0].message.content
+    except Exception as e:
+        ERRORS.inc(stage="generation")
+        print(f"Error generating response: {e}")
+        if raise_errors:
+            raise
+        return FALLBACK_RESPONSE
+
+
+# Streaming variant: yields answer text deltas as the LLM produces them.
+# A failure before any text yields FALLBACK_RESPONSE; a failure after some text is re-raised,
+# so the caller can tell a truncated answer from a finished one.
+async def astream_response(
+    user_input: str,
+    context_documents: list[str],
+    model: str = "gpt-4o-mini",
+    history: list[dict] | None = None
+):
+    emitted = False
+    try:
+        stream = await gateway.astream(
+            build_messages(user_input, context_documents, history),
+            model=model,
+            temperature=0.2,
+            stream_options={"include_usage": True}
+        )
+        async for chunk in stream:
+            # The final chunk carries token usage and no choices
+            record_usage(getattr(chunk, "usage", None))
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                emitted = True
+                yield delta
+    except Exception as e:
+        ERRORS.inc(stage="generation")
+        print(f"Error streaming response: {e}")
+        if emitted:
+            raise
+        yield FALLBACK_RESPONSE
@@ -1,43 +1,65 @@
 
 # Imports for file handling, data processing, embeddings, and vector DB
-import os, re, json, glob, uuid, math
+# Heavy dependencies (chromadb, sentence-transformers, tiktoken) are imported on first use
+import os, re, json, hashlib, argparse, threading, bisect
 from pathlib import Path
 from datetime import datetime
-import pandas as pd
-import numpy as np
-import tiktoken
 import yaml
-from sentence_transformers import SentenceTransformer
-import chromadb
-from chromadb.config import Settings
-from chromadb.utils import embedding_functions
+from tokenizer import get_encoder
+from encoder import MODEL_NAME, get_model, embed_texts, active_backend
+from bm25 import BM25Index
+from router import assign_route, reset_router
 
 
-# Tokenizer and chunk size for splitting documents
-ENCODER     = tiktoken.get_encoding("cl100k_base")
+# Keep `retriever.ENCODER` (the tiktoken encoding, now in tokenizer.py) without loading tiktoken at import time
+def __getattr__(name):
+    if name == "ENCODER":
+        return get_encoder()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Chunk size and overlap for splitting documents (tokenizer lives in tokenizer.py)
 CHUNK_TOKENS = 350
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "0"))
+# Sentence ends, plus line breaks so bullet lists without full stops still split cleanly
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+|\n+')
+
+# Cut one pre-tokenized body into (text, token count) chunks at sentence boundaries
+def _chunk_tokens(body: str, tokens: list[int], max_tokens: int, overlap: int) -> list[tuple[str, int]]:
+    if not tokens:
+        return [("", 0)]       # handle empty body edge‑case
+    n = len(tokens)
+    # Character offset where each token starts, so sentence ends map onto token indices
+    _text, offsets = get_encoder().decode_with_offsets(tokens)
+    cuts = sorted({bisect.bisect_left(offsets, m.start()) for m in SENTENCE_END.finditer(body)} - {0} | {n})
+    chunks, start = [], 0
+    while start < n:
+        limit = start + max_tokens
+        # Last sentence boundary that fits; hard cut if a single sentence is longer than the budget
+        i = bisect.bisect_right(cuts, limit) - 1
+        end = cuts[i] if i >= 0 and cuts[i] > start else min(limit, n)
+        char_end = offsets[end] if end < n else len(body)
+        chunks.append((body[offsets[start]:char_end].strip(), end - start))
+        if end >= n:
+            break
+        # Step back `overlap` tokens, preferring to restart at a sentence boundary
+        next_start = max(end - overlap, start + 1)
+        j = bisect.bisect_left(cuts, next_start)
+        start = cuts[j] if overlap and j < len(cuts) and cuts[j] < end else next_start
+    return chunks
 
-# Count tokens in a string
-def n_tokens(text: str) -> int:
-    return len(ENCODER.encode(text))
+# Split many document bodies with one batched tokenizer call
+def chunk_bodies(bodies: list[str], max_tokens: int = CHUNK_TOKENS,
+                 overlap: int = CHUNK_OVERLAP_TOKENS) -> list[list[tuple[str, int]]]:
+    """Tokenize every body once and cut at sentence boundaries ≈ max_tokens (with `overlap` tokens)."""
+    token_lists = get_encoder().encode_batch(bodies, disallowed_special=())
+    return [_chunk_tokens(body, tokens, max_tokens, overlap) for body, tokens in zip(bodies, token_lists)]
 
 # Split a document body into chunks of ~max_tokens, at sentence boundaries
-def chunk_body(body: str, max_tokens: int = CHUNK_TOKENS) -> list[str]:
-    """Greedy chunking at sentence boundaries ≈ max_tokens."""
-    sentences = re.split(r'(?<=[.!?])\s+', body)
-    chunks = []
-    current_sentences = []
-    current_sentences_tokens = 0
-    for s in sentences:
-        t = n_tokens(s)
-        if current_sentences_tokens + t > max_tokens and current_sentences:
-            chunks.append(" ".join(current_sentences))
-            current_sentences, current_sentences_tokens = [], 0
-        current_sentences.append(s)
-        current_sentences_tokens += t
-    if current_sentences:
-        chunks.append(" ".join(current_sentences))
-    return chunks or [""]       # handle empty body edge‑case
+def chunk_body(body: str, max_tokens: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP_TOKENS) -> list[str]:
+    """Greedy chunking at sentence boundaries ≈ max_tokens."""
+    tokens = get_encoder().encode(body, disallowed_special=())
+    return [text for text, _count in _chunk_tokens(body, tokens, max_tokens, overlap)]
 
 # Read markdown file and extract YAML frontmatter and body
 def read_frontmatter_md(path):
@@ -64,19 +86,23 @@ def read_frontmatter_md(path):
         print(f"Error reading markdown frontmatter from {path}: {e}")
         return {"meta": {}, "body": ""}
 
+# Turn one markdown file into a document (raises if it has no usable id)
+def md_document(path) -> dict:
+    fm = read_frontmatter_md(Path(path))
+    return {
+        "id"      : fm["meta"]["id"],
+        "meta"    : fm["meta"],
+        "body"    : fm["body"],
+        "source"  : str(path)
+    }
+
 # Load all markdown files in a folder as documents
 def load_md_dir(folder):
     
     docs = []
     for p in Path(folder).glob("*.md"):
         try:
-            fm = read_frontmatter_md(p)
-            docs.append({
-                "id"      : fm["meta"]["id"],
-                "meta"    : fm["meta"],
-                "body"    : fm["body"],
-                "source"  : str(p)
-            })
+            docs.append(md_document(p))
         except Exception as e:
                 print(f"Error loading markdown file {p}: {e}")
 
@@ -116,7 +142,6 @@ def load_installation_guides(path):
             print(f"Error processing installation guide for {app}: {e}")
     return docs
     
-# C:\Users\danie\Downloads\AI_ML\knowledge\company_it_policies.md
     # ...existing code...
 # Load category definitions from JSON
 def load_categories(path):
@@ -191,22 +216,34 @@ def load_troubleshooting(path: str) -> list[dict]:
     return docs
 
 
-docs = []  # List to hold all loaded documents
+# Knowledge directory (override with HELPDESK_KNOWLEDGE_DIR)
+KNOWLEDGE_DIR = Path(os.getenv("HELPDESK_KNOWLEDGE_DIR", Path(__file__).parent / "knowledge"))
+
+_corpus = None
+_corpus_lock = threading.Lock()
 
-# 2‑A  Markdown sources that already contain YAML front‑matter
-for p in [r"C:\Users\danie\Downloads\AI_ML\knowledge\company_it_policies.md", r"C:\Users\danie\Downloads\AI_ML\knowledge\knowledge_base.md"]:
-    fm = read_frontmatter_md(Path(p))
-    docs.append({
-        "id"     : fm["meta"]["id"],
-        "meta"   : fm["meta"],
-        "body"   : fm["body"],
-        "source" : p
-    })
+# Load every knowledge source in a directory into one document list
+def load_corpus(knowledge_dir: Path | str | None = None) -> list[dict]:
+    knowledge_dir = Path(knowledge_dir or KNOWLEDGE_DIR)
+    docs = []  # List to hold all loaded documents
 
-# 2‑B  JSON sources
-docs += load_installation_guides(r"C:\Users\danie\Downloads\AI_ML\knowledge\installation_guides.json")
-docs += load_categories(r"C:\Users\danie\Downloads\AI_ML\knowledge\categories.json")
-docs += load_troubleshooting(r"C:\Users\danie\Downloads\AI_ML\knowledge\troubleshooting_database.json")
+    # 2‑A  Markdown sources (YAML front‑matter optional)
+    docs += load_md_dir(knowledge_dir)
+
+    # 2‑B  JSON sources
+    docs += load_installation_guides(str(knowledge_dir / "installation_guides.json"))
+    docs += load_categories(str(knowledge_dir / "categories.json"))
+    docs += load_troubleshooting(str(knowledge_dir / "troubleshooting_database.json"))
+    return docs
+
+# Lazily load (once) and return the default corpus from KNOWLEDGE_DIR
+def get_docs() -> list[dict]:
+    global _corpus
+    if _corpus is None:
+        with _corpus_lock:
+            if _corpus is None:
+                _corpus = load_corpus()
+    return _corpus
 
 # Remove any fields whose value is not a primitive type
 def sanitize_meta(meta: dict) -> dict:
@@ -214,52 +251,236 @@ def sanitize_meta(meta: dict) -> dict:
     return {k: v for k, v in meta.items() if isinstance(v, allowed_types)}
 # 2‑C  Chunk each doc’s body to ≈ 350 tokens
 
-# Build the vector store: chunk docs, embed, and upsert into ChromaDB
-def build_vector():
+# Vector store location (override with HELPDESK_DB_DIR) and collection (the embedding model lives in encoder.py)
+DB_DIR          = os.getenv("HELPDESK_DB_DIR", "chroma_store")
+COLLECTION_NAME = "helpdesk_knowledge"
+# Manifest of per-document / per-chunk content hashes, kept next to the store
+MANIFEST_PATH   = Path(DB_DIR) / "index_manifest.json"
+MANIFEST_VERSION = 3   # 3: chunks carry a `route` tag
+# Keyword (BM25) index over the same chunks, persisted next to the store
+BM25_PATH       = Path(DB_DIR) / "bm25_index.json"
+# Chunks read per collection.get() when rebuilding the derived indexes
+COLLECTION_PAGE_SIZE = 5000
+
+# Metadata keys that change on every load and must not trigger re-embedding
+VOLATILE_META_KEYS = {"updated"}
+
+# Stable SHA-256 over a chunk/document's text and non-volatile metadata
+def content_hash(text: str, meta: dict | None = None) -> str:
+    stable_meta = {k: v for k, v in (meta or {}).items() if k not in VOLATILE_META_KEYS}
+    payload = json.dumps({"text": text, "meta": stable_meta}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# Hash of a whole source document (body + metadata + source path)
+def document_hash(doc: dict) -> str:
+    return content_hash(doc["body"], {**doc["meta"], "source": str(doc["source"])})
+
+# Turn a document's chunks into records keyed by "<doc id>#<i>"
+def _chunk_records(doc: dict, chunks: list[tuple[str, int]]) -> list[dict]:
+    records = []
+    for i, (chunk_text, chunk_tokens) in enumerate(chunks):
+        meta_raw = {**doc["meta"], "parent_id": doc["id"], "source": str(doc["source"]),
+                    "chunk_index": i, "n_tokens": chunk_tokens,
+                    "route": assign_route(doc["id"], doc["meta"], chunk_text)}
+        meta = sanitize_meta(meta_raw)
+        chunk_hash = content_hash(chunk_text, meta)
+        meta["content_hash"] = chunk_hash
+        records.append({"id": f"{doc['id']}#{i}", "text": chunk_text, "meta": meta, "hash": chunk_hash})
+    return records
+
+# Chunk a single document into chunk records
+def chunk_document(doc: dict) -> list[dict]:
+    return chunk_documents([doc])[0]
+
+# Chunk many documents, tokenizing all bodies in one batched call
+def chunk_documents(docs: list[dict]) -> list[list[dict]]:
+    chunked = chunk_bodies([doc["body"] for doc in docs])
+    return [_chunk_records(doc, chunks) for doc, chunks in zip(docs, chunked)]
+
+# Load the index manifest; an unreadable or foreign manifest means "nothing indexed yet"
+def load_manifest(path: Path = MANIFEST_PATH) -> dict:
+    backend = active_backend()
+    empty = {"version": MANIFEST_VERSION, "model": MODEL_NAME, "backend": backend, "chunk_tokens": CHUNK_TOKENS,
+             "chunk_overlap": CHUNK_OVERLAP_TOKENS, "documents": {}}
     try:
-        chunks, texts, metadatas, ids = [], [], [], []
-        for doc in docs:
-            for i, chunk_text in enumerate(chunk_body(doc["body"])):
-                chunk_id = f"{doc['id']}#{i}"
-                meta_raw = {**doc["meta"], "parent_id": doc["id"], "source": doc["source"]}
-                meta = sanitize_meta(meta_raw)
-                chunks.append({"id": chunk_id, "text": chunk_text, "meta": meta})
-                ids.append(chunk_id)
-                texts.append(chunk_text)
-                metadatas.append(meta)
-
-        print(f"Loaded {len(docs)} docs → {len(chunks)} chunks")
-
-        # Embed all text chunks
-        model = SentenceTransformer("all-MiniLM-L6-v2")
-        embeddings = model.encode(texts, batch_size=64, show_progress_bar=True)
-
-        DB_DIR = "chroma_store"                     
-
-        # Connect to ChromaDB and upsert embeddings
-        chroma_client = chromadb.PersistentClient(
-            path=DB_DIR,                          
-            settings=Settings(anonymized_telemetry=False) 
-        )
-        collection = chroma_client.get_or_create_collection(name="helpdesk_knowledge")
-
-        collection.upsert(
-            ids=ids,
-            documents=texts,
-            embeddings=embeddings,
-            metadatas=metadatas
-        )
-
-        return model, collection
+        manifest = json.loads(Path(path).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return empty
+    except Exception as e:
+        print(f"Error reading index manifest {path}: {e}")
+        return empty
+    # A different embedding model, encoder backend or chunk size invalidates every stored vector
+    if (manifest.get("version") != MANIFEST_VERSION or manifest.get("model") != MODEL_NAME
+            or manifest.get("backend") != backend
+            or manifest.get("chunk_tokens") != CHUNK_TOKENS
+            or manifest.get("chunk_overlap") != CHUNK_OVERLAP_TOKENS):
+        print("Index manifest is stale (model/backend/chunking changed) → full re-index")
+        return {**empty, "stale_chunk_ids": [cid for d in manifest.get("documents", {}).values()
+                                               for cid in d.get("chunks", {})]}
+    return manifest
+
+# Embedding model and encoder backend that produced the stored vectors, as recorded in the
+# manifest (even a stale one); None when there is no readable manifest
+def indexed_embedding_space(path: Path = MANIFEST_PATH) -> tuple[str, str] | None:
+    try:
+        manifest = json.loads(Path(path).read_text(encoding="utf-8"))
+    except Exception:
+        return None
+    return manifest.get("model"), manifest.get("backend")
+
+# Atomically write the manifest so a crash never leaves it half-written
+def save_manifest(manifest: dict, path: Path = MANIFEST_PATH) -> None:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Record the backend that actually embedded the chunks (it may have fallen back to PyTorch)
+    manifest = {**{k: v for k, v in manifest.items() if k != "stale_chunk_ids"}, "backend": active_backend()}
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest, indent=1, sort_keys=True), encoding="utf-8")
+    os.replace(tmp, path)
+
+# Compare the corpus against the manifest and work out what has to change
+def plan_index_update(docs: list[dict], manifest: dict) -> dict:
+    """
+    Diff the current documents against the previous manifest.
+    Returns:
+        dict with "upsert" (chunk records to embed), "delete" (orphaned chunk IDs),
+        "documents" (the new manifest entries) and the added/updated/skipped/removed counts.
+    """
+    old_docs = manifest.get("documents", {})
+    plan = {"upsert": [], "delete": list(manifest.get("stale_chunk_ids", [])), "documents": {},
+            "added": 0, "updated": 0, "skipped": 0, "removed": 0}
+    changed = []
+    for doc in docs:
+        doc_hash = document_hash(doc)
+        previous = old_docs.get(doc["id"])
+        # Unchanged document: keep every chunk without re-chunking or re-embedding
+        if previous and previous.get("hash") == doc_hash:
+            plan["documents"][doc["id"]] = previous
+            plan["skipped"] += len(previous.get("chunks", {}))
+            continue
+        changed.append((doc, doc_hash, previous))
+    # Chunk all changed documents with one batched tokenizer pass
+    for (doc, doc_hash, previous), records in zip(changed, chunk_documents([c[0] for c in changed])):
+        old_chunks = previous.get("chunks", {}) if previous else {}
+        new_chunks = {}
+        for record in records:
+            new_chunks[record["id"]] = record["hash"]
+            old_hash = old_chunks.get(record["id"])
+            if old_hash == record["hash"]:
+                plan["skipped"] += 1
+                continue
+            plan["upsert"].append(record)
+            plan["updated" if old_hash else "added"] += 1
+        # Chunks that disappeared because the document got shorter
+        plan["delete"] += [cid for cid in old_chunks if cid not in new_chunks]
+        plan["documents"][doc["id"]] = {"hash": doc_hash, "chunks": new_chunks}
+    # Documents that no longer exist in the corpus
+    for doc_id, previous in old_docs.items():
+        if doc_id not in plan["documents"]:
+            plan["delete"] += list(previous.get("chunks", {}))
+    plan["removed"] = len(plan["delete"])
+    return plan
+
+# Connect to ChromaDB and return the knowledge collection
+def open_collection(db_dir: str = DB_DIR, name: str = COLLECTION_NAME):
+    import chromadb
+    from chromadb.config import Settings
+    chroma_client = chromadb.PersistentClient(
+        path=db_dir,
+        settings=Settings(anonymized_telemetry=False)
+    )
+    return chroma_client.get_or_create_collection(name=name)
+
+# Page through the collection so no single get() returns the whole store
+def iter_collection(collection, include: list[str]):
+    offset = 0
+    while True:
+        page = collection.get(include=include, limit=COLLECTION_PAGE_SIZE, offset=offset)
+        if not page["ids"]:
+            return
+        yield page
+        offset += len(page["ids"])
+
+# Build and persist the BM25 index from every chunk currently in the collection
+def build_bm25_index(collection, path: Path = BM25_PATH) -> BM25Index:
+    index = BM25Index()
+    for page in iter_collection(collection, ["documents", "metadatas"]):
+        index.add(page["ids"], page["documents"], page["metadatas"])
+    index.save(path)
+    print(f"BM25 index rebuilt over {len(index)} chunks → {path}")
+    return index
+
+# Rebuild the indexes derived from the collection: BM25, plus the mmap vector export when it is in use
+def build_search_indexes(collection) -> None:
+    import vector_index
+    build_bm25_index(collection)
+    if vector_index.VECTOR_BACKEND == "mmap" or vector_index.INDEX_DIR.exists():
+        vector_index.export_index(collection)
+
+# Build the vector store: chunk docs, embed only new/changed chunks, and sync ChromaDB
+def build_vector(full: bool = False, docs: list[dict] | None = None):
+    """
+    Incrementally (re)index the knowledge corpus into the helpdesk_knowledge collection.
+    Args:
+        full (bool): Ignore the manifest and re-embed every chunk.
+        docs (list[dict]|None): Documents to index (default: the corpus in KNOWLEDGE_DIR).
+    Returns:
+        tuple: (model, collection, report) where report counts added/updated/skipped/removed chunks.
+    """
+    try:
+        docs = get_docs() if docs is None else docs
+        manifest = load_manifest()
+        if full:
+            previous_ids = [cid for d in manifest.get("documents", {}).values() for cid in d.get("chunks", {})]
+            manifest = {**manifest, "documents": {}, "stale_chunk_ids": previous_ids}
+        plan = plan_index_update(docs, manifest)
+        # A forced rebuild re-upserts ids it also lists as stale; only delete true orphans
+        upsert_ids = {r["id"] for r in plan["upsert"]}
+        plan["delete"] = [cid for cid in dict.fromkeys(plan["delete"]) if cid not in upsert_ids]
+        plan["removed"] = len(plan["delete"])
+
+        report = {k: plan[k] for k in ("added", "updated", "skipped", "removed")}
+        print(f"Loaded {len(docs)} docs → {report['added']} added, {report['updated']} updated, "
+              f"{report['skipped']} skipped, {report['removed']} removed chunks")
+
+        collection = open_collection()
+
+        model = None
+        if plan["upsert"]:
+            # Embed only the new or changed chunks
+            model = get_model()
+            texts = [r["text"] for r in plan["upsert"]]
+            embeddings = embed_texts(texts, batch_size=64, show_progress_bar=True)
+            collection.upsert(
+                ids=[r["id"] for r in plan["upsert"]],
+                documents=texts,
+                embeddings=embeddings,
+                metadatas=[r["meta"] for r in plan["upsert"]]
+            )
+        if plan["delete"]:
+            collection.delete(ids=plan["delete"])
+
+        # Only record the new state once the store has actually been updated
+        save_manifest({**manifest, "documents": plan["documents"]})
+
+        # Rebuild the keyword index (and mmap export) from the collection so every retriever sees the same chunks
+        if plan["upsert"] or plan["delete"] or not BM25_PATH.exists():
+            build_search_indexes(collection)
+        # Category centroids are computed from the indexed chunks
+        reset_router()
+        print("✅ Embeddings upserted & collection persisted.")
+        return model, collection, report
     except Exception as e:
         print(f"Error building vector store: {e}")
-        return None, None      
+        return None, None, None
 
-# Print status after upserting embeddings
-print("✅ Embeddings upserted & collection persisted.")
 
 
 # Main entry point: build the vector store if run as a script
 if __name__ == "__main__":
-    build_vector()
-    print("Vector store built successfully.")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Build or incrementally update the help-desk vector store.")
+    parser.add_argument("--full", action="store_true", help="re-embed every chunk, ignoring the manifest")
+    args = parser.parse_args()
+    _model, _collection, report = build_vector(full=args.full)
+    if report is not None:
+        print(f"Vector store built successfully: {report}")
\ No newline at end of file
@@ -0,0 +1,241 @@
+# Query routing: predict the ticket category before retrieval so the search can be narrowed
+#
+# Index time: every chunk is tagged with a `route` (a categories.json key, or "general")
+#             by cheap lexical matching, see assign_route().
+# Query time: the query embedding is compared with one prototype vector per category
+#             (its description blended with the centroid of its chunks). Confident
+#             predictions restrict the search to that category's chunks plus "general" ones.
+import argparse
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from typing import NamedTuple
+
+from bm25 import STOPWORDS
+from metrics import Counter
+
+# Set ROUTER_ENABLED=0 to always search the whole collection
+ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "1") == "1"
+# Minimum cosine similarity to the best category prototype
+ROUTER_MIN_SCORE = float(os.getenv("ROUTER_MIN_SCORE", "0.25"))
+# Minimum lead of the best category over the runner-up
+ROUTER_MIN_MARGIN = float(os.getenv("ROUTER_MIN_MARGIN", "0.03"))
+# Chunks read from the collection to build category centroids
+ROUTER_CENTROID_CHUNK_LIMIT = 5000
+# Route of chunks that belong to no single category; always searched
+GENERAL_ROUTE = "general"
+CATEGORIES_PATH = Path(os.getenv("HELPDESK_KNOWLEDGE_DIR", Path(__file__).parent / "knowledge")) / "categories.json"
+
+# Document types (metadata "category") that always belong to one route
+DOC_TYPE_ROUTES = {"installation_guide": "software_installation"}
+# Words in category descriptions that say nothing about the category
+GENERIC_WORDS = STOPWORDS | {"issues", "including", "questions", "problems", "about", "requiring",
+                             "related", "potential", "activity"}
+
+ROUTING_DECISIONS = Counter(
+    "helpdesk_routing_decisions_total", "Query routing outcomes", ["outcome"])
+
+
+class RoutePrediction(NamedTuple):
+    category: str | None
+    score: float
+    margin: float
+    confident: bool
+
+
+# Load {category name: description} from categories.json
+def load_route_profiles(path: Path = CATEGORIES_PATH) -> dict:
+    try:
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Error loading categories from {path}: {e}")
+        return {}
+    return {name: details.get("description", "") for name, details in data.get("categories", {}).items()}
+
+
+# Crude prefix stems so "install", "installing" and "installation" match
+def _stems(text: str) -> set:
+    return {w[:5] for w in re.findall(r"[a-z]+", text.lower()) if w not in GENERIC_WORDS and len(w) > 2}
+
+
+_vocab = None
+_vocab_lock = threading.Lock()
+
+
+def _route_vocabulary() -> dict:
+    global _vocab
+    if _vocab is None:
+        with _vocab_lock:
+            if _vocab is None:
+                _vocab = {name: _stems(f"{name.replace('_', ' ')} {description}")
+                          for name, description in load_route_profiles().items()}
+    return _vocab
+
+
+def assign_route(doc_id: str, meta: dict, text: str) -> str:
+    """
+    Pick the route (category) of a chunk at index time.
+    Args:
+        doc_id (str): Parent document id; ids named after a category (e.g. password_reset_troubleshoot_v1) win.
+        meta (dict): Chunk metadata; the document type, title and tags are matched along with the text.
+        text (str): Chunk text.
+    Returns:
+        str: A categories.json key, or GENERAL_ROUTE when no category clearly dominates.
+    """
+    vocab = _route_vocabulary()
+    for name in sorted(vocab, key=len, reverse=True):
+        if doc_id.startswith(f"{name}_"):
+            return name
+    if meta.get("category") in DOC_TYPE_ROUTES and DOC_TYPE_ROUTES[meta["category"]] in vocab:
+        return DOC_TYPE_ROUTES[meta["category"]]
+    # Title and tag matches count double
+    heading = _stems(f"{meta.get('title', '')} {meta.get('tags', '')}")
+    stems = _stems(text)
+    scores = sorted(((len(stems & words) + 2 * len(heading & words), name) for name, words in vocab.items()),
+                    reverse=True)
+    if not scores:
+        return GENERAL_ROUTE
+    best, name = scores[0]
+    runner_up = scores[1][0] if len(scores) > 1 else 0
+    # Chunks spanning several topics (e.g. a whole FAQ section) stay searchable by every route
+    return name if best >= 2 and best >= 2 * runner_up else GENERAL_ROUTE
+
+
+class CategoryRouter:
+    """Nearest-prototype classifier over normalized query embeddings."""
+
+    def __init__(self, profiles: dict, min_score: float = ROUTER_MIN_SCORE, min_margin: float = ROUTER_MIN_MARGIN):
+        self.names = list(profiles)
+        self.profiles = profiles
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.prototypes = None
+        self.tagged = True   # False when the index predates route tags; queries then search everything
+
+    def fit(self, embed_fn, chunk_embeddings=None, chunk_routes=None) -> "CategoryRouter":
+        """
+        Build one prototype per category.
+        Args:
+            embed_fn: Callable mapping a list of texts to normalized vectors.
+            chunk_embeddings: Optional embeddings of indexed chunks.
+            chunk_routes: The `route` of each chunk in chunk_embeddings.
+        """
+        import numpy as np
+        texts = [f"{name.replace('_', ' ')}: {self.profiles[name]}" for name in self.names]
+        prototypes = np.asarray(embed_fn(texts), dtype=np.float32)
+        if chunk_embeddings is not None and len(chunk_embeddings):
+            chunk_embeddings = np.asarray(chunk_embeddings, dtype=np.float32)
+            routes = np.asarray(chunk_routes)
+            for i, name in enumerate(self.names):
+                members = chunk_embeddings[routes == name]
+                if len(members):
+                    prototypes[i] = prototypes[i] + members.mean(axis=0)
+        norms = np.linalg.norm(prototypes, axis=1, keepdims=True)
+        self.prototypes = prototypes / np.where(norms == 0, 1, norms)
+        return self
+
+    def predict(self, embedding) -> RoutePrediction:
+        import numpy as np
+        if self.prototypes is None or not self.names:
+            return RoutePrediction(None, 0.0, 0.0, False)
+        scores = self.prototypes @ np.asarray(embedding, dtype=np.float32)
+        order = np.argsort(scores)[::-1]
+        best = float(scores[order[0]])
+        margin = best - float(scores[order[1]]) if len(order) > 1 else best
+        confident = best >= self.min_score and margin >= self.min_margin
+        return RoutePrediction(self.names[order[0]], round(best, 4), round(margin, 4), confident)
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+# Embeddings and routes of up to ROUTER_CENTROID_CHUNK_LIMIT routed chunks, and whether the index
+# carries route tags at all (a Chroma collection, or the mmap index's Chroma-style get())
+def _routed_chunks(store) -> tuple:
+    sample = store.get(limit=1, include=["metadatas"])
+    if sample["ids"] and "route" not in sample["metadatas"][0]:
+        return None, None, False
+    stored = store.get(where={"route": {"$ne": GENERAL_ROUTE}}, include=["embeddings", "metadatas"],
+                       limit=ROUTER_CENTROID_CHUNK_LIMIT)
+    return stored["embeddings"], [meta.get("route") for meta in stored["metadatas"]], True
+
+
+# Build (once) the router for the default taxonomy and the chunks in `collection`
+def get_router(collection=None) -> CategoryRouter:
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                from encoder import embed_texts
+                chunk_embeddings, chunk_routes, tagged = None, None, True
+                if collection is not None:
+                    try:
+                        chunk_embeddings, chunk_routes, tagged = _routed_chunks(collection)
+                    except Exception as e:
+                        print(f"Error reading chunk embeddings for routing: {e}")
+                if not tagged:
+                    print("Index has no route tags (built before routing) → routing off until it is re-indexed")
+                category_router = CategoryRouter(load_route_profiles()).fit(embed_texts, chunk_embeddings, chunk_routes)
+                category_router.tagged = tagged
+                _router = category_router
+    return _router
+
+
+# Drop the cached router (e.g. after re-indexing or editing categories.json)
+def reset_router() -> None:
+    global _router, _vocab
+    with _router_lock:
+        _router = None
+    with _vocab_lock:
+        _vocab = None
+
+
+def evaluate_routing(scenarios: list[dict], router: CategoryRouter | None = None) -> dict:
+    """
+    Measure routing accuracy against each scenario's expected_classification.
+    Returns:
+        dict: overall accuracy, accuracy of the confident (routed) subset, the routed
+        fraction, and one prediction per scenario.
+    """
+    from encoder import embed_texts
+    if router is None:
+        from query import get_collection
+        router = get_router(get_collection())
+    embeddings = embed_texts([s["request"] for s in scenarios])
+    results = []
+    for scenario, embedding in zip(scenarios, embeddings):
+        prediction = router.predict(embedding)
+        results.append({
+            "id": scenario.get("id"),
+            "expected": scenario.get("expected_classification"),
+            **prediction._asdict(),
+            "correct": prediction.category == scenario.get("expected_classification"),
+        })
+    routed = [r for r in results if r["confident"]]
+    def accuracy(rows):
+        return round(sum(r["correct"] for r in rows) / len(rows), 3) if rows else None
+    return {
+        "scenarios": len(results),
+        "accuracy": accuracy(results),
+        "routed_fraction": round(len(routed) / len(results), 3) if results else None,
+        "routed_accuracy": accuracy(routed),
+        "results": results,
+    }
+
+
+# Command-line entry point: python router.py
+if __name__ == "__main__":
+    from evaluation import TEST_REQUESTS_PATH, load_scenarios
+    parser = argparse.ArgumentParser(description="Report query-routing accuracy on test scenarios.")
+    parser.add_argument("--scenarios", default=str(TEST_REQUESTS_PATH), help="path to test_requests.json")
+    args = parser.parse_args()
+    report = evaluate_routing(load_scenarios(args.scenarios))
+    for r in report["results"]:
+        print(f"{r['id']:<10} expected {r['expected']:<24} predicted {r['category']:<24} "
+              f"score {r['score']:.3f} margin {r['margin']:.3f} {'routed' if r['confident'] else 'unrouted'}")
+    print(json.dumps({k: v for k, v in report.items() if k != "results"}, indent=2))
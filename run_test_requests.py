@@ -1,28 +1,100 @@
-# Script to run all test requests against the /chat API endpoint
+# Script to run all test requests against the /chat API endpoint, concurrently
 import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from evaluation import load_scenarios, score_answer, percentiles
 
 # URL of the local API server
 API_URL = "http://localhost:8000/chat"
 
-# Load test scenarios from test_requests.json
-with open("test_requests.json", "r", encoding="utf-8") as f:
-    data = json.load(f)
-    test_requests = data["test_requests"]
 
-# Loop through each test scenario and send to API
-for req in test_requests:
+# Send one scenario to the /chat endpoint and score the answer
+def run_scenario(req: dict, api_url: str, top_k: int) -> dict:
     payload = {
         "question": req["request"],
-        "top_k": 5
+        "top_k": top_k
     }
-    # Send POST request to /chat endpoint
-    response = requests.post(API_URL, json=payload)
-    # Print test scenario and API response
-    print(f"Request: {req['request']}")
-    print(f"Expected classification: {req['expected_classification']}")
-    print(f"Expected elements: {req['expected_elements']}")
-    print(f"Escalate: {req['escalate']}")
-    print(f"API Response: {response.json()['answer']}")
-    print(f"Sources: {response.json()['sources']}")
-    print('-' * 80)
+    started = time.perf_counter()
+    try:
+        # Send POST request to /chat endpoint
+        response = requests.post(api_url, json=payload, timeout=120)
+        response.raise_for_status()
+        body = response.json()
+    except Exception as e:
+        return {"request": req, "error": str(e), "latency_ms": 1000 * (time.perf_counter() - started)}
+    return {
+        "request": req,
+        "answer": body["answer"],
+        "sources": body["sources"],
+        "latency_ms": 1000 * (time.perf_counter() - started),
+        **score_answer(body["answer"], req),
+    }
+
+
+# Send every scenario in one /chat/batch request and score the answers
+def run_batch(reqs: list[dict], api_url: str, top_k: int) -> list[dict]:
+    started = time.perf_counter()
+    try:
+        response = requests.post(f"{api_url.rstrip('/')}/batch",
+                                 json={"questions": [r["request"] for r in reqs], "top_k": top_k}, timeout=600)
+        response.raise_for_status()
+        items = response.json()["results"]
+    except Exception as e:
+        latency = 1000 * (time.perf_counter() - started)
+        return [{"request": r, "error": str(e), "latency_ms": latency} for r in reqs]
+    latency = 1000 * (time.perf_counter() - started)
+    results = []
+    for req, item in zip(reqs, items):
+        if item["error"]:
+            results.append({"request": req, "error": item["error"], "latency_ms": latency})
+            continue
+        results.append({"request": req, "answer": item["answer"], "sources": item["sources"],
+                        "latency_ms": latency, **score_answer(item["answer"], req)})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay test_requests.json against a running /chat API.")
+    parser.add_argument("--url", default=API_URL, help="chat endpoint URL")
+    parser.add_argument("--parallelism", type=int, default=4, help="requests in flight at once")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--batch", action="store_true", help="send all scenarios in one /chat/batch request")
+    args = parser.parse_args()
+
+    # Load test scenarios from test_requests.json
+    test_requests = load_scenarios()
+
+    wall_started = time.perf_counter()
+    if args.batch:
+        results = run_batch(test_requests, args.url, args.top_k)
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, args.parallelism)) as pool:
+            results = list(pool.map(lambda r: run_scenario(r, args.url, args.top_k), test_requests))
+    wall = time.perf_counter() - wall_started
+
+    # Print each test scenario and API response
+    for result in results:
+        req = result["request"]
+        print(f"Request: {req['request']}")
+        print(f"Expected classification: {req['expected_classification']}")
+        print(f"Expected elements: {req['expected_elements']}")
+        print(f"Escalate: {req['escalate']}")
+        if "error" in result:
+            print(f"Error: {result['error']}")
+        else:
+            print(f"API Response: {result['answer']}")
+            print(f"Sources: {result['sources']}")
+            print(f"Passed: {result['passed']} (classification={result['classification_correct']}, "
+                  f"escalation={result['escalation_correct']}, elements={result['element_recall']})")
+        print('-' * 80)
+
+    scored = [r for r in results if "error" not in r]
+    print(json.dumps({
+        "scenarios": len(results),
+        "errors": len(results) - len(scored),
+        "pass_rate": sum(r["passed"] for r in scored) / len(scored) if scored else None,
+        "wall_seconds": round(wall, 2),
+        "latency_ms": percentiles([r["latency_ms"] for r in results]),
+    }, indent=2))
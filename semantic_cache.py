@@ -0,0 +1,128 @@
+# Semantic answer cache: reuse LLM answers for near-duplicate questions
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    Bounded LRU/TTL cache of generated answers keyed on the query embedding.
+
+    A stored answer is served when a new question's embedding is within
+    `threshold` cosine similarity of a cached question AND retrieval returned
+    the same source chunks. Each chunk carries the `content_hash` written by
+    the indexer, so re-indexed content no longer matches; the server also
+    calls invalidate() with the documents that changed when the index does.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600, threshold: float = 0.92):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self._entries = OrderedDict()   # key -> entry dict, oldest first
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    # (parent_id, content_hash) pairs identifying the retrieved sources
+    @staticmethod
+    def fingerprint(metadatas: list[dict]) -> frozenset:
+        return frozenset((m.get("parent_id"), m.get("content_hash")) for m in metadatas)
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _expired(self, entry: dict, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - entry["created"] > self.ttl_seconds
+
+    def lookup(self, embedding, metadatas: list[dict]) -> str | None:
+        """
+        Return a cached answer for a semantically equivalent question, or None.
+        Args:
+            embedding: Query embedding of the new question.
+            metadatas (list[dict]): Metadata of the chunks retrieved for it.
+        """
+        if not self.enabled:
+            return None
+        query = self._normalize(embedding)
+        sources = self.fingerprint(metadatas)
+        now = time.monotonic()
+        with self._lock:
+            best_key, best_sim = None, self.threshold
+            for key, entry in list(self._entries.items()):
+                if self._expired(entry, now):
+                    del self._entries[key]
+                    self.evictions += 1
+                    continue
+                # Other chunks (even of the same documents) were retrieved: not the same context
+                if entry["sources"] != sources:
+                    continue
+                sim = float(np.dot(entry["embedding"], query))
+                if sim >= best_sim:
+                    best_key, best_sim = key, sim
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            return self._entries[best_key]["answer"]
+
+    def store(self, question: str, embedding, metadatas: list[dict], answer: str) -> None:
+        """Cache an answer, evicting the least recently used entry when full."""
+        # An answer generated without any retrieved sources is never reused
+        if not self.enabled or not metadatas:
+            return
+        sources = self.fingerprint(metadatas)
+        entry = {
+            "question": question,
+            "embedding": self._normalize(embedding),
+            "sources": sources,
+            "parents": {pid for pid, _h in sources},
+            "answer": answer,
+            "created": time.monotonic(),
+        }
+        with self._lock:
+            self._entries[self._next_key] = entry
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, parent_ids=None) -> int:
+        """Drop entries built from any of `parent_ids` (all entries when None)."""
+        with self._lock:
+            if parent_ids is None:
+                removed = len(self._entries)
+                self._entries.clear()
+            else:
+                parent_ids = set(parent_ids)
+                stale = [k for k, e in self._entries.items() if e["parents"] & parent_ids]
+                for key in stale:
+                    del self._entries[key]
+                removed = len(stale)
+            self.invalidations += removed
+            return removed
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
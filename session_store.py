@@ -0,0 +1,224 @@
+# Multi-turn conversations: bounded, expiring per-session state for /chat follow-ups
+#
+# Each session keeps its recent turns (older ones compacted into one-line digests), the
+# chunks retrieved for the last turn and a running topic embedding. A follow-up that restates
+# the question reuses the previous chunks outright; a follow-up on the same topic runs a
+# smaller search with the topic-blended embedding and merges it into the previous set; a
+# change of topic gets a fresh retrieval.
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import Counter
+
+# Sessions kept in memory (least recently used evicted first); 0 disables sessions
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))
+# Idle time after which a session is dropped
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "1800"))
+# Tokens of conversation history sent to the LLM; older turns are compacted beyond this
+SESSION_HISTORY_TOKENS = int(os.getenv("SESSION_HISTORY_TOKENS", "800"))
+# Similarity to the conversation topic (or the last question) above which the previous chunks are reused as-is
+SESSION_REUSE_SIMILARITY = float(os.getenv("SESSION_REUSE_SIMILARITY", "0.9"))
+# Similarity to the conversation topic above which a turn counts as a follow-up
+SESSION_TOPIC_SIMILARITY = float(os.getenv("SESSION_TOPIC_SIMILARITY", "0.35"))
+# Short questions with a back-reference ("that didn't work, what next?") are follow-ups too
+FOLLOWUP_MAX_WORDS = 10
+FOLLOWUP_CUES = {"it", "that", "this", "those", "them", "still", "again", "same", "next", "else", "also",
+                 "tried", "didn't", "doesn't", "won't", "work", "worked", "working", "then", "instead"}
+# Words of the previous answer kept in a compacted turn
+DIGEST_WORDS = 30
+
+SESSION_RETRIEVALS = Counter(
+    "helpdesk_session_retrievals_total", "Retrievals for follow-up turns of a session by action", ["action"])
+
+
+class Session:
+    """State of one conversation."""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.turns = []             # [{"question", "answer", "tokens"}], oldest first
+        self.digests = []           # one line per compacted older turn, oldest first
+        self.results = []           # (document chunk, metadata) pairs retrieved for the last turn
+        self.topic = None           # normalized running topic embedding
+        self.last_embedding = None  # normalized embedding of the last question
+        self.last_question = ""
+        self.updated = time.monotonic()
+
+    def history_messages(self) -> list[dict]:
+        """Chat messages for the earlier turns: the compacted digest first, then recent turns verbatim."""
+        messages = []
+        if self.digests:
+            messages.append({"role": "system", "content": "Earlier in this conversation:\n" + "\n".join(self.digests)})
+        for turn in self.turns:
+            messages.append({"role": "user", "content": turn["question"]})
+            messages.append({"role": "assistant", "content": turn["answer"]})
+        return messages
+
+
+def _normalize(embedding) -> np.ndarray:
+    vec = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+# True for short questions that refer back to the previous turn
+def is_followup(question: str) -> bool:
+    words = re.findall(r"[a-z']+", question.lower().replace("’", "'"))
+    return len(words) <= FOLLOWUP_MAX_WORDS and bool(FOLLOWUP_CUES.intersection(words))
+
+
+def plan_retrieval(session: Session | None, embedding, question: str,
+                   reuse_similarity: float = SESSION_REUSE_SIMILARITY,
+                   topic_similarity: float = SESSION_TOPIC_SIMILARITY) -> tuple[str, np.ndarray]:
+    """
+    Decide how to retrieve for a turn.
+    Args:
+        session (Session|None): The conversation so far (None or empty for a first turn).
+        embedding: Query embedding of the new question.
+        question (str): The new question.
+    Returns:
+        tuple[str, np.ndarray]: ("reuse" | "extend" | "fresh", embedding to search with).
+    """
+    query = _normalize(embedding)
+    if session is None or session.topic is None or not session.results:
+        return "fresh", query
+    similarity = float(np.dot(session.topic, query))
+    restated = session.last_embedding is not None and float(np.dot(session.last_embedding, query)) >= reuse_similarity
+    if similarity >= reuse_similarity or restated:
+        return "reuse", session.topic
+    if similarity >= topic_similarity or is_followup(question):
+        # Blend in the topic so vague follow-ups still search the conversation's subject
+        return "extend", _normalize(session.topic + query)
+    return "fresh", query
+
+
+# Chunks found for the follow-up first, then the previous turn's chunks, without duplicates
+def merge_results(new: list[tuple[str, dict]], previous: list[tuple[str, dict]], top_k: int) -> list[tuple[str, dict]]:
+    merged, seen = [], set()
+    for doc, meta in new + previous:
+        key = (meta.get("parent_id"), meta.get("chunk_index"), meta.get("content_hash"))
+        if key in seen:
+            continue
+        seen.add(key)
+        merged.append((doc, meta))
+    return merged[:top_k]
+
+
+# One-line summary of a compacted turn: the question and the start of the answer's response
+def digest_turn(question: str, answer: str) -> str:
+    category = re.search(r"Category:\s*(.+)", answer)
+    response = answer.split("Response:", 1)[-1]
+    words = response.split()
+    summary = " ".join(words[:DIGEST_WORDS]) + (" ..." if len(words) > DIGEST_WORDS else "")
+    label = f" [{category.group(1).strip()}]" if category else ""
+    return f"- User: {question.strip()}{label} -> Assistant: {summary}"
+
+
+class SessionStore:
+    """
+    Thread-safe LRU/TTL store of conversation sessions.
+
+    History is kept within `history_tokens`: the oldest verbatim turns are folded into
+    one-line digests, and the digests themselves are capped at a quarter of the budget.
+    """
+
+    def __init__(self, max_sessions: int = SESSION_MAX_SESSIONS, ttl_seconds: float = SESSION_TTL_SECONDS,
+                 history_tokens: int = SESSION_HISTORY_TOKENS, count_tokens=None):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.history_tokens = history_tokens
+        if count_tokens is None:
+            from tokenizer import n_tokens as count_tokens
+        self.count_tokens = count_tokens
+        self._sessions = OrderedDict()  # session_id -> Session, least recently used first
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_sessions > 0
+
+    def _expired(self, session: Session, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - session.updated > self.ttl_seconds
+
+    def get(self, session_id: str) -> Session | None:
+        """Return the live session with this id, or None (unknown or expired)."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if self._expired(session, time.monotonic()):
+                del self._sessions[session_id]
+                self.expirations += 1
+                return None
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def record_turn(self, session_id: str, question: str, answer: str, embedding, results: list[tuple[str, dict]],
+                    topic=None) -> Session | None:
+        """
+        Append a finished turn to a session (created on first use).
+        Args:
+            question (str): The user's question.
+            answer (str): The generated answer (unformatted).
+            embedding: Query embedding of the question.
+            results (list[tuple[str, dict]]): Chunks the answer was generated from.
+            topic: Embedding retrieval searched with (default: `embedding`); becomes the session topic.
+        """
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        turn = {"question": question, "answer": answer,
+                "tokens": self.count_tokens(question) + self.count_tokens(answer)}
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or self._expired(session, now):
+                session = self._sessions[session_id] = Session(session_id)
+            self._sessions.move_to_end(session_id)
+            session.turns.append(turn)
+            session.results = list(results)
+            session.last_embedding = _normalize(embedding)
+            session.topic = session.last_embedding if topic is None else _normalize(topic)
+            session.last_question = question
+            session.updated = now
+            self._compact(session)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+            return session
+
+    # Fold the oldest turns into digests until the history fits the token budget
+    def _compact(self, session: Session) -> None:
+        digest_budget = self.history_tokens // 4
+        def history_tokens():
+            return sum(t["tokens"] for t in session.turns) + sum(self.count_tokens(d) for d in session.digests)
+        while len(session.turns) > 1 and history_tokens() > self.history_tokens:
+            oldest = session.turns.pop(0)
+            session.digests.append(digest_turn(oldest["question"], oldest["answer"]))
+            while len(session.digests) > 1 and sum(self.count_tokens(d) for d in session.digests) > digest_budget:
+                session.digests.pop(0)
+
+    def end(self, session_id: str) -> bool:
+        """Forget a session; returns whether it existed."""
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "max_sessions": self.max_sessions,
+            "turns": sum(len(s.turns) + len(s.digests) for s in sessions),
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "retrievals": {action: SESSION_RETRIEVALS.value(action=action) for action in ("fresh", "extend", "reuse")},
+        }
@@ -68,4 +68,682 @@ def test_responder_module():
 def test_retriever_module():
     """Test that retriever.py has sanitize_meta function."""
     import retriever
-    assert hasattr(retriever, "sanitize_meta")
\ No newline at end of file
+    assert hasattr(retriever, "sanitize_meta")
+
+def test_plan_index_update_only_touches_changed_chunks():
+    """Test that the incremental indexer skips unchanged docs and removes orphans."""
+    from retriever import plan_index_update, MODEL_NAME, CHUNK_TOKENS
+    doc_a = {"id": "a_v1", "meta": {"title": "A"}, "body": "Alpha steps.", "source": "a.json"}
+    doc_b = {"id": "b_v1", "meta": {"title": "B"}, "body": "Bravo steps.", "source": "b.json"}
+    first = plan_index_update([doc_a, doc_b], {"model": MODEL_NAME, "chunk_tokens": CHUNK_TOKENS, "documents": {}})
+    assert (first["added"], first["updated"], first["skipped"], first["removed"]) == (2, 0, 0, 0)
+
+    manifest = {"documents": first["documents"]}
+    doc_a_changed = {**doc_a, "body": "Alpha steps, revised."}
+    second = plan_index_update([doc_a_changed], manifest)
+    assert [r["id"] for r in second["upsert"]] == ["a_v1#0"]
+    assert (second["added"], second["updated"], second["skipped"], second["removed"]) == (0, 1, 0, 1)
+    assert second["delete"] == ["b_v1#0"]
+
+
+def test_index_manifest_is_stale_for_another_encoder_backend(tmp_path):
+    """Test that a manifest written by a different encoder backend forces a full re-index."""
+    import json
+    import retriever
+    from encoder import active_backend
+    path = tmp_path / "index_manifest.json"
+    documents = {"kb_v1": {"hash": "d1", "chunks": {"kb_v1#0": "c1"}}}
+    retriever.save_manifest({"version": retriever.MANIFEST_VERSION, "model": retriever.MODEL_NAME,
+                             "chunk_tokens": retriever.CHUNK_TOKENS,
+                             "chunk_overlap": retriever.CHUNK_OVERLAP_TOKENS, "documents": documents}, path)
+    assert json.loads(path.read_text(encoding="utf-8"))["backend"] == active_backend()
+    assert retriever.load_manifest(path)["documents"] == documents
+
+    other = "onnx-fp32" if active_backend() == "torch" else "torch"
+    path.write_text(json.dumps({**json.loads(path.read_text(encoding="utf-8")), "backend": other}), encoding="utf-8")
+    stale = retriever.load_manifest(path)
+    assert stale["documents"] == {} and stale["stale_chunk_ids"] == ["kb_v1#0"]
+
+
+def test_api_falls_back_to_bm25_when_the_index_backend_differs(monkeypatch):
+    """Test that a collection embedded by another encoder backend is searched with BM25 only."""
+    import Api_server
+    import query
+    from encoder import MODEL_NAME, active_backend
+    searched = []
+    monkeypatch.setattr(query, "search", lambda q, top_k, category, embedding, mode, routes=None:
+                        searched.append((mode, routes)) or [])
+    monkeypatch.setattr(query, "search_many", lambda qs, embeddings, top_k, category, mode, routes=None:
+                        searched.append((mode, routes)) or [[] for _q in qs])
+    monkeypatch.setattr(query, "route_query", lambda embedding: ["network"])
+
+    Api_server.check_embedding_space((MODEL_NAME, "not-" + active_backend()))
+    try:
+        assert "backend" in query.dense_search_disabled()
+        query.query_helpdesk("vpn drops", mode="hybrid", query_embedding=[1.0], route=True)
+        query.query_helpdesk_batch(["vpn drops"], mode="vector", query_embeddings=[[1.0]], route=True)
+        assert searched == [("bm25", None), ("bm25", None)]
+    finally:
+        Api_server.check_embedding_space((MODEL_NAME, active_backend()))
+    assert query.dense_search_disabled() is None
+    query.query_helpdesk("vpn drops", mode="hybrid", query_embedding=[1.0], route=False)
+    assert searched[-1] == ("hybrid", None)
+
+
+def test_semantic_cache_hits_and_invalidates_on_reindex():
+    """Test that the semantic cache matches near-duplicates and drops entries whose chunks changed."""
+    from semantic_cache import SemanticCache
+    cache = SemanticCache(max_entries=2, ttl_seconds=0, threshold=0.9)
+    metas = [{"parent_id": "password_reset_troubleshoot_v1", "content_hash": "h1"}]
+    cache.store("forgot my password", [1.0, 0.0, 0.1], metas, "answer")
+    assert cache.lookup([0.98, 0.0, 0.12], metas) == "answer"
+    assert cache.lookup([0.0, 1.0, 0.0], metas) is None
+    # Another chunk of the same document is a different context, not a re-index
+    reindexed = [{"parent_id": "password_reset_troubleshoot_v1", "content_hash": "h2"}]
+    assert cache.lookup([1.0, 0.0, 0.1], reindexed) is None
+    assert cache.lookup([1.0, 0.0, 0.1], metas) == "answer"
+    assert cache.invalidate(["password_reset_troubleshoot_v1"]) == 1
+    assert cache.lookup([1.0, 0.0, 0.1], metas) is None
+    assert cache.stats()["invalidations"] == 1
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_micro_batcher_groups_concurrent_requests():
+    """Test that concurrent submissions are embedded together and fanned back out in order."""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from encoder import MicroBatcher
+    calls = []
+
+    def fake_encode(texts):
+        calls.append(list(texts))
+        return [[float(len(t))] for t in texts]
+
+    questions = ["vpn", "outlook", "wifi", "vpn"]
+    # The window is far longer than the test, so the batch is flushed only once all four are queued
+    batcher = MicroBatcher(fake_encode, max_batch_size=len(questions), max_wait_ms=60_000)
+    start = threading.Barrier(len(questions))
+
+    def embed(question):
+        start.wait()
+        return batcher.embed(question, timeout=10)
+
+    with ThreadPoolExecutor(max_workers=len(questions)) as pool:
+        vectors = list(pool.map(embed, questions))
+    assert vectors == [[3.0], [7.0], [4.0], [3.0]]
+    assert len(calls) < len(questions)
+    assert len(calls) == 1 and sorted(calls[0]) == ["outlook", "vpn", "wifi"]
+    stats = batcher.stats()
+    assert stats["items"] == 4
+    assert stats["max_batch_size"] == 4
+
+
+def test_bm25_exact_token_match_and_rrf():
+    """Test that BM25 ranks exact issue-key/app-name matches first and RRF merges rankings."""
+    from bm25 import BM25Index, reciprocal_rank_fusion
+    index = BM25Index.build(
+        ["vpn#0", "outlook#0", "wifi#0"],
+        ["Issue Key: vpn_connection. Restart the VPN client.",
+         "Configure Outlook with IMAP settings.",
+         "Forget and reconnect to TechCorp-WiFi."],
+        [{"category": "troubleshooting"}, {"category": "installation_guide"}, {"category": "troubleshooting"}],
+    )
+    top = index.search("Outlook keeps asking for settings", top_k=1)
+    assert index.ids[top[0][0]] == "outlook#0"
+    assert index.search("Outlook", top_k=3, where={"category": "troubleshooting"}) == []
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "c", "a"]])
+    assert fused[0][0] == "b"
+
+
+def test_pack_context_dedupes_merges_and_respects_budget():
+    """Test that the context packer merges same-parent chunks, drops duplicates and honours the budget."""
+    from context_packer import pack_context
+    results = [
+        ("Go to https://password.techcorp.com and enter your email.", {"parent_id": "pw", "chunk_index": 0}),
+        ("Check email for the reset link.", {"parent_id": "pw", "chunk_index": 1}),
+        ("Go to https://password.techcorp.com and enter your email.", {"parent_id": "pw", "chunk_index": 0}),
+        ("Restart the VPN client and try again.", {"parent_id": "vpn", "chunk_index": 0}),
+    ]
+    passages, used = pack_context(results, max_tokens=1000)
+    assert len(passages) == 2
+    assert passages[0].startswith("Go to") and "reset link" in passages[0]
+    assert used > 0
+    tight, tight_used = pack_context(results, max_tokens=25)
+    assert len(tight) == 1 and tight_used <= 25
+
+
+def test_html_stream_formatter_matches_batch_formatting():
+    """Test that incremental HTML formatting of streamed deltas equals formatting the full answer."""
+    from Api_server import HtmlStreamFormatter, format_answer
+    deltas = ["Category: password_reset\n", "\nResponse:\n1. Go", " to the portal\n", "\n\nEscalation Required: No"]
+    formatter = HtmlStreamFormatter()
+    streamed = "".join(formatter.feed(d) for d in deltas) + formatter.flush()
+    assert streamed == format_answer("".join(deltas), "html")
+
+
+def test_system_prompt_static_prefix_is_cached_and_precedes_context():
+    """Test that the static prompt prefix is reused across calls and the context comes after it."""
+    import responder
+    first = responder.build_messages("q1", ["context one"])[0]["content"]
+    second = responder.build_messages("q2", ["context two"])[0]["content"]
+    prefix = responder.get_static_prefix()
+    assert first.startswith(prefix) and second.startswith(prefix)
+    assert first[len(prefix):].lstrip().startswith("<CONTEXT>\ncontext one")
+    assert any(c.name == "password_reset" for c in responder.get_categories())
+
+
+def test_score_answer_checks_classification_elements_and_escalation():
+    """Test that evaluation scoring parses the formatted answer and checks expectations."""
+    from evaluation import score_answer, percentiles
+    scenario = {
+        "expected_classification": "password_reset",
+        "expected_elements": ["self-service portal", "company.com/reset", "account lockout"],
+        "escalate": False,
+    }
+    answer = ("Category: password_reset\n\nResponse:\nUse the self-service portal at company.com/reset.\n\n"
+              "Escalation Required: No")
+    score = score_answer(answer, scenario)
+    assert score["classification_correct"] and score["escalation_correct"]
+    assert score["missing_elements"] == ["account lockout"]
+    assert score["passed"]
+    assert percentiles([3, 1, 2, 4], qs=(50, 99)) == {"p50": 2, "p99": 4}
+
+
+def test_retriever_import_is_side_effect_free_and_corpus_loads_lazily():
+    """Test that importing retriever/query does no I/O and the corpus loads from a configurable dir."""
+    import subprocess
+    import sys
+    from pathlib import Path
+    import retriever
+    fresh_import = ("import sys, retriever, query; "
+                    "assert query._collection is None and retriever._corpus is None; "
+                    "assert 'chromadb' not in sys.modules and 'sentence_transformers' not in sys.modules; "
+                    "assert 'tiktoken' not in sys.modules and callable(getattr(retriever, 'get_encoder'))")
+    subprocess.run([sys.executable, "-c", fresh_import], cwd=Path(__file__).parent, check=True)
+    docs = retriever.load_corpus(Path(__file__).parent / "knowledge")
+    ids = {d["id"] for d in docs}
+    assert "password_reset_troubleshoot_v1" in ids
+    assert "knowledge_base_v1" in ids
+
+
+def test_chunk_body_single_pass_respects_budget_and_overlap():
+    """Test that the single-pass chunker stays within max_tokens, cuts at boundaries and overlaps."""
+    from retriever import chunk_body, chunk_bodies
+    from tokenizer import n_tokens
+    body = " ".join(f"Step {i}: restart the network adapter and check the cable." for i in range(40))
+    chunks = chunk_body(body, max_tokens=50)
+    assert len(chunks) > 1
+    assert all(n_tokens(c) <= 50 for c in chunks)
+    assert all(c.endswith(".") for c in chunks)
+    overlapped = chunk_body(body, max_tokens=50, overlap=15)
+    assert len(overlapped) > len(chunks)
+    assert overlapped[1].split(".")[0] in overlapped[0]
+    counted = chunk_bodies([body, ""], max_tokens=50)
+    assert [text for text, _n in counted[0]] == chunks
+    assert counted[1] == [("", 0)]
+
+
+def test_metrics_render_prometheus_text_and_server_timing(monkeypatch):
+    """Test histogram exposition, label escaping and per-request span timings."""
+    import metrics
+    from metrics import Histogram, render, span, start_request_timings, server_timing_header
+    # Register into an empty registry so the test metric never shows up in the app's /metrics
+    monkeypatch.setattr(metrics, "_registry", [])
+    latency = Histogram("test_latency_seconds", "Test latency", ["route"], buckets=(0.1, 1.0))
+    latency.observe(0.05, route='/a"b')
+    latency.observe(0.5, route='/a"b')
+    text = render()
+    assert '# TYPE test_latency_seconds histogram' in text
+    assert 'test_latency_seconds_bucket{route="/a\\"b",le="0.1"} 1' in text
+    assert 'test_latency_seconds_bucket{route="/a\\"b",le="+Inf"} 2' in text
+    assert 'test_latency_seconds_count{route="/a\\"b"} 2' in text
+    assert text.count("# TYPE") == 1
+
+    timings = start_request_timings()
+    with span("context_packing"):
+        pass
+    assert set(timings) == {"context_packing"}
+    assert server_timing_header(timings).startswith("context_packing;dur=")
+
+
+def test_router_tags_chunks_and_routes_confident_queries(monkeypatch):
+    """Test index-time route tags, nearest-prototype prediction and the routed search filters."""
+    from router import assign_route, CategoryRouter, GENERAL_ROUTE
+    from query import build_filters
+    assert assign_route("password_reset_troubleshoot_v1", {}, "anything") == "password_reset"
+    assert assign_route("slack_install_v1", {"title": "Installing Slack"},
+                        "Download the installer and install the application, then update it.") == "software_installation"
+    assert assign_route("kb_v1", {}, "Welcome to the help desk.") == GENERAL_ROUTE
+
+    vectors = {"password reset": [1.0, 0.0, 0.0], "network connectivity": [0.0, 1.0, 0.0]}
+    def fake_embed(texts):
+        return [vectors[t.split(":")[0]] for t in texts]
+    router = CategoryRouter({"password_reset": "", "network_connectivity": ""}, min_score=0.5, min_margin=0.1)
+    router.fit(fake_embed, chunk_embeddings=[[0.8, 0.6, 0.0]], chunk_routes=["network_connectivity"])
+    assert router.predict([1.0, 0.0, 0.0]).category == "password_reset"
+    assert router.predict([1.0, 0.0, 0.0]).confident
+    assert not router.predict([0.0, 0.0, 1.0]).confident
+
+    class UntaggedCollection:
+        def get(self, include=(), limit=None, where=None):
+            assert where is None, "an untagged index must not be searched for routed chunks"
+            return {"ids": ["kb_v1#0"], "metadatas": [{"parent_id": "kb_v1"}], "embeddings": [[1.0, 0.0, 0.0]]}
+    import encoder
+    import query
+    import router as router_module
+    monkeypatch.setattr(encoder, "embed_texts", lambda texts: [[1.0, 0.0, 0.0] for _t in texts])
+    monkeypatch.setattr(query, "get_vector_store", UntaggedCollection)
+    router_module.reset_router()
+    try:
+        assert not router_module.get_router(UntaggedCollection()).tagged
+        assert query.route_query([1.0, 0.0, 0.0]) is None
+        assert router_module.ROUTING_DECISIONS.value(outcome="untagged_index") >= 1
+    finally:
+        router_module.reset_router()
+
+    chroma_where, bm25_where = build_filters(routes=["password_reset", GENERAL_ROUTE])
+    assert chroma_where == {"route": {"$in": ["password_reset", GENERAL_ROUTE]}}
+    assert bm25_where == {"route": ["password_reset", GENERAL_ROUTE]}
+    assert build_filters() == (None, None)
+
+
+def test_batch_generation_retries_transient_errors(monkeypatch):
+    """Test that /chat/batch generation backs off and retries timeouts, then gives up."""
+    import asyncio
+    import Api_server
+    calls = []
+
+    async def flaky(question, chunks, raise_errors=False):
+        calls.append(question)
+        if len(calls) < 3:
+            raise asyncio.TimeoutError()
+        return f"answer to {question}"
+
+    monkeypatch.setattr(Api_server, "agenerate_response", flaky)
+    monkeypatch.setattr(Api_server, "BATCH_RETRY_BASE_SECONDS", 0.001)
+    assert asyncio.run(Api_server.generate_with_retry("vpn", [])) == "answer to vpn"
+    assert len(calls) == 3
+
+    monkeypatch.setattr(Api_server, "BATCH_MAX_RETRIES", 1)
+    async def always_fails(question, chunks, raise_errors=False):
+        raise asyncio.TimeoutError()
+    monkeypatch.setattr(Api_server, "agenerate_response", always_fails)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(Api_server.generate_with_retry("vpn", []))
+
+
+def test_batch_retrieval_failure_sets_item_errors_without_generating(monkeypatch):
+    """Test that a failed batch search marks every question as failed instead of answering from no context."""
+    import asyncio
+    from types import SimpleNamespace
+    import Api_server
+
+    def broken_search(questions, top_k, **kwargs):
+        assert kwargs["raise_errors"] is True
+        raise ConnectionError("collection unavailable")
+
+    async def must_not_generate(*args, **kwargs):
+        raise AssertionError("generation ran without retrieved context")
+
+    monkeypatch.setattr(Api_server, "embed_and_query_batch", broken_search)
+    monkeypatch.setattr(Api_server, "agenerate_response", must_not_generate)
+    req = Api_server.BatchChatRequest(questions=["vpn drops", "", "outlook crashes"])
+    response = asyncio.run(Api_server.chat_batch(req, SimpleNamespace(query_params={})))
+    assert response.errors == 3
+    assert response.results[0].error == "Knowledge retrieval failed: ConnectionError: collection unavailable"
+    assert response.results[1].error == "Question cannot be empty."
+    assert all(item.answer is None for item in response.results)
+
+    cache = Api_server.SemanticCache(max_entries=4, ttl_seconds=0)
+    cache.store("vpn drops", [1.0, 0.0], [], "answer from no context")
+    assert cache.stats()["entries"] == 0
+
+
+def test_chat_endpoint_answers_through_the_stub_llm(monkeypatch):
+    """Test that StubLLM.agenerate is a drop-in for agenerate_response on /chat (as bench_pipeline uses it)."""
+    import asyncio
+    import httpx
+    import numpy as np
+    import Api_server
+    from evaluation import StubLLM
+    chunks = [("Reconnect the VPN client and check the token.", {"parent_id": "vpn", "chunk_index": 0, "content_hash": "a"})]
+    monkeypatch.setattr(Api_server, "embed_and_query",
+                        lambda question, top_k, session=None, **kwargs: (np.ones(4), chunks, "fresh", None))
+    monkeypatch.setattr(Api_server, "pack_context", lambda results, budget: ([doc for doc, _m in results], 10))
+    monkeypatch.setattr(Api_server, "response_cache", Api_server.SemanticCache(max_entries=4, ttl_seconds=0))
+    monkeypatch.setattr(Api_server, "agenerate_response", StubLLM().agenerate)
+
+    async def post():
+        transport = httpx.ASGITransport(app=Api_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/chat", json={"question": "My VPN keeps dropping", "top_k": 1})
+
+    response = asyncio.run(post())
+    assert response.status_code == 200
+    body = response.json()
+    assert "Reconnect the VPN client" in body["answer"] and body["sources"] == ["vpn"]
+
+
+def test_llm_gateway_coalesces_identical_requests_and_retries():
+    """Test that concurrent identical prompts share one upstream call and transient errors are retried."""
+    import asyncio
+    import httpx
+    import openai
+    from types import SimpleNamespace
+    from llm_gateway import LLMGateway, TokenBucket
+
+    calls = []
+
+    async def create(model, messages, **params):
+        calls.append(messages[-1]["content"])
+        await asyncio.sleep(0.01)
+        if messages[-1]["content"] == "flaky" and calls.count("flaky") == 1:
+            raise openai.APIConnectionError(request=httpx.Request("POST", "http://llm.local"))
+        return SimpleNamespace(usage=None, content=f"answer: {messages[-1]['content']}")
+
+    gateway = LLMGateway(api_key="test", rpm=0, tpm=0, max_retries=2)
+    gateway._async_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    async def run():
+        same = [{"role": "user", "content": "vpn"}]
+        first, second = await asyncio.gather(gateway.acomplete(same, model="m"), gateway.acomplete(same, model="m"))
+        flaky = await gateway.acomplete([{"role": "user", "content": "flaky"}], model="m")
+        return first, second, flaky
+
+    first, second, flaky = asyncio.run(run())
+    assert first is second
+    assert calls.count("vpn") == 1
+    assert flaky.content == "answer: flaky" and calls.count("flaky") == 2
+
+    bucket = TokenBucket(rate_per_minute=60, capacity=2)
+    assert bucket.reserve() == 0 and bucket.reserve() == 0
+    assert 0.9 < bucket.reserve() <= 1.0
+
+
+def test_astream_response_signals_a_broken_stream(monkeypatch):
+    """Test that a stream failing after some text raises instead of ending like a finished answer."""
+    import asyncio
+    from types import SimpleNamespace
+    import responder
+
+    def chunk(text):
+        return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+    def fake_astream(fail_after):
+        async def astream(messages, **params):
+            async def stream():
+                for text in ["Category: ", "Network"][:fail_after]:
+                    yield chunk(text)
+                raise ConnectionError("stream reset")
+            return stream()
+        return astream
+
+    async def collect():
+        return [delta async for delta in responder.astream_response("vpn", ["context"])]
+
+    monkeypatch.setattr(responder.gateway, "astream", fake_astream(fail_after=0))
+    assert asyncio.run(collect()) == [responder.FALLBACK_RESPONSE]
+    monkeypatch.setattr(responder.gateway, "astream", fake_astream(fail_after=1))
+    with pytest.raises(ConnectionError):
+        asyncio.run(collect())
+
+
+def test_llm_gateway_settles_streamed_token_reservations():
+    """Test that streams return over-reserved TPM tokens, whether they finish or break part-way."""
+    import asyncio
+    from types import SimpleNamespace
+    from llm_gateway import LLMGateway
+
+    def chunk(text=None, total_tokens=None):
+        usage = SimpleNamespace(total_tokens=total_tokens) if total_tokens else None
+        choices = [SimpleNamespace(delta=SimpleNamespace(content=text))] if text else []
+        return SimpleNamespace(usage=usage, choices=choices)
+
+    async def create(model, messages, stream, **params):
+        async def chunks():
+            yield chunk("a" * 40)
+            if messages[-1]["content"] == "broken":
+                raise ConnectionError("stream reset")
+            yield chunk(total_tokens=30)
+        return chunks()
+
+    # 600 tokens/minute refills 0.01 tokens per millisecond, so the balance barely moves during the test
+    gateway = LLMGateway(api_key="test", rpm=0, tpm=600)
+    gateway._async_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    async def consume(content):
+        stream = await gateway.astream([{"role": "user", "content": content}], model="m")
+        try:
+            async for _chunk in stream:
+                pass
+        except ConnectionError:
+            pass
+
+    asyncio.run(consume("ok"))
+    assert 600 - 30 <= gateway.tokens.tokens < 600 - 29
+    gateway.tokens.tokens = 600
+    asyncio.run(consume("broken"))
+    # No usage reported: the prompt estimate plus the 40 characters (10 tokens) streamed
+    prompt_estimate = len("broken") // 4
+    assert 600 - prompt_estimate - 10 <= gateway.tokens.tokens < 600 - prompt_estimate - 9
+
+
+# Runs ingest twice against an in-memory collection that rejects unpaged reads
+_INGEST_SCRIPT = """
+import json, os, sys
+sys.path.insert(0, os.getcwd())
+import numpy as np
+import ingest, retriever
+from bm25 import BM25Index
+
+class PagedCollection:
+    def __init__(self):
+        self.rows = {}
+    def upsert(self, ids, documents, embeddings, metadatas):
+        for row in zip(ids, documents, embeddings, metadatas):
+            self.rows[row[0]] = row
+    def delete(self, ids):
+        for chunk_id in ids:
+            self.rows.pop(chunk_id, None)
+    def get(self, include=(), limit=None, offset=0):
+        assert limit is not None and limit <= retriever.COLLECTION_PAGE_SIZE, "unpaged collection read"
+        rows = sorted(self.rows.values(), key=lambda row: row[0])[offset:offset + limit]
+        return {"ids": [r[0] for r in rows], "documents": [r[1] for r in rows],
+                "embeddings": [r[2] for r in rows], "metadatas": [r[3] for r in rows]}
+
+collection = PagedCollection()
+retriever.open_collection = lambda: collection
+retriever.embed_texts = lambda texts, **kwargs: np.ones((len(texts), 4), dtype=np.float32)
+retriever.COLLECTION_PAGE_SIZE = 16
+first = ingest.ingest(sys.argv[1], workers=2, batch_size=8)
+second = ingest.ingest(sys.argv[1], workers=2, batch_size=8)
+bm25 = BM25Index.load(retriever.BM25_PATH)
+print(json.dumps({"first": first, "second": second, "stored": len(collection.rows), "bm25": len(bm25),
+                  "top": bm25.ids[bm25.search("printer 7", top_k=1)[0][0]]}))
+"""
+
+
+def test_ingest_runs_end_to_end_and_reads_the_collection_in_pages(tmp_path):
+    """Test that ingest stores and keyword-indexes a corpus, re-runs incrementally and never reads the whole store at once."""
+    import json
+    import os
+    import subprocess
+    import sys
+    from pathlib import Path
+    knowledge = tmp_path / "knowledge"
+    knowledge.mkdir()
+    articles = [{"id": f"kb_{i}", "title": f"Printer {i}", "body": f"Printer {i} is offline. Restart the spooler."}
+                for i in range(40)]
+    (knowledge / "articles.jsonl").write_text("\n".join(json.dumps(a) for a in articles), encoding="utf-8")
+    script = tmp_path / "run_ingest.py"
+    script.write_text(_INGEST_SCRIPT, encoding="utf-8")
+    env = {**os.environ, "HELPDESK_DB_DIR": str(tmp_path / "store"), "VECTOR_BACKEND": "chroma"}
+    run = subprocess.run([sys.executable, str(script), str(knowledge)], cwd=Path(__file__).parent, env=env,
+                         capture_output=True, text=True)
+    assert run.returncode == 0, run.stderr
+    result = json.loads(run.stdout.strip().splitlines()[-1])
+    assert (result["first"]["documents"], result["first"]["added"]) == (40, 40)
+    assert (result["second"]["added"], result["second"]["updated"], result["second"]["skipped"]) == (0, 0, 40)
+    assert result["stored"] == result["bm25"] == 40
+    assert result["top"] == "kb_7#0"
+
+
+class _FakeCollection:
+    """Just enough of a Chroma collection for exporting: paged get()."""
+
+    def __init__(self, embeddings, metadatas, text="chunk {}"):
+        self.embeddings, self.metadatas, self.text = embeddings, metadatas, text
+
+    def get(self, include=(), limit=None, offset=0):
+        rows = range(offset, min(len(self.embeddings), offset + limit))
+        return {"ids": [f"c{i}" for i in rows], "documents": [self.text.format(i) for i in rows],
+                "metadatas": [self.metadatas[i] for i in rows], "embeddings": [self.embeddings[i] for i in rows]}
+
+
+@pytest.mark.parametrize("dtype,ivf_min_vectors", [("float16", 10**9), ("int8", 10**9), ("float16", 1)])
+def test_mmap_vector_index_matches_exact_search(tmp_path, monkeypatch, dtype, ivf_min_vectors):
+    """Test that the exported, quantized index finds the same neighbours as exact float32 search."""
+    import json
+    import numpy as np
+    import retriever
+    import vector_index
+    from encoder import active_backend
+    rows = 400
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(rows, 32)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    metas = [{"route": "network_connectivity" if i % 2 else "general"} for i in range(rows)]
+    monkeypatch.setattr(vector_index, "EXPORT_PAGE_SIZE", 150)
+    # The export is labelled with the backend recorded for the collection, and refused on a mismatch
+    manifest_path = tmp_path / "index_manifest.json"
+    other = "onnx-fp32" if active_backend() == "torch" else "torch"
+    manifest_path.write_text(json.dumps({"model": retriever.MODEL_NAME, "backend": other}), encoding="utf-8")
+    with pytest.raises(ValueError, match="embedded with"):
+        vector_index.export_index(_FakeCollection(vectors, metas), tmp_path / "vector_index",
+                                  manifest_path=manifest_path)
+    assert not (tmp_path / "vector_index").exists()
+    retriever.save_manifest({"model": retriever.MODEL_NAME, "documents": {}}, manifest_path)
+    manifest = vector_index.export_index(_FakeCollection(vectors, metas), tmp_path / "vector_index",
+                                         dtype=dtype, ivf_min_vectors=ivf_min_vectors, manifest_path=manifest_path)
+    assert manifest["count"] == rows and manifest["dtype"] == dtype
+    assert manifest["backend"] == active_backend()
+    index = vector_index.MmapVectorIndex(tmp_path / "vector_index", nprobe=4)
+
+    queries = vectors[:5] + 0.05 * rng.normal(size=(5, 32)).astype(np.float32)
+    results = index.search_many(queries, top_k=3)
+    for query, hits in zip(queries, results):
+        exact = np.argsort(vectors @ query)[::-1][:3]
+        assert hits[0][0] == f"c{exact[0]}"
+        assert hits[0][1] == f"chunk {exact[0]}"
+    filtered = index.search_many(queries[:1], top_k=5, where={"route": {"$in": ["network_connectivity"]}})[0]
+    assert len(filtered) == 5 and all(meta["route"] == "network_connectivity" for _id, _doc, meta in filtered)
+
+    # A re-export swaps the directory; the loaded index keeps serving the texts its offsets belong to
+    vector_index.export_index(_FakeCollection(vectors, metas, text="re-indexed chunk number {}"),
+                              tmp_path / "vector_index", dtype=dtype, ivf_min_vectors=ivf_min_vectors,
+                              manifest_path=manifest_path)
+    assert index.search_many(queries, top_k=3)[0][0][1] == results[0][0][1]
+    assert vector_index.MmapVectorIndex(tmp_path / "vector_index").document(0).startswith("re-indexed chunk")
+
+
+def test_canonical_answers_require_confident_unambiguous_match(tmp_path):
+    """Test that canonical answers are only served for a clear, current single-document match."""
+    import json
+    from canonical_answers import CanonicalAnswers
+    path = tmp_path / "canonical_answers.json"
+    path.write_text(json.dumps({"vpn_fix": {"hash": "d1", "chunk_hashes": ["c1"], "answer": "Category: vpn"}}))
+    answers = CanonicalAnswers(path, min_similarity=0.6, min_margin=0.1)
+
+    def hit(parent_id, similarity, chunk_hash="c1"):
+        return ("chunk", {"parent_id": parent_id, "similarity": similarity, "content_hash": chunk_hash})
+
+    assert answers.lookup([hit("vpn_fix", 0.8), hit("vpn_fix", 0.75), hit("wifi", 0.6)]) == ("vpn_fix", "Category: vpn")
+    assert answers.lookup([hit("vpn_fix", 0.8), hit("wifi", 0.75)]) is None       # ambiguous
+    assert answers.lookup([hit("vpn_fix", 0.5)]) is None                          # too far
+    assert answers.lookup([hit("vpn_fix", 0.8, chunk_hash="c2")]) is None         # re-indexed content
+    assert answers.lookup([hit("wifi", 0.9)]) is None                             # no canonical answer
+    assert answers.stats()["hits"] == 1 and answers.stats()["bypass_rate"] == 0.2
+
+    # Hybrid results: a BM25-only runner-up has no similarity, and the RRF winner may not be the closest chunk
+    bm25_only = ("chunk", {"parent_id": "wifi", "content_hash": "w1"})
+    assert answers.lookup([hit("vpn_fix", 0.8), bm25_only]) is None
+    assert answers.lookup([hit("wifi", 0.75), hit("vpn_fix", 0.8)]) is None       # dense lead too small
+    assert answers.lookup([hit("wifi", 0.5), hit("vpn_fix", 0.8)]) == ("vpn_fix", "Category: vpn")
+
+
+def test_session_followups_reuse_retrieval_and_compact_history():
+    """Test that follow-ups reuse/extend the previous retrieval and old turns are compacted."""
+    import numpy as np
+    from session_store import SessionStore, plan_retrieval, merge_results
+    store = SessionStore(max_sessions=2, ttl_seconds=0, history_tokens=60, count_tokens=lambda s: len(s.split()))
+    vpn, wifi = np.eye(4)[0], np.eye(4)[1]
+    chunks = [("Reconnect the VPN client", {"parent_id": "vpn", "chunk_index": 0, "content_hash": "a"})]
+
+    assert plan_retrieval(store.get("s1"), vpn, "VPN keeps dropping")[0] == "fresh"
+    store.record_turn("s1", "VPN keeps dropping", "Category: network\n\nResponse:\nReconnect.", vpn, chunks)
+    session = store.get("s1")
+    assert plan_retrieval(session, vpn, "My VPN keeps dropping")[0] == "reuse"
+    assert plan_retrieval(session, wifi, "That didn't work, what next?")[0] == "extend"
+    assert plan_retrieval(session, wifi, "How do I request a new monitor for my desk at home?")[0] == "fresh"
+    new = [("Check Wi-Fi", {"parent_id": "wifi", "chunk_index": 0, "content_hash": "b"})]
+    assert [m["parent_id"] for _d, m in merge_results(new + chunks, chunks, 5)] == ["wifi", "vpn"]
+
+    for i in range(5):
+        store.record_turn("s1", f"follow-up question {i}", "Category: network\n\nResponse:\n" + "step " * 20, vpn, chunks)
+    session = store.get("s1")
+    history = session.history_messages()
+    assert session.digests and history[0]["role"] == "system"
+    assert sum(t["tokens"] for t in session.turns) <= 60
+    assert history[-1] == {"role": "assistant", "content": session.turns[-1]["answer"]}
+
+    store.record_turn("s2", "q", "a", vpn, chunks)
+    store.record_turn("s3", "q", "a", vpn, chunks)
+    assert store.get("s1") is None and store.stats()["evictions"] == 1
+
+
+def test_admission_control_prioritises_chat_and_sheds_excess():
+    """Test that queued chat is admitted before batch traffic and excess load is shed with Retry-After."""
+    import asyncio
+    from admission import AdmissionController, RouteClass, Rejected
+    classes = {"interactive": RouteClass(0, 2, 0.05), "batch": RouteClass(1, 1, 1.0)}
+
+    async def run():
+        admission = AdmissionController(classes, max_concurrent=2, queue_size=2)
+        await admission.acquire("interactive")
+        await admission.acquire("batch")
+        order = []
+
+        async def request(route_class):
+            try:
+                await admission.acquire(route_class)
+            except Rejected as e:
+                order.append((route_class, e.reason, e.retry_after >= 1))
+                return
+            order.append(route_class)
+
+        batch = asyncio.create_task(request("batch"))
+        await asyncio.sleep(0)
+        chat = asyncio.create_task(request("interactive"))
+        await asyncio.sleep(0)
+        # Queue is full; a new chat request preempts the queued batch request
+        late_chat = asyncio.create_task(request("interactive"))
+        await asyncio.sleep(0)
+        admission.release("batch")
+        await asyncio.gather(batch, chat, late_chat)
+        return order, admission.stats()
+
+    order, stats = asyncio.run(run())
+    assert order[0] == ("batch", "preempted", True)
+    assert order[1] == "interactive"
+    assert order[2] == ("interactive", "queue_timeout", True)
+    assert stats["shed"] == 2 and stats["classes"]["interactive"]["in_flight"] == 2
+
+
+def test_onnx_mean_pool_ignores_padding():
+    """Test that ONNX pooling averages only real tokens and returns unit vectors, like SentenceTransformer."""
+    import numpy as np
+    from onnx_encoder import mean_pool
+    hidden = np.array([[[3.0, 4.0], [3.0, 4.0], [100.0, -100.0]]], dtype=np.float32)
+    pooled = mean_pool(hidden, np.array([[1, 1, 0]]))
+    assert np.allclose(pooled, [[0.6, 0.8]])
+    assert np.allclose(mean_pool(hidden, np.array([[1, 1, 0]]), normalize=False), [[3.0, 4.0]])
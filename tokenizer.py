@@ -0,0 +1,23 @@
+# Shared tiktoken tokenizer used for chunking (retriever) and prompt budgeting (context_packer)
+from functools import lru_cache
+
+ENCODING_NAME = "cl100k_base"
+
+
+# Load the tiktoken encoding on first use (it is slow to build and may download its BPE file)
+@lru_cache(maxsize=None)
+def get_encoder():
+    import tiktoken
+    return tiktoken.get_encoding(ENCODING_NAME)
+
+
+# Count tokens in a string
+def n_tokens(text: str) -> int:
+    return len(get_encoder().encode(text))
+
+
+# Keep `tokenizer.ENCODER` working without loading tiktoken at import time
+def __getattr__(name):
+    if name == "ENCODER":
+        return get_encoder()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
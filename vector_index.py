@@ -0,0 +1,342 @@
+# Read-only vector index over memory-mapped, quantized embeddings (alternative to Chroma for serving)
+#
+#   chroma_store/vector_index/
+#       index.json        format, dtype, model, encoder backend, vector count/dimension, IVF layout
+#       embeddings.npy    float16 or int8 vectors (rows grouped by IVF list when IVF is used)
+#       scales.npy        per-row dequantization scales (int8 only)
+#       centroids.npy     IVF list centroids, list_offsets.npy  row range of each list
+#       meta.jsonl        [chunk id, metadata] per line, in collection order
+#       documents.jsonl   chunk texts, one JSON string per line; doc_offsets.npy  byte offsets
+#       order.npy         line of meta.jsonl / documents.jsonl behind each row of embeddings.npy
+#
+# The arrays are opened with mmap, so every API worker on a box shares one copy through the
+# OS page cache and startup costs a few file opens rather than a Chroma client per process.
+# Exports stream each page of the collection to disk, so the exporter never holds the corpus.
+import argparse
+import array
+import mmap
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+# "chroma" (default) or "mmap" to serve dense search from the exported index
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+INDEX_DIR = Path(os.getenv("HELPDESK_DB_DIR", "chroma_store")) / "vector_index"
+INDEX_FORMAT_VERSION = 2
+# Storage dtype for exported vectors: "int8" (4x smaller than float32, fastest to scan) or "float16"
+VECTOR_INDEX_DTYPE = os.getenv("VECTOR_INDEX_DTYPE", "int8")
+# Use IVF (inverted lists) above this many vectors; brute force below
+IVF_MIN_VECTORS = int(os.getenv("IVF_MIN_VECTORS", "50000"))
+# IVF lists probed per query
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "8"))
+# Rows scored per block; small enough that each converted float32 block stays in CPU cache
+SEARCH_BLOCK_ROWS = 8192
+EXPORT_PAGE_SIZE = 5000
+
+
+# Per-row symmetric int8 quantization: x ≈ q * scale
+def quantize_int8(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+# Plain k-means on a sample; returns (centroids, list assignment of every vector)
+def train_ivf(vectors: np.ndarray, n_lists: int, iterations: int = 10, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), size=min(len(vectors), n_lists * 64), replace=False)]
+    centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = sample[assignment == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    assignment = np.concatenate([
+        np.argmax(vectors[i:i + SEARCH_BLOCK_ROWS] @ centroids.T, axis=1)
+        for i in range(0, len(vectors), SEARCH_BLOCK_ROWS)
+    ])
+    return centroids.astype(np.float32), assignment
+
+
+# Metadata filter in the Chroma `where` dialect used by query.build_filters ($eq, $ne, $in, $and)
+def matches(meta: dict, where: dict | None) -> bool:
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches(meta, clause) for clause in condition):
+                return False
+            continue
+        value = meta.get(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, expected in condition.items():
+            if op == "$eq" and value != expected:
+                return False
+            if op == "$ne" and value == expected:
+                return False
+            if op == "$in" and value not in expected:
+                return False
+    return True
+
+
+def export_index(collection, path: Path = INDEX_DIR, dtype: str = VECTOR_INDEX_DTYPE,
+                 ivf_min_vectors: int = IVF_MIN_VECTORS, manifest_path: Path | None = None) -> dict:
+    """
+    Export every chunk of a Chroma collection into the memory-mapped index format.
+    Args:
+        collection: Chroma collection to read (embeddings, documents, metadatas).
+        path (Path): Target directory; replaced atomically so live readers never see a partial index.
+        dtype (str): "float16" or "int8".
+        ivf_min_vectors (int): Build IVF lists when the collection has at least this many vectors.
+        manifest_path (Path|None): Index manifest recording the model/backend that embedded the
+            collection (default: retriever.MANIFEST_PATH).
+    Returns:
+        dict: The written index.json manifest.
+    Raises:
+        ValueError: The collection was embedded with another model or encoder backend than this process uses.
+    """
+    import retriever
+    from encoder import MODEL_NAME, active_backend
+    if dtype not in ("float16", "int8"):
+        raise ValueError(f"Unknown vector index dtype {dtype!r}; expected 'float16' or 'int8'")
+    # Label the export with what embedded the collection, not with this process's settings
+    manifest_path = manifest_path or retriever.MANIFEST_PATH
+    space = retriever.indexed_embedding_space(manifest_path)
+    if space is None:
+        raise ValueError(f"No index manifest at {manifest_path}; build the vector store first")
+    if space != (MODEL_NAME, active_backend()):
+        raise ValueError(f"The collection was embedded with {space[0]} ({space[1]}) but this process uses "
+                         f"{MODEL_NAME} ({active_backend()}); export with matching EMBEDDING_MODEL/"
+                         f"ENCODER_BACKEND or re-index first")
+    tmp = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    # Pass 1: append each page's normalized float32 vectors, texts and metadata to files in `tmp`
+    raw_path = tmp / "vectors.f32"
+    doc_offsets = array.array("q")
+    count, dim, offset = 0, 0, 0
+    with open(raw_path, "wb") as raw, open(tmp / "documents.jsonl", "wb") as docs, \
+            open(tmp / "meta.jsonl", "w", encoding="utf-8") as metas:
+        while True:
+            page = collection.get(include=["embeddings", "documents", "metadatas"],
+                                  limit=EXPORT_PAGE_SIZE, offset=offset)
+            if not page["ids"]:
+                break
+            block = np.asarray(page["embeddings"], dtype=np.float32)
+            # Cosine similarity as a dot product
+            block /= np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+            raw.write(block.tobytes())
+            for chunk_id, meta, text in zip(page["ids"], page["metadatas"], page["documents"]):
+                doc_offsets.append(docs.tell())
+                docs.write(json.dumps(text).encode("utf-8") + b"\n")
+                metas.write(json.dumps([chunk_id, meta]) + "\n")
+            count, dim = count + len(block), block.shape[1]
+            offset += len(page["ids"])
+    if not count:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise ValueError("Cannot export an empty collection; build the vector store first")
+    vectors = np.memmap(raw_path, dtype=np.float32, mode="r", shape=(count, dim))
+
+    manifest = {"version": INDEX_FORMAT_VERSION, "dtype": dtype, "model": space[0],
+                "backend": space[1], "count": count,
+                "dim": dim, "ivf_lists": 0, "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    order = np.arange(count, dtype=np.int64)
+    if count >= ivf_min_vectors:
+        n_lists = int(np.sqrt(count))
+        centroids, assignment = train_ivf(vectors, n_lists)
+        order = np.argsort(assignment, kind="stable").astype(np.int64)
+        counts = np.bincount(assignment, minlength=n_lists)
+        np.save(tmp / "centroids.npy", centroids)
+        np.save(tmp / "list_offsets.npy", np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+        manifest["ivf_lists"] = n_lists
+
+    # Pass 2: write the stored vectors in row order, one block at a time
+    stored = np.lib.format.open_memmap(tmp / "embeddings.npy", mode="w+",
+                                       dtype=np.int8 if dtype == "int8" else np.float16, shape=(count, dim))
+    scales = np.lib.format.open_memmap(tmp / "scales.npy", mode="w+", dtype=np.float32,
+                                       shape=(count,)) if dtype == "int8" else None
+    for start in range(0, count, SEARCH_BLOCK_ROWS):
+        block = np.asarray(vectors[order[start:start + SEARCH_BLOCK_ROWS]])
+        if scales is not None:
+            stored[start:start + len(block)], scales[start:start + len(block)] = quantize_int8(block)
+        else:
+            stored[start:start + len(block)] = block.astype(np.float16)
+    stored.flush()
+    if scales is not None:
+        scales.flush()
+    del stored, scales, vectors
+    raw_path.unlink()
+
+    np.save(tmp / "order.npy", order)
+    np.save(tmp / "doc_offsets.npy", np.frombuffer(doc_offsets, dtype=np.int64))
+    (tmp / "index.json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+
+    # Swap directories; readers reload when index.json changes
+    old = path.with_name(path.name + ".old")
+    shutil.rmtree(old, ignore_errors=True)
+    if path.exists():
+        os.replace(path, old)
+    os.replace(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+    print(f"Vector index exported: {manifest['count']} {dtype} vectors → {path}")
+    return manifest
+
+
+class MmapVectorIndex:
+    """Cosine-similarity search over an exported index; safe to share between threads."""
+
+    def __init__(self, path: Path = INDEX_DIR, nprobe: int = IVF_NPROBE):
+        self.path = Path(path)
+        self.manifest = json.loads((self.path / "index.json").read_text(encoding="utf-8"))
+        self.nprobe = nprobe
+        self.vectors = np.load(self.path / "embeddings.npy", mmap_mode="r")
+        self.scales = np.load(self.path / "scales.npy", mmap_mode="r") if self.manifest["dtype"] == "int8" else None
+        self.centroids, self.list_offsets = None, None
+        if self.manifest["ivf_lists"]:
+            self.centroids = np.load(self.path / "centroids.npy")
+            self.list_offsets = np.load(self.path / "list_offsets.npy")
+        self.order = np.load(self.path / "order.npy")
+        with open(self.path / "meta.jsonl", encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f]
+        self.ids = [lines[i][0] for i in self.order]
+        self.metadatas = [lines[i][1] for i in self.order]
+        self.doc_offsets = np.load(self.path / "doc_offsets.npy", mmap_mode="r")
+        # Mapped once: a later export swaps in a new directory, but this mapping keeps reading
+        # the documents file these offsets were written for
+        with open(self.path / "documents.jsonl", "rb") as f:
+            self._documents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._masks = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def document(self, row: int) -> str:
+        start = int(self.doc_offsets[self.order[row]])
+        return json.loads(self._documents[start:self._documents.find(b"\n", start)])
+
+    # Boolean row mask for a metadata filter (computed once per distinct filter)
+    def _mask(self, where: dict) -> np.ndarray:
+        key = json.dumps(where, sort_keys=True)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = np.fromiter((matches(m, where) for m in self.metadatas), dtype=bool, count=len(self.metadatas))
+            with self._lock:
+                self._masks[key] = mask
+        return mask
+
+    # Similarities of rows [start, stop) to each query (queries: q x dim float32)
+    def _scores(self, queries: np.ndarray, start: int, stop: int) -> np.ndarray:
+        block = np.asarray(self.vectors[start:stop], dtype=np.float32)
+        scores = queries @ block.T
+        if self.scales is not None:
+            scores *= np.asarray(self.scales[start:stop])
+        return scores
+
+    # Row ranges to scan for one query: every row, or the nprobe nearest IVF lists
+    def _ranges(self, query: np.ndarray) -> list[tuple[int, int]]:
+        if self.centroids is None:
+            return [(i, min(i + SEARCH_BLOCK_ROWS, len(self))) for i in range(0, len(self), SEARCH_BLOCK_ROWS)]
+        nearest = np.argsort(self.centroids @ query)[::-1][:self.nprobe]
+        return [(int(self.list_offsets[i]), int(self.list_offsets[i + 1])) for i in sorted(nearest)]
+
+    def _top_rows(self, queries: np.ndarray, ranges: list, top_k: int, mask) -> list[list[tuple[float, int]]]:
+        best = [[] for _ in queries]
+        for start, stop in ranges:
+            if stop <= start:
+                continue
+            scores = self._scores(queries, start, stop)
+            if mask is not None:
+                scores[:, ~mask[start:stop]] = -np.inf
+            k = min(top_k, stop - start)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            for q, rows in enumerate(top):
+                best[q] += [(float(scores[q, r]), start + int(r)) for r in rows if scores[q, r] > -np.inf]
+        return [sorted(candidates, reverse=True)[:top_k] for candidates in best]
+
+    def search_many(self, query_embeddings, top_k: int, where: dict | None = None) -> list[list[tuple[str, str, dict]]]:
+        """
+        Nearest chunks for each query embedding.
+        Returns:
+            list[list[tuple[str, str, dict]]]: (id, document chunk, metadata) triples per query, best first;
+            each metadata copy carries the cosine "similarity" to the query.
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        mask = self._mask(where) if where else None
+        if self.centroids is None:
+            hits = self._top_rows(queries, self._ranges(queries[0]), top_k, mask)
+        else:
+            hits = []
+            for query in queries:
+                found = self._top_rows(query[None, :], self._ranges(query), top_k, mask)[0]
+                if len(found) < top_k:
+                    # Probed lists too sparse (e.g. under a narrow filter): scan everything
+                    everything = [(i, min(i + SEARCH_BLOCK_ROWS, len(self))) for i in range(0, len(self), SEARCH_BLOCK_ROWS)]
+                    found = self._top_rows(query[None, :], everything, top_k, mask)[0]
+                hits.append(found)
+        return [[(self.ids[row], self.document(row), {**self.metadatas[row], "similarity": round(score, 4)})
+                 for score, row in found] for found in hits]
+
+    # Chroma-style read used by the query router (where, include=["embeddings", "metadatas"], limit)
+    def get(self, where: dict | None = None, include=("metadatas",), limit: int | None = None) -> dict:
+        rows = np.flatnonzero(self._mask(where)) if where else np.arange(len(self))
+        rows = rows[:limit] if limit else rows
+        result = {"ids": [self.ids[r] for r in rows]}
+        if "metadatas" in include:
+            result["metadatas"] = [self.metadatas[r] for r in rows]
+        if "documents" in include:
+            result["documents"] = [self.document(r) for r in rows]
+        if "embeddings" in include:
+            vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+            result["embeddings"] = vectors * np.asarray(self.scales[rows])[:, None] if self.scales is not None else vectors
+        return result
+
+
+_index = None
+_index_mtime = None
+_index_lock = threading.Lock()
+
+
+# Open the exported index, reopening it whenever a new export lands; None if there is none (or it is stale)
+def get_index() -> MmapVectorIndex | None:
+    global _index, _index_mtime
+    try:
+        mtime = (INDEX_DIR / "index.json").stat().st_mtime
+    except FileNotFoundError:
+        return None
+    if mtime != _index_mtime:
+        with _index_lock:
+            if mtime != _index_mtime:
+                from encoder import MODEL_NAME, active_backend
+                # Check the manifest before opening: an older format lacks the files this version reads
+                manifest = json.loads((INDEX_DIR / "index.json").read_text(encoding="utf-8"))
+                index = None
+                if (manifest.get("model") != MODEL_NAME or manifest.get("backend") != active_backend()
+                        or manifest.get("version") != INDEX_FORMAT_VERSION):
+                    print(f"Ignoring vector index at {INDEX_DIR}: built for another model, backend or format; "
+                          f"re-export it")
+                else:
+                    index = MmapVectorIndex(INDEX_DIR)
+                _index, _index_mtime = index, mtime
+    return _index
+
+
+# Command-line entry point: python vector_index.py --dtype int8
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the Chroma collection to a memory-mapped vector index.")
+    parser.add_argument("--dtype", choices=["float16", "int8"], default=VECTOR_INDEX_DTYPE)
+    parser.add_argument("--ivf-min-vectors", type=int, default=IVF_MIN_VECTORS,
+                        help="build IVF lists at or above this many vectors (0 forces IVF)")
+    args = parser.parse_args()
+    from retriever import open_collection
+    print(export_index(open_collection(), dtype=args.dtype, ivf_min_vectors=max(1, args.ivf_min_vectors)))